@@ -122,6 +122,8 @@ class AzurePathContext:
         """Azure setup for finetuning. Prepend mount folder."""
         if self.azure_env:
             for entry in self.cfg.paths:
+                if entry == 'tokenized_shards': # shard numbers, not paths
+                    continue
                 if isinstance(self.cfg.paths[entry], list):
                     new_list = []
                     for path in self.cfg.paths[entry]:
@@ -8,6 +8,8 @@ from transformers import BertConfig
 
 from ehr2vec.common.config import Config, load_config
 from ehr2vec.common.utils import Data
+from ehr2vec.common.vocabulary import VocabularyIndex
+from ehr2vec.data.shards import TokenizedShards, select_pids
 from ehr2vec.data.utils import Utilities
 
 logger = logging.getLogger(__name__)  # Get the logger for this module
@@ -42,8 +44,12 @@ class FeaturesLoader:
         self.path_cfg = cfg.paths
         self.cfg = cfg
 
-    def load_tokenized_data(self, mode: str=None)->Data:
-        """Load features for finetuning"""
+    def load_tokenized_data(self, mode: str=None, shards: List[int]=None, pids: List[str]=None)->Data:
+        """
+        Load features for finetuning. 
+        Sharded output (a tokenized_{mode} directory) is read lazily: only the shards (paths.tokenized_shards) 
+        and patients in pids are loaded if given.
+        """
         tokenized_dir = self.path_cfg.get('tokenized_dir', 'tokenized')
         tokenized_files = self.path_cfg.get('tokenized_file', f"tokenized_{mode}.pt")
         tokenized_pids_files = self.path_cfg.get('tokenized_pids', f"pids_{mode}.pt")
@@ -56,20 +62,40 @@ class FeaturesLoader:
         tokenized_data_path = join(self.path_cfg.data_path, tokenized_dir)
         
         logger.info(f"Loading tokenized data from {tokenized_data_path}")
-        features, pids = self.load_features_and_pids(tokenized_data_path, tokenized_files, tokenized_pids_files)
+        shards = self.path_cfg.get('tokenized_shards', None) if shards is None else shards
+        features, pids = self.load_features_and_pids(tokenized_data_path, tokenized_files, tokenized_pids_files, shards=shards, selected_pids=pids)
         
         logger.info("Loading vocabulary")
         vocabulary = self.load_vocabulary(tokenized_data_path)
         
         return Data(features, pids, vocabulary=vocabulary, mode=mode)
     
+    def open_tokenized_shards(self, mode: str)->TokenizedShards:
+        """Lazy reader of the sharded tokenized data of mode, e.g. to iterate over it one shard at a time"""
+        tokenized_dir = self.path_cfg.get('tokenized_dir', 'tokenized')
+        return TokenizedShards(join(self.path_cfg.data_path, tokenized_dir, f'tokenized_{mode}'))
+
     @staticmethod
-    def load_features_and_pids(tokenized_data_path: str, tokenized_files: list, tokenized_pids_files: list):
+    def load_features_and_pids(tokenized_data_path: str, tokenized_files: list, tokenized_pids_files: list, shards: List[int]=None, selected_pids: List[str]=None):
+        """
+        A tokenized file with a shards directory of the same name without .pt is read from the shards.
+        The selected shards and pids are loaded and concatenated in memory, use open_tokenized_shards to go through them one at a time.
+        """
         features = {}
         pids = []
         for tokenized_file, tokenized_pids_file in zip(tokenized_files, tokenized_pids_files):
-            features_temp = torch.load(join(tokenized_data_path, tokenized_file))
-            pids_temp = torch.load(join(tokenized_data_path, tokenized_pids_file))
+            shards_dir = join(tokenized_data_path, os.path.splitext(tokenized_file)[0])
+            if TokenizedShards.is_sharded(shards_dir):
+                if os.path.exists(join(tokenized_data_path, tokenized_file)):
+                    raise ValueError(f"Both {tokenized_file} and shards in {shards_dir} found in {tokenized_data_path}, remove the stale one")
+                features_temp, pids_temp = TokenizedShards(shards_dir).load(shards=shards, pids=selected_pids)
+            else:
+                if shards is not None:
+                    raise ValueError(f"Shards {shards} selected, but {tokenized_file} is not sharded")
+                features_temp = torch.load(join(tokenized_data_path, tokenized_file))
+                pids_temp = torch.load(join(tokenized_data_path, tokenized_pids_file))
+                if selected_pids is not None:
+                    features_temp, pids_temp = select_pids(features_temp, pids_temp, set(selected_pids))
             # Concatenate features
             for key in features_temp.keys():
                 features.setdefault(key, []).extend(features_temp[key])
@@ -84,7 +110,9 @@ class FeaturesLoader:
         if not os.path.exists(vocabulary_file_path):
             vocabulary_file_path = join(self.path_cfg.data_path, VOCABULARY_FILE)
         
-        return torch.load(vocabulary_file_path)
+        vocabulary = torch.load(vocabulary_file_path)
+        VocabularyIndex.load(vocabulary, vocabulary_file_path) # Index saved with the vocabulary, used by the token lookups
+        return vocabulary
 
     def load_outcomes(self)->Tuple[dict, dict]:
         logger.info(f'Load outcomes from {self.path_cfg.outcome}')
@@ -109,6 +137,7 @@ class FeaturesLoader:
         outcomes = torch.load(join(path, f'outcomes.pt'))
         pids = torch.load(join(path, f'pids.pt'))
         vocabulary = torch.load(join(path, 'vocabulary.pt'))
+        VocabularyIndex.load(vocabulary, join(path, 'vocabulary.pt'))
         return Data(features, pids, outcomes, vocabulary=vocabulary, mode=mode)
 
 class ModelLoader:
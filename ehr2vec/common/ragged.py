@@ -0,0 +1,249 @@
+from collections.abc import MutableMapping, Sequence
+from dataclasses import dataclass
+from itertools import chain
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+
+
+@dataclass
+class RaggedFeatures:
+    """
+    Features of many patients in a ragged (CSR) layout.
+    Every feature is one flat array holding the values of all patients,
+    patient i spans values[feature][offsets[i]:offsets[i+1]].
+    """
+    values: Dict[str, np.ndarray]
+    offsets: np.ndarray
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def patient_indices(self) -> np.ndarray:
+        """Index of the patient of every value"""
+        return np.repeat(np.arange(len(self)), self.lengths())
+
+    @classmethod
+    def from_lists(cls, features: Dict[str, list]) -> 'RaggedFeatures':
+        """Create from the dict of lists layout, {feature: [patient_values, ...]}"""
+        lengths = [len(patient) for patient in features['concept']]
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        values = {}
+        for feature, patients in features.items():
+            flat = [value for patient in patients for value in patient]
+            array = np.array(flat)
+            # Strings are kept as objects, built from the values so missing values are not turned into 'nan'
+            values[feature] = np.array(flat, dtype=object) if array.dtype.kind in 'US' else array
+        return cls(values, offsets)
+
+    def to_lists(self) -> Dict[str, list]:
+        """Convert to the dict of lists layout. Values are converted to python types, as with pd.Series.tolist()"""
+        bounds = list(zip(self.offsets[:-1].tolist(), self.offsets[1:].tolist()))
+        features = {}
+        for feature, values in self.values.items():
+            flat = values.tolist()
+            features[feature] = [flat[start:end] for start, end in bounds]
+        return features
+
+    def select(self, indices: np.ndarray) -> 'RaggedFeatures':
+        """Select patients by index, in the given order"""
+        indices = np.asarray(indices, dtype=np.int64)
+        lengths = self.lengths()[indices]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # Position of every kept value in the flat arrays
+        positions = np.repeat(self.offsets[indices] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return RaggedFeatures({feature: values[positions] for feature, values in self.values.items()}, offsets)
+
+    def head(self, lengths: np.ndarray) -> 'RaggedSlices':
+        """The first lengths[i] values of every patient, as views of the value arrays"""
+        lengths = np.minimum(np.asarray(lengths, dtype=np.int64), self.lengths())
+        return RaggedSlices(self.values, self.offsets[:-1], self.offsets[:-1] + lengths)
+
+    def mask(self, keep: np.ndarray) -> 'RaggedFeatures':
+        """Keep the values where keep is True, in one gather over all features"""
+        offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.patient_indices()[keep], minlength=len(self)), out=offsets[1:])
+        positions = np.flatnonzero(keep)
+        return RaggedFeatures({feature: values[positions] for feature, values in self.values.items()}, offsets)
+
+
+@dataclass
+class RaggedSlices:
+    """
+    Patients as slices values[feature][starts[i]:ends[i]] of shared value arrays,
+    e.g. several censored versions of the same features without copying them.
+    """
+    values: Dict[str, np.ndarray]
+    starts: np.ndarray
+    ends: np.ndarray
+
+    def __len__(self):
+        return len(self.starts)
+
+    def lengths(self) -> np.ndarray:
+        return self.ends - self.starts
+
+    def patient(self, index: int) -> Dict[str, np.ndarray]:
+        """Features of one patient, views of the value arrays"""
+        start, end = self.starts[index], self.ends[index]
+        return {feature: values[start:end] for feature, values in self.values.items()}
+
+    def to_ragged(self) -> RaggedFeatures:
+        """Copy the slices into a compact RaggedFeatures"""
+        offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(self.lengths(), out=offsets[1:])
+        positions = np.repeat(self.starts - offsets[:-1], self.lengths()) + np.arange(offsets[-1])
+        return RaggedFeatures({feature: values[positions] for feature, values in self.values.items()}, offsets)
+
+    def to_lists(self) -> Dict[str, list]:
+        return self.to_ragged().to_lists()
+
+
+def flatten(patients: List[list]) -> Tuple[np.ndarray, np.ndarray]:
+    """Values of all patients as one flat array, with the offsets of the patients"""
+    offsets = np.zeros(len(patients) + 1, dtype=np.int64)
+    np.cumsum([len(patient) for patient in patients], out=offsets[1:])
+    return np.array(list(chain.from_iterable(patients))), offsets
+
+
+def unflatten(values: np.ndarray, offsets: np.ndarray) -> List[list]:
+    """Inverse of flatten, values are converted to python types"""
+    flat = values.tolist()
+    return [flat[start:end] for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+
+def segment_sum(values: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """Sum of the values of every patient, with np.add.reduceat. Empty patients sum to 0"""
+    values = np.asarray(values)
+    if values.dtype == bool:
+        values = values.astype(np.int64)
+    # reduceat returns the value at the index for empty patients, and needs indices < len(values)
+    sums = np.add.reduceat(np.append(values, values.dtype.type(0)), np.minimum(offsets[:-1], len(values)))
+    return np.where(np.diff(offsets) > 0, sums, 0)
+
+
+def range_positions(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """Positions of the index ranges [starts[i], starts[i] + lengths[i]), concatenated"""
+    ends = np.cumsum(lengths)
+    return np.repeat(starts - (ends - lengths), lengths) + np.arange(ends[-1] if len(ends) else 0)
+
+
+def segmented_dense_rank(values: np.ndarray, patient_indices: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """Dense rank of the values within every patient, e.g. segments [0, 3, 3, 6] -> [0, 1, 1, 2]"""
+    order = np.lexsort((values, patient_indices))
+    sorted_values, sorted_patients = values[order], patient_indices[order]
+    is_new = np.ones(len(values), dtype=bool)
+    is_new[1:] = (sorted_values[1:] != sorted_values[:-1]) | (sorted_patients[1:] != sorted_patients[:-1])
+    ranks = np.cumsum(is_new)
+    # Sorting keeps every patient within its offsets, so its first sorted value is at offsets[patient]
+    ranks -= ranks[offsets[sorted_patients]]
+    dense = np.empty(len(values), dtype=np.int64)
+    dense[order] = ranks
+    return dense
+
+
+class FeaturesView(MutableMapping):
+    """
+    Features of a subset of patients, with the dict of lists interface ({feature: [patient_values, ...]}),
+    backed by shared RaggedFeatures. Per patient features (e.g. PLOS) are kept in patient_values, indexed by patient.
+    Selecting patients only composes the indices, the values are not copied.
+    A feature is copied into a list of the selected patients when it is written (copy-on-write),
+    either by features[key] = values or by features[key][i] = patient_values.
+    Reading a patient always returns a new list, so editing it in place (e.g. features[key][i].append(x))
+    changes nothing in the view: build the new values and assign them with features[key][i] = values.
+    """
+    def __init__(self, base: RaggedFeatures, indices: np.ndarray = None, patient_values: Dict[str, list] = None,
+                 copies: Dict[str, list] = None, keys: List[str] = None):
+        self.base = base
+        self.patient_values = patient_values or {}
+        self.indices = np.arange(len(base)) if indices is None else np.asarray(indices, dtype=np.int64)
+        self.copies = copies or {}
+        self._keys = list(keys) if keys is not None else list(base.values) + list(self.patient_values)
+
+    @classmethod
+    def from_lists(cls, features: Dict[str, list]) -> 'FeaturesView':
+        """Copy the dict of lists layout into flat arrays once, features that are not sequences are per patient values"""
+        is_ragged = {key: len(values) == 0 or isinstance(values[0], (list, tuple, np.ndarray)) for key, values in features.items()}
+        base = RaggedFeatures.from_lists({key: values for key, values in features.items() if is_ragged[key]})
+        patient_values = {key: list(values) for key, values in features.items() if not is_ragged[key]}
+        return cls(base, patient_values=patient_values, keys=list(features))
+
+    def select(self, indices: Union[List[int], np.ndarray]) -> 'FeaturesView':
+        """View of the patients at the given indices, in their order"""
+        indices = np.asarray(indices, dtype=np.int64)
+        positions = indices.tolist()
+        copies = {key: [values[i] for i in positions] for key, values in self.copies.items()}
+        return FeaturesView(self.base, self.indices[indices], self.patient_values, copies, self._keys)
+
+    def patient(self, key: str, index: int):
+        """Values of one patient, as a new list of python types like the dict of lists layout"""
+        if key in self.copies:
+            values = self.copies[key][index]
+            return list(values) if isinstance(values, list) else values
+        patient = int(self.indices[index])
+        if key in self.patient_values:
+            return self.patient_values[key][patient]
+        return self.base.values[key][self.base.offsets[patient]:self.base.offsets[patient + 1]].tolist()
+
+    def copy_feature(self, key: str) -> list:
+        """Copy the feature into a list of the selected patients, further writes go to the copy"""
+        if key not in self.copies:
+            self.copies[key] = [self.patient(key, i) for i in range(len(self.indices))]
+        return self.copies[key]
+
+    def to_lists(self) -> Dict[str, list]:
+        return {key: list(self[key]) for key in self}
+
+    def __getitem__(self, key: str) -> 'FeatureColumn':
+        if key not in self._keys:
+            raise KeyError(key)
+        return FeatureColumn(self, key)
+
+    def __setitem__(self, key: str, values: list) -> None:
+        self.copies[key] = values
+        if key not in self._keys:
+            self._keys.append(key)
+
+    def __delitem__(self, key: str) -> None:
+        self._keys.remove(key)
+        self.copies.pop(key, None)
+
+    def __iter__(self):
+        return iter(list(self._keys))
+
+    def __len__(self):
+        """Number of features, as for a dict"""
+        return len(self._keys)
+
+
+class FeatureColumn(Sequence):
+    """
+    The patients of one feature of a FeaturesView, as a list with copy-on-write.
+    Items are new lists on every read, write a patient back with column[i] = values, in place edits are not kept.
+    """
+    def __init__(self, view: FeaturesView, key: str):
+        self.view = view
+        self.key = key
+
+    def __len__(self):
+        return len(self.view.indices)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.view.patient(self.key, i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('patient index out of range')
+        return self.view.patient(self.key, index)
+
+    def __setitem__(self, index, values) -> None:
+        self.view.copy_feature(self.key)[index] = values
+
+    def __eq__(self, other):
+        return list(self) == list(other)
@@ -6,6 +6,7 @@ import torch
 
 from typing import Dict
 from ehr2vec.common.utils import Data
+from ehr2vec.common.vocabulary import VocabularyIndex
 
 VOCABULARY_FILE = 'vocabulary.pt'
 
@@ -59,11 +60,12 @@ class Saver:
         """Save data (features, pids and outcomes (if present) to run_folder)"""
         torch.save(data.features, join(self.run_folder, 'features.pt'))
         torch.save(data.pids, join(self.run_folder, 'pids.pt'))
-        torch.save(data.vocabulary, join(self.run_folder, 'vocabulary.pt'))
+        self.save_vocab(data.vocabulary)
         if data.outcomes is not None:
             torch.save(data.outcomes, join(self.run_folder, 'outcomes.pt'))
         if data.censor_outcomes is not None:
             torch.save(data.censor_outcomes, join(self.run_folder, 'censor_outcomes.pt'))
 
     def save_vocab(self, vocabulary, name: str=VOCABULARY_FILE):
-        torch.save(vocabulary, join(self.run_folder, name))
\ No newline at end of file
+        torch.save(vocabulary, join(self.run_folder, name))
+        VocabularyIndex.get(vocabulary).save(join(self.run_folder, name))
\ No newline at end of file
@@ -12,10 +12,13 @@ logger = logging.getLogger(__name__)  # Get the logger for this module
 
 CHECKPOINTS_DIR = "checkpoints"
 
-def get_args(default_config_name, default_run_name=None):
+def get_args(default_config_name, default_run_name=None, extra_args: dict=None):
+    """extra_args maps additional argument names to add_argument kwargs, e.g. {'--workers': {'type': int, 'default': 1}}"""
     parser = argparse.ArgumentParser()
     parser.add_argument('--config_path', type=str, default=join('configs', default_config_name))
     parser.add_argument('--run_name', type=str, default=default_run_name if default_run_name else default_config_name.split('.')[0])
+    for name, kwargs in (extra_args or {}).items():
+        parser.add_argument(name, **kwargs)
     return parser.parse_args()
 
 def setup_logger(dir: str, log_file: str = 'info.log'):
@@ -1,5 +1,6 @@
 import glob
 import logging
+import multiprocessing
 import os
 import random
 from dataclasses import dataclass, field
@@ -9,6 +10,8 @@ from typing import Dict, List, Optional, Tuple, Generator
 import torch
 from torch.utils.data import IterableDataset
 
+from ehr2vec.common.ragged import FeaturesView
+
 logger = logging.getLogger(__name__)  # Get the logger for this module
 
 def iter_patients(features: dict) -> Generator[dict, None, None]:
@@ -16,6 +19,16 @@ def iter_patients(features: dict) -> Generator[dict, None, None]:
     for i in range(len(features["concept"])):
         yield {key: values[i] for key, values in features.items()}
 
+def get_mp_context():
+    """
+    Workers are started fresh instead of forked, so they do not inherit the loaded data or the threads of the parent.
+    With forkserver, the server imports ehr2vec once and workers fork from it, instead of each importing torch again.
+    """
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    multiprocessing.set_forkserver_preload(['ehr2vec.data.batch', 'ehr2vec.main_create_data'])
+    return multiprocessing.get_context('forkserver')
+
 def check_patient_counts(concepts, patients_info, logger):
     if concepts.PID.nunique() != patients_info.PID.nunique():
             logger.warning(f"patients info contains {patients_info.PID.nunique()} patients != \
@@ -94,8 +107,21 @@ class Data:
         val_data = self.select_data_subset_by_indices(val_indices, 'val')
         return train_data, val_data
     
+    def to_views(self)->'Data':
+        """
+        Back the features by flat arrays (FeaturesView), so subsets are index views sharing the values instead of copies.
+        Features are only copied for a subset when it writes to them.
+        """
+        if isinstance(self.features, dict) and 'concept' in self.features:
+            self.features = FeaturesView.from_lists(self.features)
+        return self
+
     def select_data_subset_by_indices(self, indices: list, mode:str ='')->'Data':
-        return Data(features={key: [values[i] for i in indices] for key, values in self.features.items()}, 
+        if not isinstance(self.features, dict):
+            features = self.features.select(indices)
+        else:
+            features = {key: [values[i] for i in indices] for key, values in self.features.items()}
+        return Data(features=features, 
                         pids=[self.pids[i] for i in indices],
                         outcomes=[self.outcomes[i] for i in indices] if self.outcomes is not None else None,
                         censor_outcomes=[self.censor_outcomes[i] for i in indices] if self.censor_outcomes is not None else None,
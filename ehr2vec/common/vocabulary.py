@@ -0,0 +1,160 @@
+import os
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, Tuple, Union
+
+import numpy as np
+import torch
+
+SPECIAL_PREFIX = '['
+BACKGROUND_PREFIX = 'BG_'
+INDEX_SUFFIX = '_index.pt'
+CACHE_SIZE = 8
+ANCESTOR_CACHE_SIZE = 100000
+
+
+class VocabularyIndex:
+    """
+    Array-backed lookups of a vocabulary {token: id}, indexed by token id:
+    - tokens: id -> token, None for ids without a token
+    - is_special: [CLS], [SEP], [MASK], ... tokens
+    - is_background: BG_ tokens
+    - prefix_mask(prefixes): tokens starting with any of the prefixes, e.g. code types, computed once per prefixes
+    Use VocabularyIndex.get(vocabulary) to build it once per vocabulary. Adding, removing or replacing tokens rebuilds it,
+    changing the id of an existing token in place does not: vocabularies are frozen once they are used for lookups.
+    """
+    _cache: 'OrderedDict[int, VocabularyIndex]' = OrderedDict()
+
+    def __init__(self, vocabulary: Dict[str, int]):
+        self.vocabulary = vocabulary
+        self.size = len(vocabulary)
+        self.fingerprint = self.get_fingerprint(vocabulary)
+        self.tokens = self.get_tokens(vocabulary)
+        self.prefix_masks = {}
+        self.is_special = self.prefix_mask(SPECIAL_PREFIX)
+        self.is_background = self.prefix_mask(BACKGROUND_PREFIX)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    @classmethod
+    def get(cls, vocabulary: Dict[str, int]) -> 'VocabularyIndex':
+        """Index of the vocabulary, built only if the vocabulary object is new or its tokens have changed"""
+        index = cls._cache.get(id(vocabulary))
+        if index is None or index.vocabulary is not vocabulary or index.fingerprint != cls.get_fingerprint(vocabulary):
+            index = cls._register(cls(vocabulary))
+        return index
+
+    @staticmethod
+    def get_fingerprint(vocabulary: Dict[str, int]) -> Tuple[int, tuple]:
+        """Size and last (token, id) pair, in constant time. Changes when tokens are added, or removed and replaced"""
+        return len(vocabulary), next(reversed(vocabulary.items()), None)
+
+    @staticmethod
+    def get_tokens(vocabulary: Dict[str, int]) -> np.ndarray:
+        """id -> token, None for ids without a token"""
+        tokens = np.empty(max(vocabulary.values(), default=-1) + 1, dtype=object)
+        tokens[list(vocabulary.values())] = list(vocabulary.keys())
+        return tokens
+
+    @classmethod
+    def _register(cls, index: 'VocabularyIndex') -> 'VocabularyIndex':
+        cls._cache[id(index.vocabulary)] = index
+        while len(cls._cache) > CACHE_SIZE:
+            cls._cache.popitem(last=False)
+        return index
+
+    def prefix_mask(self, prefixes: Union[str, Tuple[str, ...]]) -> np.ndarray:
+        """Mask of the token ids whose token starts with any of the prefixes"""
+        prefixes = (prefixes,) if isinstance(prefixes, str) else tuple(prefixes)
+        if prefixes not in self.prefix_masks:
+            self.prefix_masks[prefixes] = np.array(
+                [token is not None and token.startswith(prefixes) for token in self.tokens], dtype=bool)
+        return self.prefix_masks[prefixes]
+
+    @staticmethod
+    def lookup(mask: np.ndarray, ids: np.ndarray) -> np.ndarray:
+        """mask[ids], ids outside of the vocabulary are False"""
+        ids = np.asarray(ids, dtype=np.int64)
+        flags = np.zeros(len(ids), dtype=bool)
+        valid = (ids >= 0) & (ids < len(mask))
+        flags[valid] = mask[ids[valid]]
+        return flags
+
+    def decode(self, ids: np.ndarray) -> np.ndarray:
+        """Tokens of the ids, None for ids outside of the vocabulary"""
+        ids = np.asarray(ids, dtype=np.int64)
+        tokens = np.full(len(ids), None, dtype=object)
+        valid = (ids >= 0) & (ids < len(self.tokens))
+        tokens[valid] = self.tokens[ids[valid]]
+        return tokens
+
+    def save(self, vocabulary_path: str) -> None:
+        """Save next to the vocabulary file, vocabulary.pt -> vocabulary_index.pt"""
+        prefix_masks = {prefixes: torch.from_numpy(mask) for prefixes, mask in self.prefix_masks.items()}
+        torch.save({'size': self.size, 'tokens': self.tokens.tolist(), 'prefix_masks': prefix_masks},
+                   self.get_path(vocabulary_path))
+
+    @classmethod
+    def load(cls, vocabulary: Dict[str, int], vocabulary_path: str) -> 'VocabularyIndex':
+        """Load the index saved with the vocabulary, build it if there is none or it belongs to another vocabulary"""
+        path = cls.get_path(vocabulary_path)
+        if not os.path.exists(path):
+            return cls.get(vocabulary)
+        saved = torch.load(path)
+        if saved['size'] != len(vocabulary) or saved['tokens'] != cls.get_tokens(vocabulary).tolist():
+            return cls._register(cls(vocabulary)) # Saved with another vocabulary
+        index = cls.__new__(cls)
+        index.vocabulary, index.size = vocabulary, saved['size']
+        index.fingerprint = cls.get_fingerprint(vocabulary)
+        index.tokens = np.empty(len(saved['tokens']), dtype=object)
+        index.tokens[:] = saved['tokens']
+        index.prefix_masks = {prefixes: mask.numpy() for prefixes, mask in saved['prefix_masks'].items()}
+        index.is_special = index.prefix_mask(SPECIAL_PREFIX)
+        index.is_background = index.prefix_mask(BACKGROUND_PREFIX)
+        return cls._register(index)
+
+    @staticmethod
+    def get_path(vocabulary_path: str) -> str:
+        return os.path.splitext(vocabulary_path)[0] + INDEX_SUFFIX
+
+
+class AncestorIndex:
+    """
+    Closest ancestor lookup of a frozen vocabulary {token: id}: the id of the longest prefix of a concept that is in the vocabulary.
+    The prefixes are compiled once into a trie, a concept is resolved in a single walk over its characters.
+    Resolved concepts are kept in an LRU cache of cache_size concepts, cache_info() gives the hits and misses.
+    """
+    _END = None # Key of the token id in a trie node, the other keys are characters
+
+    def __init__(self, vocabulary: Dict[str, int], default: int, cache_size: int = ANCESTOR_CACHE_SIZE):
+        self.vocabulary = vocabulary
+        self.size = len(vocabulary)
+        self.default = default
+        self.root = {}
+        for token, index in vocabulary.items():
+            node = self.root
+            for char in token:
+                node = node.setdefault(char, {})
+            node[self._END] = index
+        self.find = lru_cache(maxsize=cache_size)(self._longest_prefix)
+
+    def __call__(self, concept: str) -> int:
+        return self.find(concept)
+
+    def _longest_prefix(self, concept: str) -> int:
+        node = self.root
+        found = node.get(self._END, self.default)
+        for char in concept:
+            node = node.get(char)
+            if node is None:
+                break
+            found = node.get(self._END, found)
+        return found
+
+    def is_current(self, vocabulary: Dict[str, int]) -> bool:
+        """False if the index was built for another vocabulary or the vocabulary has changed size since"""
+        return self.vocabulary is vocabulary and self.size == len(vocabulary)
+
+    def cache_info(self):
+        return self.find.cache_info()
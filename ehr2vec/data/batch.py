@@ -4,13 +4,19 @@ import random
 import logging
 from tqdm import tqdm
 from os.path import join
-from dataclasses import dataclass
-from typing import Dict, List, Tuple
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
 
 from ehr2vec.data.utils import Utilities
 from ehr2vec.common.loader import load_assigned_pids, load_exclude_pids
 from ehr2vec.common.logger import TqdmToLogger
-from ehr2vec.common.utils import check_directory_for_features
+from ehr2vec.common.utils import check_directory_for_features, get_mp_context
+from ehr2vec.common.vocabulary import VocabularyIndex
+from ehr2vec.data.shards import TokenizedShards, TokenizedShardWriter
 
 logger = logging.getLogger(__name__)  # Get the logger for this module
 PRETRAIN = 'pretrain'
@@ -22,6 +28,38 @@ class Split:
     pids: list = None
     mode: str = None
 
+@dataclass
+class Route:
+    """Patients of one feature file to tokenize, with the split they go to and their position in split.pids"""
+    pids: list = field(default_factory=list)
+    modes: list = field(default_factory=list)
+    positions: list = field(default_factory=list)
+
+@dataclass
+class SplitStream:
+    """
+    Tokenized patients of a split in the order they were tokenized, with their position in split.pids.
+    With a writer, patients are written to shards in the order they were tokenized instead of kept in memory.
+    """
+    encoded: dict = field(default_factory=dict)
+    pids: list = field(default_factory=list)
+    positions: list = field(default_factory=list)
+    writer: TokenizedShardWriter = None
+
+    def append(self, encoded: dict, pids: list, positions: list)->None:
+        if self.writer is not None:
+            self.writer.append(encoded, pids)
+            return
+        BatchTokenize.merge_dicts(self.encoded, encoded)
+        self.pids.extend(pids)
+        self.positions.extend(positions)
+
+    def ordered(self)->Tuple[dict, list]:
+        """Encoded features and pids in the order of split.pids"""
+        permutation = np.empty(len(self.positions), dtype=np.int64)
+        permutation[self.positions] = np.arange(len(self.positions))
+        return {key: [values[i] for i in permutation] for key, values in self.encoded.items()}, [self.pids[i] for i in permutation]
+
 class Batches:
     """Class for splitting batches into pretrain, finetune and test sets"""
     def __init__(self, cfg, pids: List[List[str]]):
@@ -163,11 +201,53 @@ class Batches:
         pids_set = set(pids)
         return {split: [pid for pid in pids if pid in pids_set] for split, pids in assigned_pids.items()}
 
+_worker_tokenizer = None # Tokenizer of a BatchTokenize worker process, set once per process
+
+def _init_tokenize_worker(tokenizer)->None:
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+def _scan_batch(file_id: str, selected_pids_in_file: List[str], features_dir: str)->list:
+    """Distinct concepts of the selected patients of a feature file, in order of first occurrence"""
+    features, _ = BatchTokenize.load_and_filter_batch(file_id, selected_pids_in_file, features_dir)
+    return _worker_tokenizer.scan_concepts(features)
+
+def _tokenize_batch(file_id: str, selected_pids_in_file: List[str], features_dir: str)->Tuple[dict, List[str], tuple]:
+    """Tokenizes the selected patients of a feature file with a frozen vocabulary. Also returns the (hits, misses) of closest ancestor lookups"""
+    features, pids = BatchTokenize.load_and_filter_batch(file_id, selected_pids_in_file, features_dir)
+    hits, misses = _worker_tokenizer.ancestor_lookup_counts()
+    encoded = _worker_tokenizer(features)
+    total_hits, total_misses = _worker_tokenizer.ancestor_lookup_counts()
+    return dict(encoded), pids, (total_hits - hits, total_misses - misses)
+
+def _route_batch(file_id: str, route: Route, features_dir: str)->Tuple[Dict[str, Tuple[dict, List[int]]], tuple]:
+    """
+    Tokenizes the patients of a feature file per split with a frozen vocabulary. 
+    Returns {mode: (encoded, indices in route)} and the (hits, misses) of closest ancestor lookups
+    """
+    features, _ = BatchTokenize.load_and_filter_batch(file_id, route.pids, features_dir)
+    hits, misses = _worker_tokenizer.ancestor_lookup_counts()
+    encoded = {mode: (dict(_worker_tokenizer(BatchTokenize.select_patients(features, indices))), indices) 
+               for mode, indices in BatchTokenize.group_indices(route.modes).items()}
+    total_hits, total_misses = _worker_tokenizer.ancestor_lookup_counts()
+    return encoded, (total_hits - hits, total_misses - misses)
+
 class BatchTokenize:
-    def __init__(self, pids: List[List[str]], tokenizer, cfg, tokenized_dir_name:str='tokenized'):
+    def __init__(self, pids: List[List[str]], tokenizer, cfg, tokenized_dir_name:str='tokenized', workers: int=1, route_splits: bool=False, shard_size: int=None):
+        """
+        With workers > 1, tokenization runs in two phases: the distinct concepts of the pretrain files are scanned in parallel 
+        and merged in file and patient order into the vocabulary, the same ids as a sequential run. 
+        All files are then encoded in parallel with the frozen vocabulary.
+        With route_splits, every feature file is loaded once for all splits instead of once per split.
+        With shard_size, each split is streamed to a tokenized_{mode} directory of shards with shard_size patients, 
+        in the order the patients were tokenized, instead of saved as one tokenized_{mode}.pt in the order of split.pids.
+        """
         self.tokenizer = tokenizer
         self.cfg = cfg
         self.tokenized_dir_name = tokenized_dir_name
+        self.workers = workers
+        self.route_splits = route_splits
+        self.shard_size = shard_size
         self.create_tokenized_directory()
         self.pid2fileid = self.map_pids_to_file_ids(pids)
 
@@ -181,6 +261,11 @@ class BatchTokenize:
 
     def tokenize(self, splits: Dict[str, Split])->None:
         """Tokenizes all batches. The returned order is according to the pids in splits."""
+        if self.workers > 1 and self.tokenizer.new_vocab:
+            self.build_vocabulary(splits[PRETRAIN])
+        if self.route_splits:
+            self.tokenize_routed(splits)
+            return
         self.batch_tokenize(splits[PRETRAIN])
         self.tokenizer.freeze_vocabulary()
         self.save_vocabulary()
@@ -188,16 +273,130 @@ class BatchTokenize:
         if TEST in splits and len(splits[TEST].pids) > 0:
             self.batch_tokenize(splits[TEST])
     
+    def tokenize_routed(self, splits: Dict[str, Split])->None:
+        """
+        Tokenizes all splits in a single pass over the feature files, each file is loaded once.
+        Patients are appended to the stream of their split, which is put in the order of split.pids at the end.
+        While the vocabulary is built from the pretrain patients, the patients of the other splits are only prepared 
+        and encoded once the vocabulary is frozen, so the result is the same as tokenizing split by split.
+        """
+        splits = {mode: split for mode, split in splits.items() if mode != TEST or len(split.pids) > 0}
+        routes = self.get_routes(splits)
+        features_dir = self.get_features_directory()
+        streams = {mode: SplitStream(writer=self.get_shard_writer(mode) if self.shard_size else None) for mode in splits}
+        if self.workers > 1 and not self.tokenizer.new_vocab:
+            self.route_files_parallel(routes, features_dir, streams)
+        else:
+            deferred = [] # (mode, prepared patients, positions) waiting for the frozen vocabulary
+            for file_id, route in tqdm(routes.items(), desc='Tokenizing batches', file=TqdmToLogger(logger)):
+                features, _ = self.load_and_filter_batch(file_id, route.pids, features_dir)
+                for mode, indices in self.group_indices(route.modes).items():
+                    mode_features, positions = self.select_patients(features, indices), [route.positions[i] for i in indices]
+                    mode_pids = [route.pids[i] for i in indices]
+                    if mode != PRETRAIN and self.tokenizer.new_vocab:
+                        deferred.append((mode, self.tokenizer.prepare_batch(mode_features, self.tokenizer.truncation), mode_pids, positions))
+                    else:
+                        streams[mode].append(self.tokenizer(mode_features), mode_pids, positions)
+            if self.tokenizer.new_vocab:
+                self.tokenizer.freeze_vocabulary()
+            for mode, patients, mode_pids, positions in deferred:
+                streams[mode].append(self.tokenizer.encode_prepared(patients, self.tokenizer.padding), mode_pids, positions)
+            ancestor_lookup_info = self.tokenizer.ancestor_lookup_info()
+            if ancestor_lookup_info:
+                logger.info(ancestor_lookup_info)
+        self.save_vocabulary()
+
+        for mode, split in splits.items():
+            if streams[mode].writer is not None:
+                pids = streams[mode].writer.close()
+                assert len(pids) == len(split.pids), f"Tokenized pids ({len(pids)}) do not match split {mode} pids ({len(split.pids)})"
+                continue
+            encoded, pids = streams[mode].ordered()
+            assert pids == split.pids, f"Tokenized pids ({len(pids)}) do not match split {mode} pids ({len(split.pids)})"
+            self.save_tokenized_data(encoded, pids, mode)
+
+    def get_routes(self, splits: Dict[str, Split])->Dict[int, Route]:
+        """Maps the file ids to the patients of the splits in them, in file order"""
+        targets = {pid: (mode, position) for mode, split in splits.items() for position, pid in enumerate(split.pids)}
+        assert set(targets).issubset(self.pid2fileid.keys()), f"Split pids ({len(targets)}) are not a subset of pid2fileid keys ({len(self.pid2fileid.keys())})"
+        routes = {}
+        for pid, file_id in self.pid2fileid.items():
+            if pid in targets:
+                route = routes.setdefault(file_id, Route())
+                mode, position = targets[pid]
+                route.pids.append(pid)
+                route.modes.append(mode)
+                route.positions.append(position)
+        return routes
+
+    def route_files_parallel(self, routes: Dict[int, Route], features_dir: str, streams: Dict[str, SplitStream])->None:
+        """Tokenizes the files in a process pool with the frozen vocabulary and appends the patients to the stream of their split"""
+        hits, misses = 0, 0
+        with self.get_executor() as executor:
+            results = executor.map(_route_batch, routes.keys(), routes.values(), repeat(features_dir))
+            for route, (encoded, (batch_hits, batch_misses)) in tqdm(zip(routes.values(), results), total=len(routes), desc='Tokenizing batches', file=TqdmToLogger(logger)):
+                for mode, (encoded_batch, indices) in encoded.items():
+                    streams[mode].append(encoded_batch, [route.pids[i] for i in indices], [route.positions[i] for i in indices])
+                hits, misses = hits + batch_hits, misses + batch_misses
+        if hits or misses:
+            logger.info(f"Closest ancestor lookups: {hits} hits, {misses} misses")
+
+    @staticmethod
+    def group_indices(modes: List[str])->Dict[str, List[int]]:
+        """Indices of each mode in modes"""
+        indices = {}
+        for index, mode in enumerate(modes):
+            indices.setdefault(mode, []).append(index)
+        return indices
+
+    @staticmethod
+    def select_patients(features: Dict[str, list], indices: List[int])->Dict[str, list]:
+        return {key: [values[i] for i in indices] for key, values in features.items()}
+
+    def build_vocabulary(self, split: Split)->None:
+        """Builds the vocabulary from the concepts of split, scanned in parallel, and freezes it"""
+        fileid2pid = self.group_pids_by_file(split)
+        with self.get_executor() as executor:
+            scans = executor.map(_scan_batch, fileid2pid.keys(), fileid2pid.values(), repeat(self.get_features_directory()))
+            # map returns the scans in file order, so ids do not depend on which worker finishes first
+            for concepts in tqdm(scans, total=len(fileid2pid), desc=f'Scanning {split.mode} concepts', file=TqdmToLogger(logger)):
+                self.tokenizer.add_to_vocabulary(concepts)
+        self.tokenizer.freeze_vocabulary()
+        logger.info(f"Vocabulary size: {len(self.tokenizer.vocabulary)}")
+
+    def get_executor(self)->ProcessPoolExecutor:
+        """Process pool of fresh workers that each get a copy of the tokenizer in its current state"""
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=get_mp_context(),
+                                   initializer=_init_tokenize_worker, initargs=(self.tokenizer,))
+
     def save_vocabulary(self)->None:
-        """Saves the tokenizer's vocabulary."""
-        self.tokenizer.save_vocab(join(self.cfg.output_dir, self.tokenized_dir_name, 'vocabulary.pt'))
+        """Saves the tokenizer's vocabulary and its index."""
+        vocabulary_path = join(self.cfg.output_dir, self.tokenized_dir_name, 'vocabulary.pt')
+        self.tokenizer.save_vocab(vocabulary_path)
+        VocabularyIndex.get(self.tokenizer.vocabulary).save(vocabulary_path)
         
     def batch_tokenize(self, split: Split, save_dir=None)->None:
-        """Tokenizes batches and saves them"""
+        """Tokenizes batches and saves them. With shard_size, they are streamed to shards and a reader of the shards is returned instead of the features"""
         features_dir = self.get_features_directory()
+        if self.shard_size:
+            return self.stream_split(split, features_dir, save_dir=save_dir)
         encoded, pids = self.tokenize_split(split, features_dir)
         self.save_tokenized_data(encoded, pids, split.mode, save_dir=save_dir)
         return encoded, pids
+
+    def stream_split(self, split: Split, features_dir: str, save_dir: str=None)->Tuple[TokenizedShards, List[str]]:
+        """Tokenizes the files of split and writes the patients to shards as they are tokenized, in file order"""
+        writer = self.get_shard_writer(split.mode, save_dir=save_dir)
+        for encoded_batch, batch_pids in self.iter_tokenized_batches(self.group_pids_by_file(split), features_dir, split.mode):
+            writer.append(encoded_batch, batch_pids)
+        pids = writer.close()
+        assert set(split.pids)==set(pids), f"Split pids ({len(split.pids)}) and pids ({len(pids)}) do not match"
+        return TokenizedShards(writer.shards_dir), pids
+
+    def get_shard_writer(self, mode: str, save_dir: str=None)->TokenizedShardWriter:
+        if save_dir is None:
+            save_dir = join(self.cfg.output_dir, self.tokenized_dir_name)
+        return TokenizedShardWriter(join(save_dir, f'tokenized_{mode}'), self.shard_size, pids_file=join(save_dir, f'pids_{mode}.pt'))
         
     def tokenize_split(self, split: Split, features_dir: str)->None:    
         """
@@ -205,17 +404,9 @@ class BatchTokenize:
         Returns tokenized features and pids ordered according to split.pids.
         """
         encoded, pids = {}, []
-        # we need to know which pid is in which file
-        split_pids_set = set(split.pids)
-        assert split_pids_set.issubset(set(self.pid2fileid.keys())), f"Split pids ({len(split_pids_set)}) is not a subset of pid2fileid keys ({len(self.pid2fileid.keys())})"
-        pid2fileid = {pid: file_id for pid, file_id in self.pid2fileid.items() if pid in split_pids_set} 
-        fileid2pid = self.invert_dictionary(pid2fileid)
-        # select only file ids 
-        for file_id, selected_pids_in_file in tqdm(fileid2pid.items(), desc=f'Tokenizing {split.mode} batches', file=TqdmToLogger(logger)):
-            filtered_features, filtered_pids = self.load_and_filter_batch(file_id, selected_pids_in_file, features_dir)
-            encoded_batch = self.tokenizer(filtered_features)
+        for encoded_batch, batch_pids in self.iter_tokenized_batches(self.group_pids_by_file(split), features_dir, split.mode):
             self.merge_dicts(encoded, encoded_batch)
-            pids.extend(filtered_pids)
+            pids.extend(batch_pids)
 
         # use the order of split.pids to ensure the order of encoded and pids is the same
         assert set(split.pids)==set(pids), f"Split pids ({len(split.pids)}) and pids ({len(pids)}) do not match"
@@ -225,6 +416,37 @@ class BatchTokenize:
 
         return encoded, pids
     
+    def group_pids_by_file(self, split: Split)->Dict[int, List[str]]:
+        """Maps the file ids containing pids of split to those pids, in file order"""
+        # we need to know which pid is in which file
+        split_pids_set = set(split.pids)
+        assert split_pids_set.issubset(set(self.pid2fileid.keys())), f"Split pids ({len(split_pids_set)}) is not a subset of pid2fileid keys ({len(self.pid2fileid.keys())})"
+        pid2fileid = {pid: file_id for pid, file_id in self.pid2fileid.items() if pid in split_pids_set} 
+        return self.invert_dictionary(pid2fileid)
+
+    def iter_tokenized_batches(self, fileid2pid: Dict[int, List[str]], features_dir: str, mode: str)->Iterator[Tuple[dict, List[str]]]:
+        """Yields the tokenized features and pids of the selected patients of every file, in file order"""
+        if self.workers > 1 and not self.tokenizer.new_vocab:
+            yield from self.tokenize_files_parallel(fileid2pid, features_dir, mode)
+            return
+        for file_id, selected_pids_in_file in tqdm(fileid2pid.items(), desc=f'Tokenizing {mode} batches', file=TqdmToLogger(logger)):
+            filtered_features, filtered_pids = self.load_and_filter_batch(file_id, selected_pids_in_file, features_dir)
+            yield self.tokenizer(filtered_features), filtered_pids
+        ancestor_lookup_info = self.tokenizer.ancestor_lookup_info()
+        if ancestor_lookup_info:
+            logger.info(ancestor_lookup_info)
+
+    def tokenize_files_parallel(self, fileid2pid: Dict[int, List[str]], features_dir: str, mode: str)->Iterator[Tuple[dict, List[str]]]:
+        """Tokenizes the files in a process pool with the frozen vocabulary. Results are yielded in file order."""
+        hits, misses = 0, 0
+        with self.get_executor() as executor:
+            results = executor.map(_tokenize_batch, fileid2pid.keys(), fileid2pid.values(), repeat(features_dir))
+            for encoded_batch, filtered_pids, (batch_hits, batch_misses) in tqdm(results, total=len(fileid2pid), desc=f'Tokenizing {mode} batches', file=TqdmToLogger(logger)):
+                yield encoded_batch, filtered_pids
+                hits, misses = hits + batch_hits, misses + batch_misses
+        if hits or misses:
+            logger.info(f"Closest ancestor lookups: {hits} hits, {misses} misses")
+
     @staticmethod
     def load_and_filter_batch(file_id: str, 
                             selected_pids_in_file: List[str], 
@@ -0,0 +1,116 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import threading
+from os.path import join
+from typing import Callable, Iterator, Union
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+logger = logging.getLogger(__name__)  # Get the logger for this module
+
+CACHE_FORMAT = '{}_{}_{}.feather'
+
+
+class FormattedDataCache:
+    """
+    Content addressed cache of parsed formatted data files.
+    Frames are stored as uncompressed Feather (Arrow IPC) files, which are memory-mapped when loaded.
+    An entry is keyed by the source path, the source size and mtime and the loader config.
+    Entries of a source file that has since changed are removed when the new entry is written.
+    """
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_or_create(self, file_path: str, config: dict, create: Callable[[], pd.DataFrame]) -> Union[pa.Table, pd.DataFrame]:
+        """Loads the cached table of file_path, or creates, caches and returns it. Frames that can not be cached are returned as they are."""
+        table = self.load(file_path, config)
+        if table is not None:
+            return table
+        df = create()
+        table = self.save(file_path, config, df)
+        return df if table is None else table
+
+    def get_or_create_from_chunks(self, file_path: str, config: dict, create_chunks: Callable[[], Iterator[pd.DataFrame]]) -> pa.Table:
+        """
+        Like get_or_create, but the frame is created in chunks that are written to the cache one at a time, so it is never fully in memory.
+        Dictionary columns are stored decoded, since chunks can have different dictionaries.
+        Returns None if nothing could be cached, e.g. the file is empty or a chunk does not fit the types of the first chunk.
+        """
+        table = self.load(file_path, config)
+        if table is not None:
+            return table
+        path = self.get_cache_path(file_path, config)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        writer, schema = None, None
+        try:
+            for chunk in create_chunks():
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    schema = self._decode_dictionaries(table.schema)
+                    writer = pa.ipc.new_file(tmp_path, schema)
+                writer.write_table(table.select(schema.names).cast(schema))
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError, KeyError) as e:
+            logger.warning(f'Could not cache {file_path}: {e}')
+            if writer is not None:
+                writer.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return None
+        if writer is None:
+            return None
+        writer.close()
+        self._remove_stale(file_path)
+        os.replace(tmp_path, path) # Readers never see a partially written entry
+        return self.load(file_path, config)
+
+    @staticmethod
+    def _decode_dictionaries(schema: pa.Schema) -> pa.Schema:
+        fields = [field.with_type(field.type.value_type) if pa.types.is_dictionary(field.type) else field for field in schema]
+        return pa.schema(fields)
+
+    def load(self, file_path: str, config: dict) -> pa.Table:
+        path = self.get_cache_path(file_path, config)
+        if not os.path.exists(path):
+            return None
+        logger.info(f'Loading {file_path} from cache {path}')
+        return pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+
+    def save(self, file_path: str, config: dict, df: pd.DataFrame) -> pa.Table:
+        """Writes df to the cache and returns it as a table, or None if arrow can not represent the frame."""
+        path = self.get_cache_path(file_path, config)
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            logger.warning(f'Could not cache {file_path}: {e}')
+            return None
+        self._remove_stale(file_path)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        feather.write_feather(table, tmp_path, compression='uncompressed')
+        os.replace(tmp_path, path) # Readers never see a partially written entry
+        return table
+
+    def get_cache_path(self, file_path: str, config: dict) -> str:
+        return join(self.cache_dir, CACHE_FORMAT.format(
+            self._hash(os.path.abspath(file_path)), self._get_signature(file_path), self._hash(config)))
+
+    def _remove_stale(self, file_path: str) -> None:
+        """Removes entries of file_path written for another version of the file. Entries for other configs are kept."""
+        path_hash, signature = self._hash(os.path.abspath(file_path)), self._get_signature(file_path)
+        for path in glob.glob(join(self.cache_dir, CACHE_FORMAT.format(path_hash, '*', '*'))):
+            if os.path.basename(path).split('_')[1] != signature:
+                os.remove(path)
+
+    @classmethod
+    def _get_signature(cls, file_path: str) -> str:
+        stat = os.stat(file_path)
+        return cls._hash({'size': stat.st_size, 'mtime': stat.st_mtime_ns})
+
+    @staticmethod
+    def _hash(obj) -> str:
+        return hashlib.sha1(json.dumps(obj, sort_keys=True, default=str).encode()).hexdigest()[:16]
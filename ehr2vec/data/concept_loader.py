@@ -1,23 +1,48 @@
 import os
+import datetime
 import glob
 import os
+import queue
 import random
-from datetime import datetime
-from typing import Iterator, Tuple
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join
+from typing import Callable, Iterator, List, Tuple, Union
 
 import dateutil
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pcsv
+import pyarrow.dataset as ds
 import pyarrow.parquet as pq
 
+from ehr2vec.data.cache import FormattedDataCache
+
 CONCEPT_FORMAT = 'concept.*'
 PATIENTS_INFO_FORMAT = 'patients_info.*'
+PARTITION_FORMAT = 'partition_{}'
+
+# Declared column types of the formatted data, undeclared columns are inferred
+DATETIME_FORMATS = ['%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S']
+CONCEPT_SCHEMA = {'TIMESTAMP': 'datetime', 'ADMISSION_ID': 'string', 'CONCEPT': 'category'}
+PATIENTS_INFO_SCHEMA = {'BIRTHDATE': 'datetime', 'DATE_OF_BIRTH': 'datetime', 'DEATHDATE': 'datetime', 'DATE_OF_DEATH': 'datetime'}
+DATETIME_SAMPLE_SIZE = 1000 # Values a datetime format is chosen on
+ARROW_TYPES = {'datetime': pa.timestamp('ns'), 'string': pa.string(), 'category': pa.dictionary(pa.int32(), pa.string())}
 random.seed(42)
 
 class ConceptLoader:
     """Load concepts and patient data"""
-    def __init__(self, concepts=['diagnose', 'medication'], data_dir: str = 'formatted_data'):
+    def __init__(self, concepts=['diagnose', 'medication'], data_dir: str = 'formatted_data', columns: list = None, num_workers: int = None,
+                 cache_dir: str = None):
         # First verify input types
         self._verify_input(concepts, data_dir)
+        self.columns = columns # Columns to read from concept files, all if None
+        self.num_workers = num_workers # Threads reading concept files concurrently, one per file if None
+        self.cache = FormattedDataCache(cache_dir) if cache_dir is not None else None # Parsed files are cached if given
 
         # Create paths to relevant files
         concepts_paths = glob.glob(os.path.join(data_dir, CONCEPT_FORMAT))
@@ -44,43 +69,190 @@ class ConceptLoader:
 
     def process(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
         """ Process concepts """
-        concepts = pd.concat([self.read_file(p) for p in self.concepts_paths], ignore_index=True).drop_duplicates()
-        concepts = concepts.sort_values('TIMESTAMP')
+        concepts = pd.concat(self._map_files(lambda p: self.read_file(p, self.columns)), ignore_index=True)
+        concepts = self._drop_duplicates_and_sort(self._handle_categorical_columns(concepts), ['TIMESTAMP'])
 
         """ Process patients info """
         patients_info = self.read_file(self.patients_info_path[0])#.drop_duplicates()
 
         return concepts, patients_info
 
-    def read_file(self, file_path: str) -> pd.DataFrame:
+    @staticmethod
+    def _drop_duplicates_and_sort(df: pd.DataFrame, by: List[str])-> pd.DataFrame:
+        """
+        Same result as df.drop_duplicates().sort_values(by, kind='stable') with missing values last.
+        Every column is factorized once. The codes are hashed per row and only rows sharing a hash are compared exactly.
+        The codes of the by columns form one integer sort key: sorted input is returned without sorting,
+        and since timsort merges sorted runs, concatenated frames that are sorted individually are merged.
+        """
+        row_hash = np.zeros(len(df), dtype=np.uint64)
+        sort_codes = {}
+        for col in df.columns:
+            codes, uniques = pd.factorize(df[col], sort=col in by)
+            row_hash = row_hash * np.uint64(1000003) ^ pd.util.hash_array(codes)
+            if col in by:
+                sort_codes[col] = (np.where(codes == -1, len(uniques), codes), len(uniques) + 1) # Missing values last
+        keep = np.ones(len(df), dtype=bool)
+        candidates = pd.Series(row_hash).duplicated(keep=False).to_numpy()
+        if candidates.any():
+            keep[candidates] = ~df[candidates].duplicated().to_numpy()
+
+        key = np.zeros(int(keep.sum()), dtype=np.int64)
+        for col in by:
+            codes, size = sort_codes[col]
+            key = key * size + codes[keep]
+        df = df[keep] if not keep.all() else df
+        if (key[1:] >= key[:-1]).all():
+            return df
+        return df.take(np.argsort(key, kind='stable'))
+
+    def _map_files(self, func: Callable[[str], pd.DataFrame]) -> List[pd.DataFrame]:
+        """Applies func to every concept file in a thread pool. Results keep the order of concepts_paths."""
+        num_workers = self.num_workers or len(self.concepts_paths)
+        if num_workers <= 1 or len(self.concepts_paths) <= 1:
+            return [func(p) for p in self.concepts_paths]
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            return list(executor.map(func, self.concepts_paths))
+
+    def read_file(self, file_path: str, columns: list = None) -> pd.DataFrame:
+        if self.cache is not None:
+            data = self._read_cached(file_path, columns)
+            return data if isinstance(data, pd.DataFrame) else data.to_pandas()
+        return self._parse_file(file_path, columns)
+
+    def _read_cached(self, file_path: str, columns: list = None) -> Union[pa.Table, pd.DataFrame]:
+        """Returns the parsed file from the cache. On a miss the file is parsed and cached, duplicates are dropped by the callers."""
+        return self.cache.get_or_create(file_path, self._get_cache_config(file_path, columns), lambda: self._parse_file(file_path, columns))
+
+    def _get_cache_config(self, file_path: str, columns: list = None) -> dict:
+        return {'columns': sorted(columns) if columns is not None else None, 'schema': self._get_schema(file_path), 'formats': DATETIME_FORMATS}
+
+    def _parse_file(self, file_path: str, columns: list = None) -> pd.DataFrame:
         _, file_ext = os.path.splitext(file_path)
         if file_ext == '.csv':
-            df = pd.read_csv(file_path)
+            df = self._read_csv(file_path, columns)
         elif file_ext == '.parquet':
-            df = pd.read_parquet(file_path)
+            df = ParquetDatasetReader(file_path, columns).read()
 
         if "patients_info" in file_path:
             assert len(df.PID) == len(df.PID.unique()), f"Found {len(df.PID) - len(df.PID.unique())} duplicate patient IDs in patients info file"
 
         return self._handle_datetime_columns(df)
 
+    @staticmethod
+    def _column_selector(columns: list = None):
+        """Returns a usecols callable for pd.read_csv which ignores requested columns that are missing in the file."""
+        if columns is None:
+            return None
+        columns = set(columns)
+        return lambda col: col in columns
+
+    @staticmethod
+    def _get_schema(file_path: str)-> dict:
+        return PATIENTS_INFO_SCHEMA if 'patients_info' in os.path.basename(file_path) else CONCEPT_SCHEMA
+
+    @classmethod
+    def _read_csv(cls, file_path: str, columns: list = None)-> pd.DataFrame:
+        """
+        Reads a csv file with the multithreaded pyarrow parser using the declared schema.
+        Falls back to pandas if the file does not fit the schema, e.g. timestamps with zone offsets.
+        """
+        try:
+            table = pcsv.read_csv(file_path,
+                                  read_options=pcsv.ReadOptions(use_threads=True),
+                                  convert_options=cls._get_convert_options(file_path, columns))
+            return cls._to_pandas(table)
+        except pa.ArrowInvalid:
+            return pd.read_csv(file_path, usecols=cls._column_selector(columns), dtype=cls._get_string_dtypes(file_path))
+
+    @classmethod
+    def _get_convert_options(cls, file_path: str, columns: list = None)-> pcsv.ConvertOptions:
+        """pyarrow csv options of the declared schema, requested columns missing in the file are ignored"""
+        header = pd.read_csv(file_path, nrows=0).columns
+        include_columns = [col for col in header if columns is None or col in columns]
+        column_types = {col: ARROW_TYPES[typ] for col, typ in cls._get_schema(file_path).items() if col in include_columns}
+        return pcsv.ConvertOptions(column_types=column_types, include_columns=include_columns,
+                                   timestamp_parsers=[pcsv.ISO8601, *DATETIME_FORMATS], strings_can_be_null=True)
+
+    @staticmethod
+    def _to_pandas(table: pa.Table)-> pd.DataFrame:
+        """Undeclared date columns are inferred as date32 by pyarrow, they are converted to datetime64 like the declared ones"""
+        schema = pa.schema([field.with_type(pa.timestamp('ns')) if pa.types.is_date(field.type) else field for field in table.schema])
+        return table.cast(schema).to_pandas()
+
+    @classmethod
+    def _get_string_dtypes(cls, file_path: str)-> dict:
+        """Pandas dtypes of the declared string columns, categories are set after concatenation."""
+        return {col: str for col, typ in cls._get_schema(file_path).items() if typ in ['string', 'category']}
+
+    @staticmethod
+    def _handle_categorical_columns(df: pd.DataFrame)-> pd.DataFrame:
+        """
+        Converts the declared categorical concept columns, concatenating frames with different categories gives object columns.
+        Categories are the sorted values in use, as astype('category') gives, whether the file was read from csv, parquet or the cache.
+        """
+        for col, typ in CONCEPT_SCHEMA.items():
+            if typ != 'category' or col not in df.columns:
+                continue
+            if not isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = df[col].astype('category')
+            else:
+                values = df[col].cat.remove_unused_categories()
+                df[col] = values.cat.reorder_categories(values.cat.categories.sort_values())
+        return df
+
     @classmethod
-    def _handle_datetime_columns(cls, df: pd.DataFrame)-> pd.DataFrame:
-        """Try to convert all potential datetime columns to datetime objects"""
-        for col in cls._detect_date_columns(df):
-            df[col] = pd.to_datetime(df[col], errors='coerce')
-            df[col] = df[col].dt.tz_localize(None)
+    def _handle_datetime_columns(cls, df: pd.DataFrame, formats: dict = None)-> pd.DataFrame:
+        """
+        Try to convert all potential datetime columns to datetime objects.
+        formats maps the datetime columns to their format, e.g. chosen once per file with _get_datetime_formats. Detected on df if None.
+        """
+        for col in df.columns:
+            if isinstance(df[col].dtype, pd.DatetimeTZDtype):
+                df[col] = df[col].dt.tz_localize(None)
+        formats = cls._get_datetime_formats(df) if formats is None else formats
+        for col, date_format in formats.items():
+            if col in df.columns and not pd.api.types.is_datetime64_any_dtype(df[col]):
+                df[col] = cls._to_datetime(df[col], date_format)
+                df[col] = df[col].dt.tz_localize(None)
         return df
 
+    @classmethod
+    def _get_datetime_formats(cls, df: pd.DataFrame)-> dict:
+        """The first declared format that parses a sample of each potential datetime column, None if none of them does"""
+        return {col: cls._find_datetime_format(df[col]) for col in cls._detect_date_columns(df)}
+
+    @staticmethod
+    def _find_datetime_format(series: pd.Series)-> str:
+        sample = series.dropna().iloc[:DATETIME_SAMPLE_SIZE]
+        for date_format in DATETIME_FORMATS:
+            try:
+                pd.to_datetime(sample, format=date_format)
+                return date_format
+            except (ValueError, TypeError):
+                continue
+        return None
+
+    @staticmethod
+    def _to_datetime(series: pd.Series, date_format: str = None)-> pd.Series:
+        """Parses with date_format, format inference per element is only used if there is none or it does not fit every entry"""
+        if date_format is not None:
+            try:
+                return pd.to_datetime(series, format=date_format)
+            except (ValueError, TypeError):
+                pass
+        return pd.to_datetime(series, errors='coerce')
+
     @staticmethod
     def _detect_date_columns(df: pd.DataFrame)-> list:
         for col in df.columns:
-            if isinstance(df[col], datetime):
+            if pd.api.types.is_datetime64_any_dtype(df[col]):
                 continue
             if 'TIME' in col.upper() or 'DATE' in col.upper():
                 try:
                     first_non_na = df.loc[df[col].notna(), col].iloc[0]
-                    dateutil.parser.parse(first_non_na)
+                    if not isinstance(first_non_na, datetime.date): # dates read by pyarrow
+                        dateutil.parser.parse(first_non_na)
                     yield col
                 except:
                     continue
@@ -88,12 +260,17 @@ class ConceptLoader:
 class ConceptLoaderLarge(ConceptLoader):
     """Load concepts and patient data in chunks"""
     def __init__(self, concepts: list = ['diagnosis', 'medication'], data_dir: str = 'formatted_data', **kwargs):
-        super().__init__(concepts, data_dir)
+        super().__init__(concepts, data_dir, kwargs.get('columns', None), kwargs.get('num_workers', None), kwargs.get('cache_dir', None))
 
         self.chunksize = kwargs.get('chunksize', 10000)     # Concepts chunk size
         self.batch_size = kwargs.get('batch_size', 100000)  # Patients per batch
+        self.partition_dir = kwargs.get('partition_dir', None)  # If given, concept files are read once and partitioned by patient batch
+        self.partition_buffer_size = kwargs.get('partition_buffer_size', 10 * self.chunksize)  # Rows buffered over all partitions of a file
+        self.prefetch = kwargs.get('prefetch', 0)  # Batches read ahead in a background thread, 0 disables prefetching
 
     def __call__(self) -> Iterator[Tuple[pd.DataFrame, pd.DataFrame]]:
+        if self.prefetch:
+            return BatchPrefetcher(self.process(), self.prefetch)
         return self.process()
     
     def process(self) -> Iterator[Tuple[pd.DataFrame, pd.DataFrame]]:
@@ -101,29 +278,123 @@ class ConceptLoaderLarge(ConceptLoader):
         patient_ids = patients_info['PID'].unique()
         random.seed(42)
         random.shuffle(patient_ids)
+        patient_batches = list(self.get_patient_batch(patient_ids, self.batch_size))
 
-        for chunk_ids in self.get_patient_batch(patient_ids, self.batch_size):
-            concepts_chunk = pd.concat([self.read_file_chunk(p, chunk_ids) for p in self.concepts_paths], ignore_index=True).drop_duplicates()
-            concepts_chunk = concepts_chunk.sort_values(by=['PID','TIMESTAMP'])
+        if self.partition_dir is not None:
+            self.partition_concepts(patient_batches)
+
+        for batch_id, chunk_ids in enumerate(patient_batches):
+            if self.partition_dir is not None:
+                concepts_chunk = self.read_partition(batch_id)
+            else:
+                concepts_chunk = pd.concat(self._map_files(lambda p: self.read_file_chunk(p, chunk_ids)), ignore_index=True)
+            concepts_chunk = self._drop_duplicates_and_sort(self._handle_categorical_columns(concepts_chunk), ['PID', 'TIMESTAMP'])
             patients_info_chunk = patients_info[patients_info['PID'].isin(chunk_ids)]
             yield concepts_chunk, patients_info_chunk
 
+    def partition_concepts(self, patient_batches: List[list]) -> None:
+        """
+        Reads every concept file once and writes its rows to one parquet partition per patient batch.
+        Each file is written to a single parquet file per partition, in row groups of roughly chunksize rows.
+        Rows of patients not present in patients info are dropped, as in read_file_chunk.
+        """
+        self._clear_partitions()
+        pids = np.concatenate(patient_batches) if patient_batches else np.array([], dtype=object)
+        partitions = np.repeat(np.arange(len(patient_batches)), [len(batch) for batch in patient_batches])
+        for batch_id in range(len(patient_batches)):
+            os.makedirs(join(self.partition_dir, PARTITION_FORMAT.format(batch_id)), exist_ok=True)
+
+        file_ids = {file_path: file_id for file_id, file_path in enumerate(self.concepts_paths)}
+        # Files write to their own partition files, so they are partitioned concurrently
+        self._map_files(lambda p: self._partition_file(file_ids[p], p, pids, partitions, len(patient_batches)))
+
+    def _partition_file(self, file_id: int, file_path: str, pids: np.ndarray, partitions: np.ndarray, num_partitions: int) -> None:
+        """partitions[i] is the patient batch of pids[i]"""
+        # pandas builds the lookup of an index lazily and not thread safe, so every file builds its own
+        pid_index = pd.Index(pids)
+        writer = PartitionWriter(self.partition_dir, file_id, self.chunksize, self.partition_buffer_size)
+        empty = None
+        try:
+            for chunk in self._get_iterator(file_path, self.chunksize, self.columns):
+                positions = pid_index.get_indexer(chunk['PID'])
+                known = positions >= 0
+                for batch_id, part in chunk[known].groupby(partitions[positions[known]], sort=False):
+                    writer.append(batch_id, part)
+                empty = chunk.iloc[:0]
+            writer.flush_all()
+            # Every partition gets at least one (possibly empty) file per concept file to keep the columns
+            if empty is not None:
+                for batch_id in range(num_partitions):
+                    if batch_id not in writer.writers:
+                        writer.append(batch_id, empty)
+                        writer.flush(batch_id)
+        finally:
+            writer.close()
+
+    def read_partition(self, batch_id: int) -> pd.DataFrame:
+        """Reads the partition of a patient batch, file by file in the order of concepts_paths."""
+        partition_dir = join(self.partition_dir, PARTITION_FORMAT.format(batch_id))
+        files = {}
+        for path in glob.glob(join(partition_dir, '*.parquet')):
+            file_id, part_id = map(int, os.path.splitext(os.path.basename(path))[0].split('_'))
+            files.setdefault(file_id, []).append((part_id, path))
+        concepts = []
+        for file_id in sorted(files):
+            parts = [pd.read_parquet(path) for _, path in sorted(files[file_id])]
+            concepts.append(self._handle_datetime_columns(pd.concat(parts, ignore_index=True)))
+        return pd.concat(concepts, ignore_index=True)
+
+    def _clear_partitions(self) -> None:
+        """Removes partitions of a previous run. Only partition directories are deleted."""
+        os.makedirs(self.partition_dir, exist_ok=True)
+        for path in glob.glob(join(self.partition_dir, PARTITION_FORMAT.format('*'))):
+            shutil.rmtree(path)
+
     def read_file_chunk(self, file_path: str, chunk_ids: list = None)-> pd.DataFrame:
+        if self.cache is not None:
+            table = self._read_cached_chunks(file_path)
+            if table is not None:
+                return self._filter_patients(table, chunk_ids)
+
+        if os.path.splitext(file_path)[1] == '.parquet':
+            # Filter and projection are pushed down to the parquet scan
+            chunks_df = ParquetDatasetReader(file_path, self.columns).read(chunk_ids)
+            return self._handle_datetime_columns(chunks_df)
+
         chunks = []
-        for chunk in self._get_iterator(file_path, self.chunksize):
+        for chunk in self._get_iterator(file_path, self.chunksize, self.columns):
             filtered_chunk = chunk[chunk['PID'].isin(chunk_ids)]  # assuming 'PID' is the patient ID column in this file too
             chunks.append(filtered_chunk)
         chunks_df = pd.concat(chunks, ignore_index=True)
 
         return self._handle_datetime_columns(chunks_df)
     
+    def _read_cached_chunks(self, file_path: str) -> pa.Table:
+        """
+        Returns the parsed file from the cache. On a miss the file is parsed chunk by chunk and streamed into the cache,
+        so it is never fully in memory. Duplicates are dropped per patient batch in process. None if the file can not be cached.
+        """
+        create_chunks = lambda: (self._handle_datetime_columns(chunk) for chunk in self._get_iterator(file_path, self.chunksize, self.columns))
+        return self.cache.get_or_create_from_chunks(file_path, self._get_cache_config(file_path, self.columns), create_chunks)
+
     @staticmethod
-    def _get_iterator(file_path: str, chunksize: int):
+    def _filter_patients(data: Union[pa.Table, pd.DataFrame], pids: list)-> pd.DataFrame:
+        """Selects the rows of pids. Cached tables are filtered before conversion, so only these rows are materialised."""
+        if isinstance(data, pa.Table):
+            try:
+                value_set = pa.array(pids).cast(data.schema.field('PID').type)
+                return data.filter(pc.is_in(data['PID'], value_set=value_set)).to_pandas()
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+                data = data.to_pandas()
+        return data[data['PID'].isin(pids)].reset_index(drop=True)
+
+    @classmethod
+    def _get_iterator(cls, file_path: str, chunksize: int, columns: list = None):
         _, file_ext = os.path.splitext(file_path)
         if file_ext == '.csv':
-            return pd.read_csv(file_path, chunksize=chunksize)
-        elif file_ext == 'parquet':
-            return ParquetIterator(file_path, chunksize)
+            return CsvIterator(file_path, chunksize, columns)
+        elif file_ext == '.parquet':
+            return ParquetIterator(file_path, chunksize, columns)
         else:
             raise ValueError(f'File path must be .csv or .parquet, was {file_ext}')
     
@@ -132,10 +403,131 @@ class ConceptLoaderLarge(ConceptLoader):
         for i in range(0, len(patient_ids), batch_size):
             yield patient_ids[i:i + batch_size]
 
+class PartitionWriter:
+    """
+    Writes the rows of one concept file to the partitions of the patient batches, one parquet file per partition
+    with a row group per flush. A partition is flushed when it has row_group_size rows buffered, and the largest
+    buffers are flushed whenever more than max_rows rows are buffered over all partitions.
+    Rows whose columns can not be cast to the schema of the open file, e.g. a column that was all null so far, start a new file.
+    """
+    def __init__(self, partition_dir: str, file_id: int, row_group_size: int, max_rows: int):
+        self.partition_dir = partition_dir
+        self.file_id = file_id
+        self.row_group_size = row_group_size
+        self.max_rows = max_rows
+        self.buffers, self.buffered = {}, {} # frames and rows buffered per partition
+        self.writers, self.counters = {}, {} # open parquet writer and number of files per partition
+
+    def append(self, batch_id: int, df: pd.DataFrame) -> None:
+        self.buffers.setdefault(batch_id, []).append(df)
+        self.buffered[batch_id] = self.buffered.get(batch_id, 0) + len(df)
+        if self.buffered[batch_id] >= self.row_group_size:
+            self.flush(batch_id)
+        while sum(self.buffered.values()) > self.max_rows:
+            self.flush(max(self.buffered, key=self.buffered.get))
+
+    def flush(self, batch_id: int) -> None:
+        """Writes the buffered rows of a partition as one row group"""
+        del self.buffered[batch_id]
+        tables = []
+        for df in self.buffers.pop(batch_id):
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            table = table.cast(FormattedDataCache._decode_dictionaries(table.schema))
+            cast = self._cast(batch_id, table)
+            if cast is None:
+                self._write(batch_id, tables)
+                tables, cast = [], table
+                self._open(batch_id, table.schema)
+            tables.append(cast)
+        self._write(batch_id, tables)
+
+    def flush_all(self) -> None:
+        for batch_id in list(self.buffers):
+            self.flush(batch_id)
+
+    def close(self) -> None:
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+
+    def _cast(self, batch_id: int, table: pa.Table) -> pa.Table:
+        """The table in the schema of the open file of the partition, None if there is none or the table does not fit"""
+        writer = self.writers.get(batch_id)
+        if writer is None:
+            return None
+        try:
+            return table.select(writer.schema.names).cast(writer.schema)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError, KeyError):
+            return None
+
+    def _open(self, batch_id: int, schema: pa.Schema) -> None:
+        if batch_id in self.writers:
+            self.writers[batch_id].close()
+        counter = self.counters.get(batch_id, 0)
+        path = join(self.partition_dir, PARTITION_FORMAT.format(batch_id), f'{self.file_id}_{counter}.parquet')
+        self.writers[batch_id] = pq.ParquetWriter(path, schema)
+        self.counters[batch_id] = counter + 1
+
+    def _write(self, batch_id: int, tables: List[pa.Table]) -> None:
+        if tables:
+            self.writers[batch_id].write_table(pa.concat_tables(tables))
+
+class CsvIterator:
+    """
+    Reads a csv file in chunks of chunksize rows with the streaming pyarrow reader and the declared schema of ConceptLoader.
+    Undeclared datetime columns are parsed with a format chosen once on the first chunk.
+    If the file does not fit the schema, e.g. timestamps with zone offsets, the remaining rows are read with pandas.
+    """
+    def __init__(self, filename: str, chunksize: int = 10000, columns: list = None):
+        self.filename = filename
+        self.chunksize = chunksize
+        self.columns = columns
+        self.formats = None # Datetime formats of the file, chosen on the first chunk
+
+    def __iter__(self) -> Iterator[pd.DataFrame]:
+        read_rows = 0
+        try:
+            for chunk in self._read_arrow():
+                read_rows += len(chunk)
+                yield self._handle_datetime_columns(chunk)
+        except pa.ArrowInvalid:
+            self.formats = None # Declared datetime columns are strings now, formats are chosen again on the first pandas chunk
+            for chunk in self._read_pandas(skip_rows=read_rows):
+                yield self._handle_datetime_columns(chunk)
+
+    def _read_arrow(self) -> Iterator[pd.DataFrame]:
+        """Record batches of the reader are regrouped into chunks of chunksize rows"""
+        reader = pcsv.open_csv(self.filename, read_options=pcsv.ReadOptions(use_threads=True),
+                               convert_options=ConceptLoader._get_convert_options(self.filename, self.columns))
+        pending = pa.Table.from_batches([], schema=reader.schema)
+        for batch in reader:
+            pending = pa.concat_tables([pending, pa.Table.from_batches([batch])])
+            while pending.num_rows >= self.chunksize:
+                yield ConceptLoader._to_pandas(pending.slice(0, self.chunksize))
+                pending = pending.slice(self.chunksize)
+        if pending.num_rows > 0:
+            yield ConceptLoader._to_pandas(pending)
+
+    def _read_pandas(self, skip_rows: int = 0) -> Iterator[pd.DataFrame]:
+        """Rows after the first skip_rows, which were already read with pyarrow"""
+        return pd.read_csv(self.filename, chunksize=self.chunksize, skiprows=range(1, skip_rows + 1),
+                           usecols=ConceptLoader._column_selector(self.columns), dtype=ConceptLoader._get_string_dtypes(self.filename))
+
+    def _handle_datetime_columns(self, chunk: pd.DataFrame) -> pd.DataFrame:
+        """Also drops the categories of the reader's dictionary that are not in the chunk"""
+        for col in chunk.columns:
+            if isinstance(chunk[col].dtype, pd.CategoricalDtype):
+                chunk[col] = chunk[col].cat.remove_unused_categories()
+        if self.formats is None:
+            self.formats = ConceptLoader._get_datetime_formats(chunk)
+        return ConceptLoader._handle_datetime_columns(chunk, self.formats)
+
 class ParquetIterator:
-    def __init__(self, filename, batch_size=100000):
+    def __init__(self, filename, batch_size=100000, columns: list = None):
         parquet_file = pq.ParquetFile(filename)
-        self.batch_iterator = parquet_file.iter_batches(batch_size=batch_size)
+        if columns is not None:
+            columns = [col for col in parquet_file.schema_arrow.names if col in columns]
+        self.batch_iterator = parquet_file.iter_batches(batch_size=batch_size, columns=columns)
 
     def __iter__(self):
         return self
@@ -145,4 +537,98 @@ class ParquetIterator:
             batch = next(self.batch_iterator)
             return batch.to_pandas()
         except StopIteration:
-            raise StopIteration
\ No newline at end of file
+            raise StopIteration
+
+class ParquetDatasetReader:
+    """
+    Reads a parquet file through pyarrow.dataset. Column projection and the PID filter are pushed down to the scan,
+    and row groups whose PID min/max statistics do not overlap the requested PIDs are skipped without being decoded.
+    """
+    def __init__(self, filename: str, columns: list = None):
+        self.dataset = ds.dataset(filename, format='parquet')
+        if columns is not None:
+            columns = [col for col in self.dataset.schema.names if col in columns]
+        self.columns = columns
+
+    def read(self, pids: list = None) -> pd.DataFrame:
+        return self.dataset.to_table(columns=self.columns, filter=self.get_pid_filter(pids)).to_pandas()
+
+    def get_pid_filter(self, pids: list = None) -> ds.Expression:
+        """The range predicate lets the scanner prune row groups by statistics, isin selects the exact PIDs."""
+        if pids is None:
+            return None
+        pids = pa.array(pids).cast(self.dataset.schema.field('PID').type)
+        if len(pids) == 0:
+            return ds.scalar(False)
+        bounds = pc.min_max(pids)
+        pid = ds.field('PID')
+        return (pid >= bounds['min']) & (pid <= bounds['max']) & pid.isin(pids)
+
+class BatchPrefetcher:
+    """
+    Runs a batch iterator in a background thread and keeps up to `size` batches ready in a bounded queue.
+    Exceptions raised by the producer are re-raised in the consumer.
+    metrics() reports the queue depth seen by the consumer and the time both sides spent waiting.
+    """
+    _DONE = object()
+
+    def __init__(self, iterator: Iterator, size: int = 2):
+        self.queue = queue.Queue(maxsize=size)
+        self.stop_event = threading.Event()
+        self.depths = []
+        self.consumer_wait = 0.
+        self.producer_wait = 0.
+        self.thread = threading.Thread(target=self._produce, args=(iterator,), daemon=True)
+        self.thread.start()
+
+    def _produce(self, iterator: Iterator) -> None:
+        try:
+            for item in iterator:
+                if not self._put((item, None)):
+                    return
+        except Exception as e:
+            self._put((self._DONE, e))
+            return
+        self._put((self._DONE, None))
+
+    def _put(self, item: tuple) -> bool:
+        """Blocks while the queue is full, returns False if the consumer was closed."""
+        start = time.perf_counter()
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                self.producer_wait += time.perf_counter() - start
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self.depths.append(self.queue.qsize())
+        start = time.perf_counter()
+        item, error = self.queue.get()
+        self.consumer_wait += time.perf_counter() - start
+        if item is self._DONE:
+            self.depths.pop()
+            self.queue.put((self._DONE, error)) # Keep raising on further calls
+            if error is not None:
+                raise error
+            raise StopIteration
+        return item
+
+    def close(self) -> None:
+        """Stops the producer, e.g. when the consumer does not exhaust the iterator."""
+        self.stop_event.set()
+        self.thread.join()
+
+    def metrics(self) -> dict:
+        return {
+            'batches': len(self.depths),
+            'mean_queue_depth': float(np.mean(self.depths)) if self.depths else 0.,
+            'empty_queue_fraction': float(np.mean(np.array(self.depths) == 0)) if self.depths else 0.,
+            'consumer_wait_time': self.consumer_wait,
+            'producer_wait_time': self.producer_wait,
+        }
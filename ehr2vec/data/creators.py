@@ -1,9 +1,10 @@
-import itertools
+import numpy as np
 import pandas as pd
 from ehr2vec.data.utils import Utilities
 
 
 class BaseCreator:
+    columns = [] # concept columns read by the creator
     def __init__(self, config: dict):
         self.config = config
 
@@ -26,11 +27,13 @@ class BaseCreator:
 
 class AgeCreator(BaseCreator):
     feature = id = 'age'
+    columns = ['PID', 'TIMESTAMP']
     def create(self, concepts: pd.DataFrame, patients_info: pd.DataFrame)-> pd.DataFrame:
         patients_info = self._rename_birthdate_column(patients_info)
-        birthdates = pd.Series(patients_info['BIRTHDATE'].values, index=patients_info['PID']).to_dict()
+        # Join birthdates on PID, missing patients get NaT
+        birthdates = pd.Series(patients_info['BIRTHDATE'].to_numpy(), index=patients_info['PID']).reindex(concepts['PID']).to_numpy()
         # Calculate approximate age
-        ages = (concepts['TIMESTAMP'] - concepts['PID'].map(birthdates)).dt.days / 365.25
+        ages = (concepts['TIMESTAMP'] - birthdates).dt.days / 365.25
         if self.config.age.get('round'):
             ages = ages.round(self.config.age.get('round'))
 
@@ -39,6 +42,7 @@ class AgeCreator(BaseCreator):
 
 class AbsposCreator(BaseCreator):
     feature = id = 'abspos'
+    columns = ['TIMESTAMP']
     def create(self, concepts: pd.DataFrame, patients_info: pd.DataFrame)-> pd.DataFrame:
         abspos = Utilities.get_abspos_from_origin_point(concepts['TIMESTAMP'], self.config.abspos)
         concepts['ABSPOS'] = abspos
@@ -46,6 +50,7 @@ class AbsposCreator(BaseCreator):
 
 class SegmentCreator(BaseCreator):
     feature = id = 'segment'
+    columns = ['PID', 'ADMISSION_ID', 'SEGMENT']
     def create(self, concepts: pd.DataFrame, patients_info: pd.DataFrame)-> pd.DataFrame:
         if 'ADMISSION_ID' in concepts.columns:
             seg_col = 'ADMISSION_ID'
@@ -54,21 +59,40 @@ class SegmentCreator(BaseCreator):
         else:
             raise KeyError('No segment column found in concepts')
     
-        segments = concepts.groupby('PID')[seg_col].transform(lambda x: pd.factorize(x)[0]+1)
-        
-        concepts['SEGMENT'] = segments
+        concepts['SEGMENT'] = self.number_segments(concepts['PID'], concepts[seg_col])
         return concepts
 
+    @staticmethod
+    def number_segments(pids: pd.Series, segments: pd.Series)-> pd.Series:
+        """
+        Numbers the segments of every patient 1, 2, ... in order of appearance and missing segments 0, as
+        groupby('PID').transform(lambda x: pd.factorize(x)[0]+1) without calling python per patient.
+        """
+        frame = pd.DataFrame({'PID': pids.to_numpy(), 'SEGMENT': segments.to_numpy()})
+        pairs = frame.groupby(['PID', 'SEGMENT'], sort=False, dropna=False).ngroup().to_numpy()
+        first = ~pd.Series(pairs).duplicated().to_numpy()
+        new_segment = pd.Series(first & segments.notna().to_numpy())
+        # Running count of new segments per patient, read at the first row of each (patient, segment) pair
+        counts = new_segment.groupby(frame['PID']).cumsum().to_numpy()
+        pair_numbers = np.empty(pairs.max() + 1 if len(pairs) else 0, dtype=counts.dtype)
+        pair_numbers[pairs[first]] = counts[first]
+        numbers = np.where(segments.notna().to_numpy(), pair_numbers[pairs], 0)
+        if pids.isna().any(): # Rows without patient are not grouped
+            numbers = np.where(pids.notna().to_numpy(), numbers, np.nan)
+        return pd.Series(numbers, index=segments.index)
+
 class BackgroundCreator(BaseCreator):
     id = 'background'
     prepend_token = "BG_"
     def create(self, concepts: pd.DataFrame, patients_info: pd.DataFrame)-> pd.DataFrame:
         self._rename_birthdate_column(patients_info)
         # Create background concepts
+        n_background = len(self.config.background)
         background = {
-            'PID': patients_info['PID'].tolist() * len(self.config.background),
-            'CONCEPT': itertools.chain.from_iterable(
-                [(self.prepend_token + col + '_' +patients_info[col].astype(str)).tolist() for col in self.config.background])
+            'PID': np.tile(patients_info['PID'].to_numpy(), n_background),
+            'CONCEPT': np.concatenate(
+                [(self.prepend_token + col + '_' +patients_info[col].astype(str)).to_numpy(dtype=object) for col in self.config.background]
+                ) if n_background else np.array([], dtype=object)
         }
 
         if 'segment' in self.config:
@@ -79,7 +103,7 @@ class BackgroundCreator(BaseCreator):
 
         if 'abspos' in self.config:
             abspos = Utilities.get_abspos_from_origin_point(patients_info['BIRTHDATE'], self.config.abspos)
-            background['ABSPOS'] = abspos.to_list() * len(self.config.background)
+            background['ABSPOS'] = np.tile(abspos.to_numpy(), n_background)
 
         # Prepend background to concepts
         background = pd.DataFrame(background)
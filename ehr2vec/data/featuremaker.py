@@ -1,5 +1,7 @@
+import numpy as np
 import pandas as pd
 from typing import Tuple
+from ehr2vec.common.ragged import RaggedFeatures
 from ehr2vec.data.creators import BaseCreator
 
 
@@ -19,14 +21,25 @@ class FeatureMaker:
         self.pipeline = self.create_pipeline()
         
 
-    def __call__(self, concepts: pd.DataFrame, patients_info: pd.DataFrame) -> Tuple[dict, list]:
+    def __call__(self, concepts: pd.DataFrame, patients_info: pd.DataFrame, ragged: bool = False) -> Tuple[dict, list]:
+        """Returns features as a dict of lists, or as RaggedFeatures if ragged is True, and the pids."""
         for creator in self.pipeline:
             concepts = creator(concepts, patients_info)
+        if self.pipeline: # Creators leave CONCEPT as it is, so it is cast once
             concepts['CONCEPT'] = concepts['CONCEPT'].astype(str)
+        if ragged:
+            return self.create_ragged_features(concepts)
         features, pids = self.create_features(concepts)
 
         return features, pids
     
+    def required_columns(self) -> list:
+        """Return the concept columns needed by the pipeline, used for column projection when loading."""
+        columns = ['PID', 'CONCEPT', 'TIMESTAMP']
+        for creator in self.pipeline:
+            columns.extend(col for col in creator.columns if col not in columns)
+        return columns
+
     def create_pipeline(self) -> list:
         """Create the pipeline of feature creators."""
         # Pipeline creation
@@ -49,12 +62,24 @@ class FeatureMaker:
         return pipeline
 
     def create_features(self, concepts: pd.DataFrame) -> Tuple[dict, list]:
-        # Add standard info
-        pids = []
-        for pid, patient in concepts.groupby('PID', sort=False):
-            pids.append(pid)
-            for feature, value in self.features.items():
-                value.append(patient[feature.upper()].tolist())
+        """Dict of lists layout, {feature: [patient_values, ...]}, appended to self.features"""
+        ragged, pids = self.create_ragged_features(concepts)
+        for feature, values in ragged.to_lists().items():
+            self.features[feature].extend(values)
 
         return self.features, pids
 
+    def create_ragged_features(self, concepts: pd.DataFrame) -> Tuple[RaggedFeatures, list]:
+        """
+        Groups concepts by patient without a python loop, same grouping as concepts.groupby('PID', sort=False):
+        patients in order of first appearance, rows in frame order and missing PIDs dropped.
+        """
+        codes, pids = pd.factorize(concepts['PID'])
+        rows = np.flatnonzero(codes >= 0)
+        order = rows[np.argsort(codes[rows], kind='stable')]
+        offsets = np.zeros(len(pids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(codes[rows], minlength=len(pids)), out=offsets[1:])
+        values = {feature: concepts[feature.upper()].to_numpy()[order] for feature in self.features}
+
+        return RaggedFeatures(values, offsets), pids.tolist()
+
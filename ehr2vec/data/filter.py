@@ -1,13 +1,16 @@
 import torch
 import random
+import numpy as np
 import logging
 import pandas as pd
 from os.path import join
-from typing import List, Tuple
+from typing import List, Tuple, Union
 
 from ehr2vec.data.utils import Utilities
 from ehr2vec.data_fixes.exclude import Excluder
+from ehr2vec.common.ragged import flatten, segment_sum
 from ehr2vec.common.utils import Data, iter_patients
+from ehr2vec.common.vocabulary import VocabularyIndex
 
 logger = logging.getLogger(__name__)  # Get the logger for this module
 
@@ -22,7 +25,7 @@ class CodeTypeFilter:
     def filter(self, data: Data) -> Data:
         """Filter code types, e.g. keep only diagnoses. Remove patients with not sufficient data left."""
         keep_codes = self._combine_to_tuple(self.SPECIAL_CODES, self.cfg.data.code_types)
-        keep_tokens = set([token for code, token in data.vocabulary.items() if self.utils.code_starts_with(code, keep_codes)])
+        keep_tokens = VocabularyIndex.get(data.vocabulary).prefix_mask(keep_codes)
         logger.info(f"Keep only codes starting with: {keep_codes}")
         for patient_index, patient in enumerate(iter_patients(data.features)):
             self._filter_patient(data, patient, keep_tokens, patient_index)
@@ -31,18 +34,16 @@ class CodeTypeFilter:
         return data
 
     @staticmethod
-    def _filter_patient(data: Data, patient: dict, keep_tokens: set, patient_index: int) -> None:
-        """Filter patient in place by removing tokens that are not in keep_tokens"""
-        concepts = patient['concept']
-        keep_entries = {i: token for i, token in enumerate(concepts) if token in keep_tokens}
+    def _filter_patient(data: Data, patient: dict, keep_tokens: np.ndarray, patient_index: int) -> None:
+        """Filter patient in place by removing tokens that are not in keep_tokens, a mask over the token ids"""
+        keep_entries = np.flatnonzero(VocabularyIndex.lookup(keep_tokens, patient['concept'])).tolist()
         for k, v in patient.items():
             filtered_list = [v[i] for i in keep_entries]
             data.features[k][patient_index] = filtered_list
 
-    def _filter_vocabulary(self, vocabulary: dict, keep_tokens: set) -> dict:
+    def _filter_vocabulary(self, vocabulary: dict, keep_tokens: np.ndarray) -> dict:
         """Filter vocabulary in place by removing tokens that are not in keep_tokens"""
-        keep_codes = set([code for code, token in vocabulary.items() if token in keep_tokens])
-        filtered_vocabulary = {code: token for code, token in vocabulary.items() if code in keep_codes}
+        filtered_vocabulary = {code: token for code, token in vocabulary.items() if keep_tokens[token]}
         # Re-index vocabulary to be sequential
         filtered_vocabulary = {code: i for i, code in enumerate(filtered_vocabulary)}
 
@@ -65,24 +66,22 @@ class PatientFilter:
         pretrain_pids = set()
         for mode in ['train', 'val']:
             pretrain_pids.update(set(torch.load(join(self.cfg.paths.pretrain_model_path, f'pids_{mode}.pt'))))
-        kept_indices = [i for i, pid in enumerate(data.pids) if pid not in pretrain_pids]
+        kept_indices = np.flatnonzero(~pd.Series(data.pids, dtype=object).isin(pretrain_pids).to_numpy())
         return self.select_entries(data, kept_indices)
 
     def filter_outcome_before_censor(self, data: Data) -> Data:
         """Filter patients with outcome before censoring and missing censoring when outcome present."""
-        kept_indices = []
-        for i, (outcome, censor) in enumerate(zip(data.outcomes, data.censor_outcomes)):
-            if pd.isna(censor):
-                if pd.isna(outcome):
-                    kept_indices.append(i)
-            elif pd.isna(outcome) or outcome >= (censor + self.cfg.outcome.n_hours):
-                kept_indices.append(i)
+        outcomes, censors = self.utils.to_float_array(data.outcomes), self.utils.to_float_array(data.censor_outcomes)
+        no_outcome = np.isnan(outcomes)
+        with np.errstate(invalid='ignore'):
+            outcome_after_censor = outcomes >= (censors + self.cfg.outcome.n_hours)
+        kept_indices = np.flatnonzero(np.where(np.isnan(censors), no_outcome, no_outcome | outcome_after_censor))
         return self.select_entries(data, kept_indices)
     
     def select_censored(self, data: Data) -> Data:
         """Select only censored patients. This is only relevant for the fine-tuning  data. 
         E.g. for pregnancy complications select only pregnant women."""
-        kept_indices = [i for i, censor in enumerate(data.censor_outcomes) if pd.notna(censor)]
+        kept_indices = np.flatnonzero(~np.isnan(self.utils.to_float_array(data.censor_outcomes)))
         return self.select_entries(data, kept_indices)
 
     def exclude_short_sequences(self, data: Data) -> Data:
@@ -96,20 +95,19 @@ class PatientFilter:
         """
         We retrieve the age of each patient at censor date and check whether it's within the range.
         """
-        kept_indices = []
         min_age = self.cfg.data.get('min_age', 0)
         max_age = self.cfg.data.get('max_age', 120)
 
         # Calculate ages at censor date for all patients
         ages_at_censor_date = self.utils.calculate_ages_at_censor_date(data)
-        kept_indices = [i for i, age in enumerate(ages_at_censor_date) 
-                if min_age <= age <= max_age]
+        kept_indices = np.flatnonzero((min_age <= ages_at_censor_date) & (ages_at_censor_date <= max_age))
         return self.select_entries(data, kept_indices)
 
     def select_by_gender(self, data: Data) -> Data:
         """Select only patients of a certain gender"""
         gender_token = self.utils.get_gender_token(data.vocabulary, self.cfg.data.gender)
-        kept_indices = [i for i, concepts in enumerate(data.features['concept']) if gender_token in set(concepts)]
+        concepts, offsets = flatten(data.features['concept'])
+        kept_indices = np.flatnonzero(segment_sum(concepts == gender_token, offsets) > 0)
         return self.select_entries(data, kept_indices)
     
     def select_random_subset(self, data, num_patients, seed=42) -> Data:
@@ -119,16 +117,15 @@ class PatientFilter:
         indices = list(range(len(data.pids)))
         random.seed(seed)
         random.shuffle(indices)
-        indices = indices[:num_patients]
-        return self.select_entries(data, indices)
+        return self.select_entries(data, sorted(indices[:num_patients])) # Selected patients stay in data order
 
     @staticmethod
-    def select_entries(data:Data, indices:List) -> Data:
+    def select_entries(data:Data, indices:Union[List, np.ndarray]) -> Data:
         """
-        Select entries based on indices. 
+        Select entries based on indices, in the order of the indices.
         Optionally for outcomes and censor outcomes, if present returns dict of results.
         """
-        indices = set(indices)
+        indices = np.asarray(indices, dtype=np.int64).tolist()
         data.features = {k: [v[i] for i in indices] for k, v in data.features.items()}
         data.pids = [data.pids[i] for i in indices]
         if data.outcomes is not None:
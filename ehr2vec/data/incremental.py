@@ -0,0 +1,205 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+from collections import defaultdict
+from os.path import join
+from typing import Callable, Dict, Iterator, List, Tuple
+
+import numpy as np
+import pandas as pd
+import torch
+
+from ehr2vec.common.utils import iter_patients
+
+logger = logging.getLogger(__name__)  # Get the logger for this module
+
+MANIFEST_FILE = 'manifest.json'
+
+
+def patient_fingerprints(concepts: pd.DataFrame, patients_info: pd.DataFrame) -> Dict:
+    """
+    Fingerprint of every patient in patients_info: the hash of its patients_info row plus the sum of the hashes of its concept rows.
+    The sum does not depend on row order, so a fingerprint only changes if rows of the patient are added, removed or changed.
+    """
+    fingerprints = pd.util.hash_pandas_object(patients_info, index=False).to_numpy().copy()
+    row_hashes = pd.util.hash_pandas_object(concepts, index=False).to_numpy()
+    positions = pd.Index(patients_info['PID']).get_indexer(concepts['PID'])
+    kept = positions >= 0
+    np.add.at(fingerprints, positions[kept], row_hashes[kept])  # uint64, wraps around
+    return dict(zip(patients_info['PID'].tolist(), fingerprints.tolist()))
+
+
+class FeatureManifest:
+    """
+    Records which source file versions and which patients every features_{i}.pt shard was built from.
+    Patients removed by the excluder are recorded too, so a change to them is detected as well.
+    """
+    def __init__(self, features_dir: str):
+        self.features_dir = features_dir
+        self.path = join(features_dir, MANIFEST_FILE)
+        self.sources = {}
+        self.config = None
+        self.shards = {} # shard -> {pid: fingerprint}
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def load(self) -> 'FeatureManifest':
+        with open(self.path) as f:
+            manifest = json.load(f)
+        self.sources = manifest['sources']
+        self.config = manifest['config']
+        self.shards = {int(shard): dict(map(tuple, patients)) for shard, patients in manifest['shards'].items()}
+        return self
+
+    def save(self) -> None:
+        manifest = {
+            'sources': self.sources,
+            'config': self.config,
+            # pid, fingerprint pairs keep the type of the PIDs
+            'shards': {str(shard): [[pid, fp] for pid, fp in patients.items()] for shard, patients in sorted(self.shards.items())},
+        }
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.path)
+
+    def record_shard(self, shard: int, fingerprints: Dict) -> None:
+        self.shards[shard] = fingerprints
+
+    def record(self, batches: Iterator[Tuple[pd.DataFrame, pd.DataFrame]]) -> Iterator[Tuple[pd.DataFrame, pd.DataFrame]]:
+        """Passes batches through, recording the fingerprints of batch i as shard i"""
+        for shard, (concepts, patients_info) in enumerate(batches):
+            self.record_shard(shard, patient_fingerprints(concepts, patients_info))
+            yield concepts, patients_info
+
+    def pid_to_shard(self) -> Dict:
+        return {pid: shard for shard, patients in self.shards.items() for pid in patients}
+
+    @staticmethod
+    def get_sources(paths: List[str]) -> Dict:
+        sources = {}
+        for path in paths:
+            stat = os.stat(path)
+            sources[os.path.abspath(path)] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        return sources
+
+    @staticmethod
+    def get_config(config: dict) -> str:
+        return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class IncrementalFeatureUpdater:
+    """
+    Updates existing feature shards in place from a manifest. Only patients with new, changed or removed rows are
+    recomputed: changed patients are rewritten in their shard, new patients are written to new shards.
+    create_features(concepts, patients_info) -> (features, kept_pids) must be the per batch feature creation used for the shards.
+    """
+    def __init__(self, features_dir: str, create_features: Callable[[pd.DataFrame, pd.DataFrame], Tuple[dict, list]],
+                 config: dict, batch_size: int):
+        self.features_dir = features_dir
+        self.create_features = create_features
+        self.config = FeatureManifest.get_config(config)
+        self.batch_size = batch_size  # Patients per new shard
+        self.manifest = FeatureManifest(features_dir)
+
+    def is_compatible(self) -> bool:
+        """Shards can only be updated if they were created with the same config"""
+        return self.manifest.exists() and self.manifest.load().config == self.config
+
+    def update(self, batches: Iterator[Tuple[pd.DataFrame, pd.DataFrame]], source_paths: List[str]) -> List[list]:
+        """Updates the shards and pids_features.pt and returns the pids of every shard."""
+        self.manifest.load()
+        pids = torch.load(join(self.features_dir, 'pids_features.pt'))
+        sources = FeatureManifest.get_sources(source_paths)
+        if sources == self.manifest.sources:
+            logger.info('Source files are unchanged, keeping all feature shards')
+            return pids
+
+        pid_to_shard = self.manifest.pid_to_shard()
+        feature_keys = []
+        updates = defaultdict(dict) # shard -> {pid: (patient features or None if excluded/removed, fingerprint or None if removed)}
+        new_patients = []
+        seen = set()
+        for concepts, patients_info in batches:
+            fingerprints = patient_fingerprints(concepts, patients_info)
+            seen.update(fingerprints)
+            changed = [pid for pid, fp in fingerprints.items()
+                       if pid not in pid_to_shard or self.manifest.shards[pid_to_shard[pid]][pid] != fp]
+            if not changed:
+                continue
+            features, kept_pids = self.create_features(concepts[concepts['PID'].isin(changed)].copy(),
+                                                       patients_info[patients_info['PID'].isin(changed)].copy())
+            feature_keys = list(features)
+            kept = dict(zip(kept_pids, iter_patients(features)))
+            for pid in changed:
+                if pid in pid_to_shard:
+                    updates[pid_to_shard[pid]][pid] = (kept.get(pid), fingerprints[pid])
+                else:
+                    new_patients.append((pid, kept.get(pid), fingerprints[pid]))
+        for pid in set(pid_to_shard).difference(seen):
+            updates[pid_to_shard[pid]][pid] = (None, None)
+
+        logger.info(f'Updating {sum(len(u) for u in updates.values())} patients in {len(updates)} shards, '
+                    f'adding {len(new_patients)} new patients')
+        for shard, patient_updates in sorted(updates.items()):
+            pids[shard] = self.update_shard(shard, patient_updates)
+        for start in range(0, len(new_patients), self.batch_size):
+            pids.append(self.write_new_shard(len(pids), new_patients[start:start + self.batch_size], feature_keys))
+
+        torch.save(pids, join(self.features_dir, 'pids_features.pt'))
+        self.manifest.sources = sources
+        self.manifest.save()
+        return pids
+
+    def update_shard(self, shard: int, patient_updates: Dict) -> list:
+        """Replaces changed patients in place, removes excluded ones and appends patients that are no longer excluded."""
+        features = torch.load(join(self.features_dir, f'features_{shard}.pt'))
+        shard_pids = torch.load(join(self.features_dir, f'pids_features_{shard}.pt'))
+        positions = {pid: i for i, pid in enumerate(shard_pids)}
+        removed = set()
+        for pid, (patient, fingerprint) in patient_updates.items():
+            if pid in positions and patient is not None:
+                for key, values in features.items():
+                    values[positions[pid]] = patient[key]
+            elif pid in positions:
+                removed.add(positions[pid])
+            elif patient is not None:
+                shard_pids.append(pid)
+                for key, values in features.items():
+                    values.append(patient[key])
+            if fingerprint is None:
+                del self.manifest.shards[shard][pid]
+            else:
+                self.manifest.shards[shard][pid] = fingerprint
+        if removed:
+            kept = [i for i in range(len(shard_pids)) if i not in removed]
+            shard_pids = [shard_pids[i] for i in kept]
+            features = {key: [values[i] for i in kept] for key, values in features.items()}
+        self._save_shard(shard, features, shard_pids)
+        return shard_pids
+
+    def write_new_shard(self, shard: int, patients: List[tuple], feature_keys: list) -> list:
+        features = {key: [] for key in feature_keys}
+        shard_pids = []
+        for pid, patient, _ in patients:
+            if patient is None:
+                continue
+            shard_pids.append(pid)
+            for key, values in patient.items():
+                features.setdefault(key, []).append(values)
+        self._save_shard(shard, features, shard_pids)
+        self.manifest.record_shard(shard, {pid: fingerprint for pid, _, fingerprint in patients})
+        return shard_pids
+
+    def _save_shard(self, shard: int, features: dict, shard_pids: list) -> None:
+        torch.save(features, join(self.features_dir, f'features_{shard}.pt'))
+        torch.save(shard_pids, join(self.features_dir, f'pids_features_{shard}.pt'))
+
+    def clear(self) -> None:
+        """Removes shards and manifest before a full rebuild"""
+        for path in glob.glob(join(self.features_dir, '*features*.pt')) + [self.manifest.path]:
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,173 @@
+import logging
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Tuple
+
+from ehr2vec.common.utils import Data
+from ehr2vec.data.utils import Utilities
+
+logger = logging.getLogger(__name__)  # Get the logger for this module
+
+FILTER = 'filter'
+TRANSFORM = 'transform'
+GLOBAL = 'global'
+DEFAULT_CHUNK_SIZE = 10000
+
+
+@dataclass
+class PlanStep:
+    kind: str
+    func: Callable
+    args_for_func: Dict = field(default_factory=dict)
+    reads_features: bool = False
+    log_positive_patients_num: bool = False
+
+    @property
+    def name(self) -> str:
+        return self.func.__name__
+
+
+class PreprocessingPlan:
+    """
+    Plan of preprocessing steps on Data, every step is func(data, **args_for_func) -> Data.
+    - filter: selects patients or sets their outcomes. Run on the patient level data (pids, outcomes and vocabulary),
+        only the indices of the kept patients are updated. Filters with reads_features see the features of the kept patients.
+    - transform: changes the features of every patient independently of the other patients.
+        Pending transforms are fused: they run together on chunks of patients when their features are needed.
+    - global: needs all data at once, e.g. changes the vocabulary. Pending transforms are applied first.
+    With lazy=False every step is applied to the full data in order, as Utilities.process_data does.
+    """
+    def __init__(self, lazy: bool = True, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.lazy = lazy
+        self.chunk_size = chunk_size
+        self.steps: List[PlanStep] = []
+
+    def filter(self, func: Callable, reads_features: bool = False, log_positive_patients_num: bool = False, args_for_func: Dict = None) -> 'PreprocessingPlan':
+        self.steps.append(PlanStep(FILTER, func, args_for_func or {}, reads_features, log_positive_patients_num))
+        return self
+
+    def transform(self, func: Callable, log_positive_patients_num: bool = False, args_for_func: Dict = None) -> 'PreprocessingPlan':
+        self.steps.append(PlanStep(TRANSFORM, func, args_for_func or {}, True, log_positive_patients_num))
+        return self
+
+    def step(self, func: Callable, log_positive_patients_num: bool = False, args_for_func: Dict = None) -> 'PreprocessingPlan':
+        self.steps.append(PlanStep(GLOBAL, func, args_for_func or {}, True, log_positive_patients_num))
+        return self
+
+    def explain(self) -> str:
+        """Summary of the plan: the steps in order and how the transforms are fused into passes over the features."""
+        mode = f'lazy, fused passes over chunks of {self.chunk_size} patients' if self.lazy else 'eager'
+        lines = [f'Preprocessing plan ({mode}):']
+        fused_pass, pending = 0, False
+        for i, step in enumerate(self.steps, start=1):
+            if self.lazy and pending and self._is_barrier(step):
+                pending = False
+            if self.lazy and step.kind == TRANSFORM and not pending:
+                fused_pass, pending = fused_pass + 1, True
+            line = f'  {i:>2}. {step.kind:<9} {step.name}'
+            if step.args_for_func:
+                line += f"({', '.join(f'{k}={self._format_arg(v)}' for k, v in step.args_for_func.items())})"
+            if self.lazy and step.kind == TRANSFORM:
+                line += f'  [fused pass {fused_pass}]'
+            elif self.lazy and self._is_barrier(step):
+                line += '  [needs features]'
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def execute(self, data: Data) -> Data:
+        logger.info(self.explain())
+        if not self.lazy:
+            for step in self.steps:
+                data = Utilities.process_data(data, step.func, log_positive_patients_num=step.log_positive_patients_num,
+                                              args_for_func=step.args_for_func)
+            return data
+        return self._execute_lazy(data)
+
+    def _execute_lazy(self, data: Data) -> Data:
+        features, indices = data.features, list(range(len(data.pids)))
+        patients = self._patient_data(data)
+        pending = []
+        for step in self.steps:
+            if step.kind == TRANSFORM:
+                pending.append(step) # Logged once it is applied
+                continue
+            if self._is_barrier(step) and pending:
+                features, indices, patients = self._apply_transforms(features, indices, patients, pending)
+                pending = []
+            view = self._patient_data(patients, self._select(features, indices) if step.reads_features else {})
+            positions = {pid: i for i, pid in enumerate(view.pids)} # Before the step, which may update view in place
+            result = step.func(view, **step.args_for_func)
+            if step.kind == GLOBAL:
+                features, indices = result.features, list(range(len(result.pids)))
+            else:
+                indices = [indices[positions[pid]] for pid in result.pids]
+            patients = self._patient_data(result)
+            self._log_step(step, patients)
+
+        if pending:
+            features, indices, patients = self._apply_transforms(features, indices, patients, pending)
+        return self._patient_data(patients, self._select(features, indices))
+
+    def _apply_transforms(self, features: Dict[str, list], indices: List[int], patients: Data, 
+                          transforms: List[PlanStep]) -> Tuple[Dict[str, list], List[int], Data]:
+        """
+        Applies the transforms to the kept patients, one chunk of patients at a time.
+        Returns the transformed features, their indices and the patient level data, which transforms may update (e.g. censor_outcomes).
+        Transforms can not add or remove patients.
+        """
+        logger.info(f"Applying {', '.join(step.name for step in transforms)} to {len(indices)} patients")
+        transformed = {key: [] for key in features} if not indices else {}
+        result = self._patient_data(patients)
+        result.pids = []
+        result.outcomes = [] if patients.outcomes is not None else None
+        result.censor_outcomes = [] if patients.censor_outcomes is not None else None
+        for start in range(0, len(indices), self.chunk_size):
+            end = start + self.chunk_size
+            chunk = Data(features=self._select(features, indices[start:end]), pids=patients.pids[start:end],
+                         outcomes=self._slice(patients.outcomes, start, end),
+                         censor_outcomes=self._slice(patients.censor_outcomes, start, end),
+                         vocabulary=patients.vocabulary, mode=patients.mode)
+            n_patients = len(chunk.pids)
+            for step in transforms:
+                chunk = step.func(chunk, **step.args_for_func)
+            assert len(chunk.pids) == n_patients, \
+                f"Transforms {[step.name for step in transforms]} returned {len(chunk.pids)} of {n_patients} patients, select patients with a filter"
+            chunk.check_lengths()
+            for key, values in chunk.features.items():
+                transformed.setdefault(key, []).extend(values)
+            result.pids.extend(chunk.pids)
+            for attr in ('outcomes', 'censor_outcomes'):
+                if getattr(result, attr) is not None:
+                    getattr(result, attr).extend(getattr(chunk, attr))
+        for step in transforms:
+            self._log_step(step, result)
+        return transformed, list(range(len(result.pids))), result
+
+    @staticmethod
+    def _is_barrier(step: PlanStep) -> bool:
+        """Steps that need the result of the pending transforms"""
+        return step.kind == GLOBAL or (step.kind == FILTER and step.reads_features)
+
+    @staticmethod
+    def _log_step(step: PlanStep, patients: Data) -> None:
+        Utilities.log_patient_nums(step.name, patients)
+        if step.log_positive_patients_num:
+            Utilities.log_pos_patients_num(patients)
+
+    @staticmethod
+    def _patient_data(data: Data, features: Dict[str, list] = None) -> Data:
+        return Data(features=features or {}, pids=data.pids, outcomes=data.outcomes, censor_outcomes=data.censor_outcomes,
+                    vocabulary=data.vocabulary, mode=data.mode)
+
+    @staticmethod
+    def _select(features: Dict[str, list], indices: List[int]) -> Dict[str, list]:
+        return {key: [values[i] for i in indices] for key, values in features.items()}
+
+    @staticmethod
+    def _slice(values: list, start: int, end: int) -> list:
+        return values[start:end] if values is not None else None
+
+    @staticmethod
+    def _format_arg(value) -> str:
+        if isinstance(value, (list, tuple, set, dict)):
+            return f'<{type(value).__name__} of {len(value)}>'
+        return repr(value)
@@ -7,14 +7,20 @@ from typing import Dict, List, Tuple, Union
 import numpy as np
 import pandas as pd
 import torch
+from scipy.sparse import csr_matrix, hstack
+from sklearn.compose import ColumnTransformer
+from sklearn.feature_extraction.text import TfidfTransformer
+from sklearn.pipeline import Pipeline
 
 from ehr2vec.common.config import Config, instantiate, load_config
 from ehr2vec.common.loader import (FeaturesLoader, get_pids_file,
                                    load_and_select_splits, load_exclude_pids)
+from ehr2vec.common.ragged import flatten
 from ehr2vec.common.saver import Saver
 from ehr2vec.common.utils import Data
 from ehr2vec.data.dataset import HierarchicalMLMDataset, MLMDataset
 from ehr2vec.data.filter import CodeTypeFilter, PatientFilter
+from ehr2vec.data.plan import DEFAULT_CHUNK_SIZE, PreprocessingPlan
 from ehr2vec.data.utils import Utilities
 from ehr2vec.data_fixes.adapt import (BaseAdapter, BehrtAdapter,
                                       DiscreteAbsposAdapter, PLOSAdapter)
@@ -27,6 +33,10 @@ PID_KEY = 'PID'
 VOCABULARY_FILE = 'vocabulary.pt'
 HIERARCHICAL_VOCABULARY_FILE = 'h_vocabulary.pt'
 DEFAULT_PROLONGED_LENGTH_OF_STAY = 7
+BINARY = 'binary'
+COUNT = 'count'
+TFIDF = 'tfidf'
+AGE_INDEX = 0 # Column of the age in the one hot features
 
 # TODO: Add option to load test set only!
 class DatasetPreparer:
@@ -75,11 +85,12 @@ class DatasetPreparer:
         data_cfg = self.cfg.data
 
         # 1. Loading tokenized data
-        data = self.loader.load_tokenized_data(mode='finetune')
+        data = self._load_tokenized_data(mode='finetune')
+        plan = self._create_plan()
         if self.cfg.paths.get('exclude_pids', None) is not None:
             logger.info(f"Pids to exclude: {self.cfg.paths.exclude_pids}")
             exclude_pids = load_exclude_pids(self.cfg.paths)
-            data = self.utils.process_data(data, self.patient_filter.exclude_pids, args_for_func={'exclude_pids': exclude_pids})
+            plan.filter(self.patient_filter.exclude_pids, args_for_func={'exclude_pids': exclude_pids})
 
         predefined_pids =  'predefined_splits' in self.cfg.paths
         if predefined_pids:
@@ -90,79 +101,70 @@ class DatasetPreparer:
             else:
                 original_config = load_config(join(self.cfg.paths.model_path, 'finetune_config.yaml'))
             self.cfg.outcome.n_hours = original_config.outcome.n_hours
-            data = self._select_predefined_pids(data)
-            self._load_outcomes_to_data(data)
+            plan.filter(self._select_predefined_pids)
+            plan.filter(self._load_outcomes_to_data)
 
         if not predefined_pids:        
             # 2. Optional: Select gender group
             if data_cfg.get('gender'):
-                data = self.utils.process_data(data, self.patient_filter.select_by_gender)
+                plan.filter(self.patient_filter.select_by_gender, reads_features=True)
             
             # 4. Loading and processing outcomes
             outcomes, censor_outcomes = self.loader.load_outcomes()
-            logger.info("Assigning outcomes to data")
-            data = self.utils.process_data(data, self._retrieve_and_assign_outcomes, log_positive_patients_num=True,
-                                            args_for_func={'outcomes': outcomes, 'censor_outcomes': censor_outcomes})
+            plan.filter(self._retrieve_and_assign_outcomes, log_positive_patients_num=True,
+                        args_for_func={'outcomes': outcomes, 'censor_outcomes': censor_outcomes})
 
             # 5. Optional: select patients of interest
             if data_cfg.get("select_censored"):
-                data = self.utils.process_data(data, self.patient_filter.select_censored, log_positive_patients_num=True)
+                plan.filter(self.patient_filter.select_censored, log_positive_patients_num=True)
 
             # 6. Optional: Filter patients with outcome before censoring
             if self.cfg.outcome.type != self.cfg.outcome.get('censor_type', None):
-                data = self.utils.process_data(data, self.patient_filter.filter_outcome_before_censor, log_positive_patients_num=True) # !Timeframe (earlier instance of outcome)
+                plan.filter(self.patient_filter.filter_outcome_before_censor, log_positive_patients_num=True) # !Timeframe (earlier instance of outcome)
 
             # 7. Optional: Filter code types
             if data_cfg.get('code_types'):
-                data = self.utils.process_data(data, self.code_type_filter.filter)
-                data = self.utils.process_data(data, self.patient_filter.exclude_short_sequences, log_positive_patients_num=True)
+                plan.step(self.code_type_filter.filter)
+                plan.filter(self.patient_filter.exclude_short_sequences, reads_features=True, log_positive_patients_num=True)
 
         # 8. Data censoring
-        data = self.utils.process_data(data, self.data_modifier.censor_data, log_positive_patients_num=True,
-                                               args_for_func={'n_hours': self.cfg.outcome.n_hours})
+        plan.filter(self.data_modifier.assign_censor_outcomes, args_for_func={'n_hours': self.cfg.outcome.n_hours})
+        plan.transform(self.data_modifier.censor_data, log_positive_patients_num=True,
+                       args_for_func={'n_hours': self.cfg.outcome.n_hours})
         if not predefined_pids:
             # 3. Optional: Select Patients By Age
             if data_cfg.get('min_age') or data_cfg.get('max_age'):
-                data = self.utils.process_data(data, self.patient_filter.select_by_age)
+                plan.filter(self.patient_filter.select_by_age, reads_features=True)
         
         # 9. Exclude patients with less than k concepts
-        data = self.utils.process_data(data, self.patient_filter.exclude_short_sequences, log_positive_patients_num=True)
+        plan.filter(self.patient_filter.exclude_short_sequences, reads_features=True, log_positive_patients_num=True)
 
         # 10. Optional: Patient selection
         if data_cfg.get('num_patients') and not predefined_pids:
-            data = self.utils.process_data(data, self.patient_filter.select_random_subset, log_positive_patients_num=True,
-                                              args_for_func={'num_patients':data_cfg.num_patients})
+            plan.filter(self.patient_filter.select_random_subset, log_positive_patients_num=True,
+                        args_for_func={'num_patients':data_cfg.num_patients})
         
         # 11. Optional: Remove Background Tokens
         if data_cfg.get("remove_background"):
-            data = self.utils.process_data(data, self.data_modifier.remove_background)
+            plan.transform(self.data_modifier.remove_background)
 
         # 12. Truncation
         logger.info(f"Truncating data to {data_cfg.truncation_len} tokens")
-        data = self.utils.process_data(data, self.data_modifier.truncate, args_for_func={'truncation_len': data_cfg.truncation_len})
+        plan.transform(self.data_modifier.truncate, args_for_func={'truncation_len': data_cfg.truncation_len})
 
         # 13. Normalize segments
-        data = self.utils.process_data(data, self.data_modifier.normalize_segments)
+        plan.transform(self.data_modifier.normalize_segments)
 
         # 14. Optional: Adapt to BEHRT embeddings
-        if self.cfg.model.get('behrt_embeddings'):
-            logger.info('Adapting features for behrt embeddings')
-            data.features = BehrtAdapter.adapt_features(data.features)
-
-        if self.cfg.model.get('discrete_abspos_embeddings'):
-            if self.cfg.model.get('behrt_embeddings'):
-                raise ValueError("Discrete abspos embeddings and behrt embeddings are not compatible.")
-            logger.info('Adapting features for discrete abspos embeddings')
-            data.features = DiscreteAbsposAdapter.adapt_features(data.features)
+        self._add_adapters(plan)
 
         # 15. Optional: Remove any unwanted features
         if 'remove_features' in data_cfg:
-            for feature in data_cfg.remove_features:
-                logger.info(f"Removing {feature}")
-                data.features.pop(feature, None)
+            logger.info(f"Removing {data_cfg.remove_features}")
+            plan.transform(self.data_modifier.remove_features, args_for_func={'features': list(data_cfg.remove_features)})
 
-        if 'age' in data.features: # we don't apply time2vec to age anymore
-            data.features['age'] = [BaseAdapter.convert_ages_to_int(ages) for ages in data.features['age']] 
+        plan.transform(self.data_modifier.convert_ages_to_int) # we don't apply time2vec to age anymore
+        data = plan.execute(data)
 
         # Verify and save
         data.check_lengths()
@@ -182,61 +184,54 @@ class DatasetPreparer:
         6. Normalize segments
         """
         data_cfg = self.cfg.data
-        model_cfg = self.cfg.model
 
         # 1. Load tokenized data
-        data = self.loader.load_tokenized_data(mode='pretrain')
+        data = self._load_tokenized_data(mode='pretrain')
+        plan = self._create_plan()
         
         if self.cfg.paths.get('exclude_pids', None) is not None:
             logger.info(f"Pids to exclude: {self.cfg.paths.exclude_pids}")
             exclude_pids = load_exclude_pids(self.cfg.paths)
-            data = self.utils.process_data(data, self.patient_filter.exclude_pids, args_for_func={'exclude_pids': exclude_pids})
+            plan.filter(self.patient_filter.exclude_pids, args_for_func={'exclude_pids': exclude_pids})
 
         predefined_pids =  'predefined_splits' in self.cfg.paths
         if predefined_pids:
             logger.warning("Using predefined splits. Ignoring test_split parameter")
-            data = self._select_predefined_pids(data)
+            plan.filter(self._select_predefined_pids)
 
         # 2. Optional: Remove background tokens
         if data_cfg.get('remove_background'):
-            data = self.utils.process_data(data, self.data_modifier.remove_background)
+            plan.transform(self.data_modifier.remove_background)
 
         # 3. Exclude short sequences
-        data = self.utils.process_data(data, self.patient_filter.exclude_short_sequences)
+        plan.filter(self.patient_filter.exclude_short_sequences, reads_features=True)
         if not predefined_pids:
             # 4. Optional: Patient Subset Selection
             if data_cfg.get('num_patients'):
-                data = self.utils.process_data(data, self.patient_filter.select_random_subset, args_for_func={'num_patients':data_cfg.num_train_patients})
+                plan.filter(self.patient_filter.select_random_subset, args_for_func={'num_patients':data_cfg.num_train_patients})
 
         # 5. Truncation
         logger.info(f"Truncating data to {data_cfg.truncation_len} tokens")
-        data = self.utils.process_data(data, self.data_modifier.truncate, args_for_func={'truncation_len': data_cfg.truncation_len})
+        plan.transform(self.data_modifier.truncate, args_for_func={'truncation_len': data_cfg.truncation_len})
 
         # 6. Normalize segments
-        data = self.utils.process_data(data, self.data_modifier.normalize_segments)
+        plan.transform(self.data_modifier.normalize_segments)
       
         # Adjust max segment if needed
-        self.utils.check_and_adjust_max_segment(data, model_cfg)
+        plan.transform(self._adjust_max_segment)
 
         if self.cfg.model.get('prolonged_length_of_stay', False):
             logger.info('Add prolonged length of stay to features.')
             threshold_in_days = self.cfg.data.get('prolonged_length_of_stay', DEFAULT_PROLONGED_LENGTH_OF_STAY)
             # visit_threshold_in_days = self.cfg.data.get('visit_threshold_in_days', DEFAULT_VISIT_THRESHOLD_IN_DAYS)
-            data.features = PLOSAdapter(threshold_in_days=threshold_in_days).adapt_features(data.features)
+            plan.transform(self.data_modifier.add_prolonged_length_of_stay, args_for_func={'threshold_in_days': threshold_in_days})
 
         # 7. Optional: Adapt to BEHRT embeddings
-        if self.cfg.model.get('behrt_embeddings'):
-            logger.info('Adapting features for behrt embeddings')
-            data.features = BehrtAdapter.adapt_features(data.features)
+        self._add_adapters(plan)
 
-        if self.cfg.model.get('discrete_abspos_embeddings'):
-            if self.cfg.model.get('behrt_embeddings'):
-                raise ValueError("Discrete abspos embeddings and behrt embeddings are not compatible.")
-            logger.info('Adapting features for discrete abspos embeddings')
-            data.features = DiscreteAbsposAdapter.adapt_features(data.features)
+        plan.transform(self.data_modifier.convert_ages_to_int) # we don't apply time2vec to age anymore
+        data = plan.execute(data)
 
-        if 'age' in data.features: # we don't apply time2vec to age anymore
-            data.features['age'] = [BaseAdapter.convert_ages_to_int(ages) for ages in data.features['age']] 
         # Verify and save
         data.check_lengths()
         data = self.utils.process_data(data, self.saver.save_sequence_lengths)
@@ -244,12 +239,34 @@ class DatasetPreparer:
         self.saver.save_data(data)
         self._log_features(data)
         return data
+
+    def _create_plan(self) -> PreprocessingPlan:
+        """Steps are run in order on the full data, or lazily with fused transforms if data.lazy_preprocessing is true"""
+        return PreprocessingPlan(lazy=self.cfg.data.get('lazy_preprocessing', False),
+                                 chunk_size=self.cfg.data.get('preprocessing_chunk_size', DEFAULT_CHUNK_SIZE))
+
+    def _add_adapters(self, plan: PreprocessingPlan) -> None:
+        """Optional: Adapt to BEHRT or discrete abspos embeddings"""
+        if self.cfg.model.get('behrt_embeddings'):
+            logger.info('Adapting features for behrt embeddings')
+            plan.transform(self.data_modifier.adapt_to_behrt)
+
+        if self.cfg.model.get('discrete_abspos_embeddings'):
+            if self.cfg.model.get('behrt_embeddings'):
+                raise ValueError("Discrete abspos embeddings and behrt embeddings are not compatible.")
+            logger.info('Adapting features for discrete abspos embeddings')
+            plan.transform(self.data_modifier.adapt_to_discrete_abspos)
+
+    def _adjust_max_segment(self, data: Data) -> Data:
+        self.utils.check_and_adjust_max_segment(data, self.cfg.model)
+        return data
     
-    def prepare_onehot_features(self)->Tuple[np.ndarray, np.ndarray, Dict]:
-        """Use ft features and map them onto one hot vectors with binary outcomes"""
+    def prepare_onehot_features(self)->Tuple[csr_matrix, np.ndarray, Dict]:
+        """Use ft features and map them onto sparse one hot vectors with binary outcomes"""
         data = self.loader.load_finetune_data()
         token2index, new_vocab = self.utils.get_token_to_index_map(data.vocabulary)
-        X, y = OneHotEncoder.encode(data, token2index)
+        weighting = OneHotEncoder.get_weighting(self.cfg)
+        X, y = OneHotEncoder.encode(data, token2index, weighting)
         return X, y, new_vocab
 
     def _retrieve_and_assign_outcomes(self, data: Data, outcomes: Dict, censor_outcomes: Dict)->Data:
@@ -260,6 +277,11 @@ class DatasetPreparer:
         else:
             data.censor_outcomes = [None]*len(outcomes)
         return data
+    def _load_tokenized_data(self, mode: str)->Data:
+        """With predefined splits only their patients are loaded, shards of sharded data without any of them are skipped"""
+        pids = self._get_predefined_pids(self.cfg.paths.predefined_splits) if 'predefined_splits' in self.cfg.paths else None
+        return self.loader.load_tokenized_data(mode=mode, pids=pids)
+
     @staticmethod
     def _get_predefined_pids(predefined_splits_path)->List:
         """Return pids from predefined splits"""
@@ -279,10 +301,11 @@ class DatasetPreparer:
         data = data.select_data_subset_by_pids(predefined_pids, mode=data.mode)
         return data
     
-    def _load_outcomes_to_data(self, data: Data)->None:
+    def _load_outcomes_to_data(self, data: Data)->Data:
         """ Load outcomes and censor outcomes to data. """
         for outcome_type in ['outcomes', 'censor_outcomes']:
             setattr(data, outcome_type, torch.load(join(self.cfg.paths.predefined_splits, f'{outcome_type}.pt')))
+        return data
 
     def _log_features(self, data:Data)->None:
         logger.info(f"Final features: {data.features.keys()}")
@@ -292,43 +315,65 @@ class DatasetPreparer:
 
 class OneHotEncoder:
     @staticmethod
-    def encode(data:Data, token2index: dict) -> Tuple[np.ndarray, np.ndarray]:
+    def encode(data:Data, token2index: dict, weighting: str=BINARY) -> Tuple[csr_matrix, np.ndarray]:
         # ! Potentially map gender onto one index?
-        """Encode features to one hot and age at the time of last event"""
-        AGE_INDEX = 0
-         # Initialize arrays
-        num_samples = len(data)
-        num_features = len(token2index) + 1 # +1 for age
-
-        X, y = OneHotEncoder.initialize_Xy(num_samples, num_features)
-        keys_array = np.array(list(token2index.keys())) # Create an array of keys for faster lookup
-        token2index_map = np.vectorize(token2index.get) # Vectorized function to map tokens to indices
-
-        for sample, (concepts, outcome) in enumerate(zip(data.features['concept'], data.outcomes)):
-            y[sample] = OneHotEncoder.encode_outcome(outcome)
-            X[sample, AGE_INDEX] = data.features['age'][sample][-1]   
-            OneHotEncoder.encode_concepts(concepts, token2index_map, keys_array, X, sample)
+        """
+        Encode features to a sparse patients x (1 + len(token2index)) matrix, built in one pass over the flat concepts.
+        Column 0 (AGE_INDEX) is the age at the time of last event (0 for patients without events), 
+        column token2index[token] + 1 holds the concept weight: binary (1 if present) or count (number of occurrences).
+        For tfidf the counts are returned, weighted by the model from get_model, which fits the idf on the training patients only.
+        """
+        concepts, offsets = flatten(data.features['concept'])
+        counts = OneHotEncoder.count_concepts(concepts, offsets, token2index)
+        ages, _ = flatten(data.features['age'])
+        last_ages = np.zeros(len(offsets) - 1)
+        has_events = np.diff(offsets) > 0
+        last_ages[has_events] = ages[offsets[1:][has_events] - 1]
+
+        if weighting == TFIDF:
+            dtype = np.float32
+            concept_weights = counts
+        elif weighting in (BINARY, COUNT):
+            dtype = np.int16
+            concept_weights = counts
+            if weighting == BINARY:
+                concept_weights.data[:] = 1
+        else:
+            raise ValueError(f"Unknown one hot weighting {weighting}, use one of {BINARY}, {COUNT}, {TFIDF}")
+
+        # Ages are whole years under every weighting, as in the int16 binary and count matrices
+        age_column = csr_matrix(last_ages.astype(np.int16).astype(dtype).reshape(-1, 1))
+        X = hstack([age_column, concept_weights], format='csr', dtype=dtype)
+        y = pd.notna(np.asarray(data.outcomes, dtype=object)).astype(np.int16)
         return X, y
 
     @staticmethod
-    def encode_outcome(outcome) -> int:
-        return int(pd.notna(outcome))
+    def get_weighting(cfg: Config) -> str:
+        return (cfg.get('data') or {}).get('onehot_weighting', BINARY)
 
     @staticmethod
-    def encode_concepts(concepts: List[int], token2index_map: np.vectorize, 
-                        keys_array: np.ndarray, X:np.ndarray, sample: int) -> None:
-        concepts = np.array(concepts)
-        unique_concepts = np.unique(concepts)
-        valid_concepts_mask = np.isin(unique_concepts, keys_array) # Only keep concepts that are in the token2index map
-        filtered_concepts = unique_concepts[valid_concepts_mask]
-        concept_indices = token2index_map(filtered_concepts) + 1
-        X[sample, concept_indices] = 1
+    def get_model(model, weighting: str=BINARY):
+        """The model, for tfidf in a pipeline that weights the concept columns with idf fitted on the data the pipeline is fitted on"""
+        if weighting != TFIDF:
+            return model
+        weights = ColumnTransformer([('age', 'passthrough', [AGE_INDEX]), ('tfidf', TfidfTransformer(), slice(AGE_INDEX + 1, None))], 
+                                    sparse_threshold=1)
+        return Pipeline([('weights', weights), ('model', model)])
 
     @staticmethod
-    def initialize_Xy(num_samples: int, num_features: int)->Tuple[np.ndarray, np.ndarray]:
-        X = np.zeros((num_samples, num_features), dtype=np.int16)
-        y = np.zeros(num_samples, dtype=np.int16)
-        return X, y
+    def count_concepts(concepts: np.ndarray, offsets: np.ndarray, token2index: dict) -> csr_matrix:
+        """Sparse patients x len(token2index) counts of the concepts, concepts not in token2index are dropped"""
+        lookup = np.full(max(max(token2index, default=-1), concepts.max(initial=-1)) + 1, -1, dtype=np.int64)
+        lookup[list(token2index.keys())] = list(token2index.values())
+        columns = np.full(len(concepts), -1, dtype=np.int64)
+        valid = concepts >= 0
+        columns[valid] = lookup[concepts[valid]]
+        rows = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        kept = columns >= 0
+        counts = csr_matrix((np.ones(kept.sum(), dtype=np.int64), (rows[kept], columns[kept])),
+                            shape=(len(offsets) - 1, len(token2index)))
+        counts.sum_duplicates()
+        return counts
     
 class DataModifier:
     def __init__(self, cfg) -> None:
@@ -360,12 +405,47 @@ class DataModifier:
 
     def censor_data(self, data: Data, n_hours: float) -> Data:
         """Censors data n_hours after censor_outcome."""
-        censorer_cfg = self.cfg.data.get('censorer', {'_target_': 'data_fixes.censor.Censorer'})
-        censorer = instantiate(censorer_cfg, vocabulary=data.vocabulary, n_hours=n_hours)
+        censorer = self._get_censorer(data, n_hours)
         logger.info(f"Censoring data {n_hours} hours after outcome with {censorer.__class__.__name__}")
         data.features, data.censor_outcomes = censorer(data.features, data.censor_outcomes, exclude=False)
         return data
 
+    def assign_censor_outcomes(self, data: Data, n_hours: float) -> Data:
+        """Sets the censor times used by the censorer for all patients, e.g. EQ_Censorer draws censor times for patients without one."""
+        data.censor_outcomes = self._get_censorer(data, n_hours).get_censor_outcomes(data.censor_outcomes)
+        return data
+
+    def _get_censorer(self, data: Data, n_hours: float):
+        censorer_cfg = self.cfg.data.get('censorer', {'_target_': 'data_fixes.censor.Censorer'})
+        return instantiate(censorer_cfg, vocabulary=data.vocabulary, n_hours=n_hours)
+
+    @staticmethod
+    def adapt_to_behrt(data: Data) -> Data:
+        data.features = BehrtAdapter.adapt_features(data.features)
+        return data
+
+    @staticmethod
+    def adapt_to_discrete_abspos(data: Data) -> Data:
+        data.features = DiscreteAbsposAdapter.adapt_features(data.features)
+        return data
+
+    @staticmethod
+    def add_prolonged_length_of_stay(data: Data, threshold_in_days: int) -> Data:
+        data.features = PLOSAdapter(threshold_in_days=threshold_in_days).adapt_features(data.features)
+        return data
+
+    @staticmethod
+    def remove_features(data: Data, features: List[str]) -> Data:
+        for feature in features:
+            data.features.pop(feature, None)
+        return data
+
+    @staticmethod
+    def convert_ages_to_int(data: Data) -> Data:
+        if 'age' in data.features:
+            data.features['age'] = BaseAdapter.convert_ages_to_int_batch(data.features['age'])
+        return data
+
     @staticmethod
     def normalize_segments(data: Data) -> Data:
         """Normalize segments after truncation to start with 1 and increase by 1
@@ -0,0 +1,126 @@
+import json
+import logging
+import os
+from os.path import join
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import torch
+
+logger = logging.getLogger(__name__)  # Get the logger for this module
+
+MANIFEST_FILE = 'manifest.json'
+
+
+class TokenizedShardWriter:
+    """
+    Writes the tokenized patients of a split to shards_dir as they are produced: features_{i}.pt and pids_{i}.pt
+    with shard_size patients each (the last shard can be smaller), and a manifest of the shards on close.
+    All pids are also saved to pids_file in the order they were written, the same file as the monolithic output.
+    """
+    def __init__(self, shards_dir: str, shard_size: int, pids_file: str = None):
+        assert shard_size > 0, f"Shard size must be positive, got {shard_size}"
+        self.shards_dir = shards_dir
+        self.shard_size = shard_size
+        self.pids_file = pids_file
+        self.buffer, self.buffer_pids = {}, []
+        self.pids = []
+        self.shards = [] # {features, pids, n_patients} of the written shards
+        os.makedirs(shards_dir, exist_ok=True)
+
+    def append(self, encoded: Dict[str, list], pids: List[str]) -> None:
+        """Adds patients, writes a shard every time shard_size patients are buffered"""
+        for key, values in encoded.items():
+            self.buffer.setdefault(key, []).extend(values)
+        self.buffer_pids.extend(pids)
+        while len(self.buffer_pids) >= self.shard_size:
+            self.flush(self.shard_size)
+
+    def flush(self, n_patients: int) -> None:
+        """Writes the first n_patients buffered patients as the next shard"""
+        shard = len(self.shards)
+        features = {key: values[:n_patients] for key, values in self.buffer.items()}
+        pids = self.buffer_pids[:n_patients]
+        features_file, pids_file = f'features_{shard}.pt', f'pids_{shard}.pt'
+        torch.save(features, join(self.shards_dir, features_file))
+        torch.save(pids, join(self.shards_dir, pids_file))
+        self.shards.append({'features': features_file, 'pids': pids_file, 'n_patients': len(pids)})
+        self.pids.extend(pids)
+        self.buffer = {key: values[n_patients:] for key, values in self.buffer.items()}
+        self.buffer_pids = self.buffer_pids[n_patients:]
+
+    def close(self) -> List[str]:
+        """Writes the remaining patients and the manifest. Returns all pids in the order they were written"""
+        if self.buffer_pids:
+            self.flush(len(self.buffer_pids))
+        manifest = {'shard_size': self.shard_size, 'n_patients': len(self.pids), 'shards': self.shards}
+        manifest_path = join(self.shards_dir, MANIFEST_FILE)
+        tmp_path = f'{manifest_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, manifest_path)
+        if self.pids_file is not None:
+            torch.save(self.pids, self.pids_file)
+        logger.info(f"Wrote {len(self.pids)} patients in {len(self.shards)} shards to {self.shards_dir}")
+        return self.pids
+
+
+class TokenizedShards:
+    """
+    Lazy reader of the shards written by TokenizedShardWriter. Only the manifest is read on opening,
+    shards are loaded when they are iterated or selected, by shard number or by PID.
+    """
+    def __init__(self, shards_dir: str):
+        self.shards_dir = shards_dir
+        with open(join(shards_dir, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+        self.shard_size = manifest['shard_size']
+        self.n_patients = manifest['n_patients']
+        self.shards = manifest['shards']
+
+    def __len__(self):
+        return len(self.shards)
+
+    @staticmethod
+    def is_sharded(shards_dir: str) -> bool:
+        return os.path.exists(join(shards_dir, MANIFEST_FILE))
+
+    def load_shard(self, shard: int) -> Tuple[Dict[str, list], List[str]]:
+        return self.load_features(shard), self.load_pids(shard)
+
+    def load_features(self, shard: int) -> Dict[str, list]:
+        return torch.load(join(self.shards_dir, self.shards[shard]['features']))
+
+    def load_pids(self, shard: int) -> List[str]:
+        return torch.load(join(self.shards_dir, self.shards[shard]['pids']))
+
+    def iter_shards(self, shards: Iterable[int] = None) -> Iterator[Tuple[Dict[str, list], List[str]]]:
+        """Yields the features and pids of the shards (all by default) one at a time"""
+        for shard in range(len(self)) if shards is None else shards:
+            yield self.load_shard(shard)
+
+    def find_shards(self, pids: Iterable[str]) -> List[int]:
+        """Shards containing any of the pids, only the pids files are read"""
+        pids = set(pids)
+        return [shard for shard in range(len(self)) if not pids.isdisjoint(self.load_pids(shard))]
+
+    def load(self, shards: Iterable[int] = None, pids: Iterable[str] = None) -> Tuple[Dict[str, list], List[str]]:
+        """Loads the shards (all by default), keeping only the patients in pids if given. Patients stay in stored order"""
+        pids = set(pids) if pids is not None else None
+        features, loaded_pids = {}, []
+        for shard in range(len(self)) if shards is None else shards:
+            shard_pids = self.load_pids(shard)
+            if pids is not None and pids.isdisjoint(shard_pids):
+                continue # only the pids file of shards without selected patients is read
+            shard_features = self.load_features(shard)
+            if pids is not None:
+                shard_features, shard_pids = select_pids(shard_features, shard_pids, pids)
+            for key, values in shard_features.items():
+                features.setdefault(key, []).extend(values)
+            loaded_pids.extend(shard_pids)
+        return features, loaded_pids
+
+
+def select_pids(features: Dict[str, list], pids: List[str], selected: set) -> Tuple[Dict[str, list], List[str]]:
+    """Patients whose pid is in selected, in their current order"""
+    indices = [i for i, pid in enumerate(pids) if pid in selected]
+    return {key: [values[i] for i in indices] for key, values in features.items()}, [pids[i] for i in indices]
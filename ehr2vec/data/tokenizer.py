@@ -1,8 +1,12 @@
+import numpy as np
+import pandas as pd
 import torch
 from transformers import BatchEncoding
 
 from ehr2vec.data_fixes.handle import Handler
+from ehr2vec.common.ragged import RaggedFeatures, range_positions, segment_sum, segmented_dense_rank
 from ehr2vec.common.utils import iter_patients
+from ehr2vec.common.vocabulary import ANCESTOR_CACHE_SIZE, AncestorIndex
 
 class EHRTokenizer:
     def __init__(self, config, vocabulary=None):
@@ -22,55 +26,105 @@ class EHRTokenizer:
         self.truncation = config.get('truncation', None)
         self.padding = config.get('padding', False)
         self.cutoffs = config.get('cutoffs', None)
+        self.ancestor_cache_size = config.get('ancestor_cache_size', ANCESTOR_CACHE_SIZE)
+        self.ancestor_index = None
         
     def __call__(self, features: dict, padding=None, truncation=None)->BatchEncoding:
         padding = self.padding if padding is None else padding
         truncation = self.truncation if truncation is None else truncation
         return self.batch_encode(features, padding, truncation)
 
-    def batch_encode(self, features: dict, padding=True, truncation=512)->BatchEncoding:
-        data = {key: [] for key in features}
-        data['attention_mask'] = []
-
-        for patient in iter_patients(features):
-            patient = self.insert_special_tokens(patient)                   # Insert SEP and CLS tokens
+    def __getstate__(self)->dict:
+        """The ancestor index is rebuilt on use, e.g. in a worker process"""
+        state = self.__dict__.copy()
+        state['ancestor_index'] = None
+        return state
 
-            if truncation and (len(patient['concept']) > truncation):
-                patient = self.truncate(patient, max_len=truncation)        # Truncate patient to max_len
-            
-            # Created after truncation for efficiency
-            patient['attention_mask'] = [1] * len(patient['concept'])       # Initialize attention mask
+    def batch_encode(self, features: dict, padding=True, truncation=512)->BatchEncoding:
+        """Encodes all patients at once on flat arrays, same result as encoding them one by one"""
+        return self.encode_prepared(self.prepare_batch(features, truncation), padding)
 
-            patient['concept'] = self.encode(patient['concept'])            # Encode concepts
+    def encode_prepared(self, patients: RaggedFeatures, padding=True)->BatchEncoding:
+        """Encodes patients from prepare_batch, can be done later, e.g. once the vocabulary is frozen"""
+        # Created after truncation for efficiency
+        patients.values['attention_mask'] = np.ones(patients.offsets[-1], dtype=np.int64)
 
-            for key, value in patient.items():
-                data[key].append(value)
+        patients.values['concept'] = self.encode_batch(patients.values['concept'])  # Encode concepts
 
         if padding:
-            longest_seq = max([len(s) for s in data['concept']])            # Find longest sequence
-            data = self.pad(data, max_len=longest_seq)                      # Pad sequences to max_len
+            data = self.pad_batch(patients)                                 # Pad sequences to the longest one
+        else:
+            data = patients.to_lists()
 
         return BatchEncoding(data, tensor_type='pt' if padding else None)
 
+    def prepare_batch(self, features: dict, truncation=512)->RaggedFeatures:
+        """Insert special tokens and truncate all patients, the concepts are not encoded yet"""
+        patients = RaggedFeatures.from_lists(features)
+        patients = self.insert_special_tokens_batch(patients)              # Insert SEP and CLS tokens
+
+        if truncation:
+            patients = self.truncate_batch(patients, max_len=truncation)    # Truncate patients to max_len
+        return patients
+
+    def scan_concepts(self, features: dict, truncation=None)->list:
+        """
+        Distinct concepts batch_encode would encode, in the order they would be added to a new vocabulary.
+        The vocabulary is not changed, so batches can be scanned in parallel and merged with add_to_vocabulary.
+        """
+        truncation = self.truncation if truncation is None else truncation
+        concepts = list(pd.unique(self.prepare_batch(features, truncation).values['concept']))
+        if self.cutoffs:
+            concepts = list(dict.fromkeys(self.limit_concepts_length(concepts)))
+        return concepts
+
+    def add_to_vocabulary(self, concepts: list)->None:
+        """Add concepts not in the vocabulary, with the next ids in order"""
+        for concept in concepts:
+            if concept not in self.vocabulary:
+                self.vocabulary[concept] = len(self.vocabulary)
+
+    def encode_batch(self, concepts: np.ndarray)->np.ndarray:
+        """Encode the flat concepts of all patients, each distinct concept is looked up once"""
+        # Uniques in order of first occurrence, so new concepts are added to the vocabulary in the same order
+        codes, uniques = pd.factorize(concepts)
+        return np.array(self.encode(list(uniques)), dtype=np.int64)[codes] if len(codes) else np.zeros(0, dtype=np.int64)
+
     def encode(self, concepts: list)->list:
         """Encode concepts to vocabulary ids"""
         if self.cutoffs:
             concepts = self.limit_concepts_length(concepts) # Truncate concepts to max_concept_length
         if self.new_vocab:
-            for concept in concepts:
-                if concept not in self.vocabulary:
-                    self.vocabulary[concept] = len(self.vocabulary)
-
+            self.add_to_vocabulary(concepts)
             encoded_sequence = [self.vocabulary.get(concept, self.vocabulary['[UNK]']) for concept in concepts]
         else:
-            encoded_sequence = [self.vocabulary.get(concept, self.find_closest_ancestor(concept)) for concept in concepts]
+            vocabulary = self.vocabulary
+            encoded_sequence = [vocabulary[concept] if concept in vocabulary else self.find_closest_ancestor(concept) for concept in concepts]
         return encoded_sequence
     
     def find_closest_ancestor(self, concept)->int:
-        """Find closest ancestor of concept in vocabulary"""
-        while concept not in self.vocabulary and len(concept)>0:
-            concept = concept[:-1]
-        return self.vocabulary.get(concept, self.vocabulary['[UNK]'])
+        """Find closest ancestor of concept in vocabulary, the longest prefix of concept that is in the vocabulary"""
+        return self.get_ancestor_index()(concept)
+
+    def get_ancestor_index(self)->AncestorIndex:
+        """Prefix index of the vocabulary, rebuilt only if the vocabulary has changed"""
+        if self.ancestor_index is None or not self.ancestor_index.is_current(self.vocabulary):
+            self.ancestor_index = AncestorIndex(self.vocabulary, self.vocabulary['[UNK]'], self.ancestor_cache_size)
+        return self.ancestor_index
+
+    def ancestor_lookup_info(self)->str:
+        """Hits and misses of the closest ancestor cache, None if no ancestor was looked up"""
+        if self.ancestor_index is None:
+            return None
+        info = self.ancestor_index.cache_info()
+        return f"Closest ancestor lookups: {info.hits} hits, {info.misses} misses, {info.currsize}/{info.maxsize} cached"
+
+    def ancestor_lookup_counts(self)->tuple:
+        """(hits, misses) of the closest ancestor cache"""
+        if self.ancestor_index is None:
+            return 0, 0
+        info = self.ancestor_index.cache_info()
+        return info.hits, info.misses
     # TODO: thinks what happens to short tokens that don't occur, should we instead look at closest node in the tree including siblings?
 
     @staticmethod
@@ -91,6 +145,57 @@ class EHRTokenizer:
             patient["segment"] = Handler.normalize_segments(patient["segment"])
         return patient
 
+    def truncate_batch(self, patients: RaggedFeatures, max_len: int)->RaggedFeatures:
+        """truncate for all patients longer than max_len, keeping background sentence + newest information"""
+        concepts, starts, lengths = patients.values['concept'], patients.offsets[:-1], patients.lengths()
+        is_background = pd.Series(concepts, dtype=object).str.startswith('BG_').fillna(False).to_numpy(dtype=bool)
+        background_lengths = segment_sum(is_background, patients.offsets) + 2
+        truncated = lengths > max_len
+
+        # Start of value[-truncation_length:], the kept tail of truncated patients
+        truncation_lengths = max_len - background_lengths[truncated]
+        truncated_lengths, truncated_starts = lengths[truncated], starts[truncated]
+        sep_index = np.clip(self._normalize_index(-truncation_lengths, truncated_lengths), 0, np.maximum(truncated_lengths - 1, 0))
+        truncation_lengths -= concepts[truncated_starts + sep_index] == '[SEP]'
+        tail_starts = np.zeros(len(patients), dtype=np.int64)
+        tail_starts[truncated] = np.clip(self._normalize_index(-truncation_lengths, truncated_lengths), 0, truncated_lengths)
+        head_lengths = np.where(truncated, np.minimum(background_lengths, lengths), 0)
+
+        range_starts = np.column_stack([starts, starts + tail_starts]).ravel()
+        range_lengths = np.column_stack([head_lengths, lengths - tail_starts]).ravel()
+        positions = range_positions(range_starts, range_lengths)
+        offsets = np.zeros(len(patients) + 1, dtype=np.int64)
+        np.cumsum(head_lengths + lengths - tail_starts, out=offsets[1:])
+        patients = RaggedFeatures({key: values[positions] for key, values in patients.values.items()}, offsets)
+
+        if "segment" in patients.values and truncated.any():  # Re-normalize segments of the truncated patients
+            segments = patients.values["segment"]
+            patient_indices = patients.patient_indices()
+            normalized = segmented_dense_rank(segments, patient_indices, offsets)
+            patients.values["segment"] = np.where(truncated[patient_indices], normalized, segments)
+        return patients
+
+    @staticmethod
+    def _normalize_index(index: np.ndarray, lengths: np.ndarray)->np.ndarray:
+        """Python list index, negative indices count from the end"""
+        return np.where(index < 0, index + lengths, index)
+
+    def pad_batch(self, patients: RaggedFeatures)->dict:
+        """Pad all patients to the longest one, written into preallocated tensors"""
+        lengths = patients.lengths()
+        max_len = int(lengths.max(initial=0))
+        rows = patients.patient_indices()
+        columns = np.arange(patients.offsets[-1]) - patients.offsets[rows]
+        padded_data = {}
+        for key, values in patients.values.items():
+            # Same dtypes as torch.tensor on the padded lists
+            dtype = torch.get_default_dtype() if values.dtype.kind == 'f' else torch.int64
+            token = self.vocabulary['[PAD]'] if key == 'concept' else 0
+            padded = torch.full((len(patients), max_len), token, dtype=dtype)
+            padded[rows, columns] = torch.from_numpy(values.astype(np.float64 if values.dtype.kind == 'f' else np.int64)).to(dtype)
+            padded_data[key] = padded
+        return padded_data
+
     def pad(self, features: dict,  max_len: int)->dict:
         """Pad sequences to max_len"""
         padded_data = {key: [] for key in features}
@@ -115,6 +220,37 @@ class EHRTokenizer:
         
         return patient
 
+    def insert_special_tokens_batch(self, patients: RaggedFeatures)->RaggedFeatures:
+        """Insert SEP and CLS tokens into all patients"""
+        if self.config.sep_tokens:
+            if 'segment' not in patients.values:
+                raise Exception('Cannot insert [SEP] tokens without segment information')
+            segments = patients.values['segment']
+            # SEP after every segment change and after the last item of a patient
+            is_last = np.zeros(len(segments), dtype=bool)
+            is_last[patients.offsets[1:][patients.lengths() > 0] - 1] = True
+            segment_end = is_last.copy()
+            segment_end[:-1] |= segments[:-1] != segments[1:]
+            patients = self._insert_copies(patients, segment_end, '[SEP]', before=False)
+
+        if self.config.cls_token:
+            is_first = np.zeros(patients.offsets[-1], dtype=bool)
+            is_first[patients.offsets[:-1][patients.lengths() > 0]] = True
+            patients = self._insert_copies(patients, is_first, '[CLS]', before=True)
+
+        return patients
+
+    @staticmethod
+    def _insert_copies(patients: RaggedFeatures, flags: np.ndarray, token: str, before: bool)->RaggedFeatures:
+        """Insert a copy of every flagged item, before or after it. The concept of the copy is token"""
+        counts = 1 + flags.astype(np.int64)
+        positions = np.repeat(np.arange(len(flags)), counts)
+        new_ends = np.cumsum(counts)
+        values = {key: values[positions] for key, values in patients.values.items()}
+        values['concept'][(new_ends - counts)[flags] + (0 if before else 1)] = token
+        offsets = np.concatenate([[0], new_ends])[patients.offsets]
+        return RaggedFeatures(values, offsets)
+
     @staticmethod
     def insert_sep_tokens(patient: dict)->dict:
         """Insert SEP tokens into patient"""
@@ -150,4 +286,5 @@ class EHRTokenizer:
 
     def freeze_vocabulary(self)->None:
         self.new_vocab = False
+        self.ancestor_index = None
 
@@ -7,7 +7,9 @@ from datetime import datetime
 from typing import Dict, List, Tuple, Union, Generator
 
 from ehr2vec.common.config import Config
+from ehr2vec.common.ragged import flatten
 from ehr2vec.common.utils import Data
+from ehr2vec.common.vocabulary import VocabularyIndex
 
 logger = logging.getLogger(__name__)  # Get the logger for this module
 
@@ -126,13 +128,13 @@ class Utilities:
     @staticmethod
     def get_background_indices(data: Data)->List[int]:
         """Get the length of the background sentence"""
-        background_tokens = set([v for k, v in data.vocabulary.items() if k.startswith('BG_')])
-        if len(background_tokens)==0:
+        index = VocabularyIndex.get(data.vocabulary)
+        if not index.is_background.any():
             logger.warning("No background tokens found in vocabulary")
             return []
 
         example_concepts = data.features['concept'][0] # Assume that all patients have the same background length
-        background_indices = [i for i, concept in enumerate(example_concepts) if concept in background_tokens]
+        background_indices = np.flatnonzero(index.lookup(index.is_background, example_concepts)).tolist()
 
         if data.vocabulary['[SEP]'] in example_concepts:
             background_indices.append(max(background_indices)+1)
@@ -266,21 +268,53 @@ class Utilities:
         return one_hot_matrix
 
     @staticmethod
-    def calculate_ages_at_censor_date(data: Data) -> List[int]:
+    def calculate_ages_at_censor_date(data: Data) -> np.ndarray:
         """
-        Calculates the age of patients at their respective censor dates.
+        Calculates the age of patients at their respective censor dates, for all patients at once.
+        The age is taken at the closest abspos on the left of the censor date (the first one if there is none)
+        plus the time since then. Patients without censoring (None) get their last age.
         """
-        ages_at_censor_date = []
-        
-        for abspos, age, censor_date in zip(data.features['abspos'], data.features['age'], data.censor_outcomes):
-            if censor_date is None:
-                ages_at_censor_date.append(age[-1]) # if no censoring, we take the last age
-                continue
-            # Calculate age differences and find the closest abspos index to the censor date
-            time_differences_h = np.array([censor_date - ap for ap in abspos])
-            # compute closest index (with regards to abspos) on the left to censor date
-            closest_abspos_index = np.argmin(
-                np.where(time_differences_h < 0, np.inf, time_differences_h)) 
-            age_at_censor = age[closest_abspos_index] + time_differences_h[closest_abspos_index] / 24 / 365.25
-            ages_at_censor_date.append(age_at_censor)
-        return ages_at_censor_date
\ No newline at end of file
+        abspos, offsets = flatten(data.features['abspos'])
+        ages, _ = flatten(data.features['age'])
+        censor_dates = Utilities.to_float_array(data.censor_outcomes)
+        lengths = np.diff(offsets)
+        starts = offsets[:-1]
+
+        ages_at_censor_date = np.full(len(lengths), np.nan)
+        no_censoring = np.array([censor_date is None for censor_date in data.censor_outcomes], dtype=bool)
+        has_items = lengths > 0
+        last_age = no_censoring & has_items
+        ages_at_censor_date[last_age] = ages[(starts + lengths - 1)[last_age]] # if no censoring, we take the last age
+
+        patients = np.flatnonzero(~no_censoring & ~np.isnan(censor_dates) & has_items)
+        if len(patients):
+            closest = Utilities.search_closest_before(abspos, offsets, patients, censor_dates[patients])
+            ages_at_censor_date[patients] = ages[closest] + (censor_dates[patients] - abspos[closest]) / 24 / 365.25
+        return ages_at_censor_date
+
+    @staticmethod
+    def search_closest_before(abspos: np.ndarray, offsets: np.ndarray, patients: np.ndarray, times: np.ndarray) -> np.ndarray:
+        """
+        Flat index of the item of each patient with the largest abspos <= its time, the first (flat) one among ties.
+        The patient's first item if it has none before its time. Patients must not be empty.
+        The items are sorted by patient and abspos once, every patient is then found with one binary search over keys
+        patient * stride + rank of the abspos among the abspos and times.
+        """
+        lengths = np.diff(offsets)
+        patient_indices = np.repeat(np.arange(len(lengths)), lengths)
+        order = np.lexsort((abspos, patient_indices)) # stable, ties keep their flat order
+        values, ranks = np.unique(np.concatenate([abspos, times]), return_inverse=True)
+        stride = len(values) + 1
+        keys = patient_indices[order] * stride + ranks[:len(abspos)][order]
+        positions = np.searchsorted(keys, patients * stride + ranks[len(abspos):], side='right') - 1
+        before = positions >= offsets[patients]
+        # First of the items with the same abspos, as the closest ones are tied
+        positions[before] = np.searchsorted(keys, keys[positions[before]], side='left')
+        closest = offsets[patients].copy()
+        closest[before] = order[positions[before]]
+        return closest
+
+    @staticmethod
+    def to_float_array(values: list) -> np.ndarray:
+        """Float array of the values, missing values (None, NaN) are NaN"""
+        return pd.Series(values, dtype=object).astype(float).to_numpy()
\ No newline at end of file
@@ -1,10 +1,9 @@
-from math import ceil, floor
+from math import floor
 from typing import List
 
 import numpy as np
 
-from ehr2vec.common.utils import iter_patients
-from ehr2vec.data.utils import Utilities
+from ehr2vec.common.ragged import flatten, unflatten
 import logging
 
 MIN_ABSPOS_MONTHS = -120 # 10 years into the past
@@ -20,43 +19,42 @@ class BaseAdapter:
         """Adapt features to behrt embeddings format. Continuous age is converted to integer and segment is stored as position_ids. 
         New segment is created from old segment."""
         if 'age' in features:
-            features['age'] = [BehrtAdapter.convert_ages_to_int(ages) for ages in features['age']] 
+            features['age'] = BehrtAdapter.convert_ages_to_int_batch(features['age'])
         if 'segment' in features:
             features['position_ids'] = features['segment'] # segment is the same as position_ids
-            features['segment'] = [BehrtAdapter.convert_segment(segments) for segments in features['segment']]
+            features['segment'] = BehrtAdapter.convert_segments_batch(features['segment'])
         return features
     
     @staticmethod
     def convert_ages_to_int(ages: list, min_age=0, max_age=120) -> list:
         """Convert ages to int and replace negative values with 0 and values over 119 with 119"""
-        converted_ages = []
-        for age in ages:
-            if age < min_age:
-                age = min_age
-            elif age > max_age:
-                age = max_age
-            converted_ages.append(int(age))
-        return converted_ages
+        return BaseAdapter.convert_ages_to_int_batch([ages], min_age, max_age)[0]
+
+    @staticmethod
+    def convert_ages_to_int_batch(ages: List[list], min_age=0, max_age=120) -> List[list]:
+        """convert_ages_to_int for all patients, in one pass over the flat ages"""
+        flat_ages, offsets = flatten(ages)
+        return unflatten(np.clip(flat_ages, min_age, max_age).astype(np.int64), offsets)
 
     @staticmethod
     def convert_segment(segments: list) -> list:
         """From segment AABBCC to segment 001100111"""
-        converted_segments = []
-        flag = 0
-
-        for i in range(len(segments)):
-            converted_segments.append(flag)
+        return BaseAdapter.convert_segments_batch([segments])[0]
 
-            # Check if we're not at the last segment
-            if i != len(segments) - 1:
-                current_segment = segments[i]
-                next_segment = segments[i + 1]
-
-                # Check if the current segment is different from the next one
-                if current_segment != next_segment:
-                    flag = 1 - flag
+    @staticmethod
+    def convert_segments_batch(segments: List[list]) -> List[list]:
+        """convert_segment for all patients: the flag is toggled by a cumulative XOR of the segment changes within every patient"""
+        flat_segments, offsets = flatten(segments)
+        changes = np.zeros(len(flat_segments), dtype=np.int64)
+        changes[1:] = flat_segments[1:] != flat_segments[:-1]
+        lengths = np.diff(offsets)
+        starts = offsets[:-1][lengths > 0]
+        changes[starts] = 0 # No change at the first segment of a patient
+        flags = np.bitwise_xor.accumulate(changes)
+        # Undo the flags accumulated over the previous patients
+        flags ^= np.repeat(flags[starts], lengths[lengths > 0])
+        return unflatten(flags, offsets)
 
-        return converted_segments
 class BehrtAdapter(BaseAdapter):
     @staticmethod
     def adapt_features(features: dict)->dict:
@@ -78,27 +76,37 @@ class PLOSAdapter:
 
     def get_prolonged_length_of_stay(self,features: dict)->dict:
         """Calculate whether any hospital stay, which was longer than N days occured"""
-        
-        prolonged_lengths_of_stay = []
-        logger.info("Examples of plos calculation")
-        for patient in iter_patients(features):
-            prolonged_lengths_of_stay.append(
-                self.get_prolonged_length_of_stay_for_patient(patient))
+        segments, offsets = flatten(features['segment'])
+        abspos, _ = flatten(features['abspos'])
+        prolonged_lengths_of_stay = self._get_prolonged_length_of_stay(segments, abspos, offsets).tolist()
         logger.info(f'Prevalence of prolonged length of stay: {sum(prolonged_lengths_of_stay)/len(prolonged_lengths_of_stay)}')
         features['PLOS'] = prolonged_lengths_of_stay
         return features
     
     def get_prolonged_length_of_stay_for_patient(self, patient):
         """Check if any hospital stay was longer than N days"""
-        segments = np.array(patient['segment'])
-        abspos = np.array(patient['abspos'])
-        segments_one_hot = Utilities.get_segments_one_hot(segments)
-        segment_abspos = segments_one_hot * abspos
-        min_values = np.where(segment_abspos != 0, segment_abspos, np.inf).min(axis=1)
-        max_values = np.where(segment_abspos != 0, segment_abspos, -np.inf).max(axis=1)
-        diff = max_values - min_values
-
-        return (diff > self.threshold_in_hours).any().astype(int)
+        segments, abspos = np.array(patient['segment']), np.array(patient['abspos'])
+        return self._get_prolonged_length_of_stay(segments, abspos, np.array([0, len(segments)]))[0]
+
+    def _get_prolonged_length_of_stay(self, segments: np.ndarray, abspos: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+        """
+        PLOS of every patient from the flat segments and abspos of all patients.
+        The stay of a segment spans from its min to its max abspos, abspos 0 is not part of any stay.
+        """
+        patients = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        valid = abspos != 0
+        segments, abspos, patients = segments[valid], abspos[valid], patients[valid]
+        order = np.lexsort((segments, patients))
+        segments, abspos, patients = segments[order], abspos[order], patients[order]
+
+        is_new = np.ones(len(segments), dtype=bool)
+        is_new[1:] = (segments[1:] != segments[:-1]) | (patients[1:] != patients[:-1])
+        stay_starts = np.flatnonzero(is_new)
+        plos = np.zeros(len(offsets) - 1, dtype=np.int64)
+        if len(stay_starts):
+            length_of_stay = np.maximum.reduceat(abspos, stay_starts) - np.minimum.reduceat(abspos, stay_starts)
+            plos[patients[stay_starts[length_of_stay > self.threshold_in_hours]]] = 1
+        return plos
     
 class DiscreteAbsposAdapter(BaseAdapter):
     @staticmethod
@@ -109,9 +117,8 @@ class DiscreteAbsposAdapter(BaseAdapter):
         if 'abspos' in features:
             # max_abpos = DiscreteAbsposAdapter.get_maximum(features['abspos'])
             # max_abspos_months = DiscreteAbsposAdapter.hours2months(max_abpos) 
-            features['abspos'] = [DiscreteAbsposAdapter.convert_abspos(
-                 abspos, min_abspos=MIN_ABSPOS_MONTHS, max_abspos=MAX_ABSPOS_MONTHS) \
-                    for abspos in features['abspos']]
+            features['abspos'] = DiscreteAbsposAdapter.convert_abspos_batch(
+                 features['abspos'], min_abspos=MIN_ABSPOS_MONTHS, max_abspos=MAX_ABSPOS_MONTHS)
         return features
 
     @staticmethod
@@ -126,18 +133,15 @@ class DiscreteAbsposAdapter(BaseAdapter):
         2. Cutoff values with min_abspos and max_abspos given in months
         3. Map values to 0 to min_abpos+max_abspos.
         """
-        converted_abspos = []
-        for pos in abspos:
-            pos = DiscreteAbsposAdapter.hours2months(pos)
-            if pos < min_abspos:
-                pos = min_abspos
-            elif pos > max_abspos: # this should not occur since we're using the maximum value
-                pos = max_abspos
-            pos = ceil(pos) # round up 
-            min_abspos = floor(min_abspos) # round down to make sure, we're not getting negative values
-            pos = pos - min_abspos
-            converted_abspos.append(pos)
-        return converted_abspos
+        return DiscreteAbsposAdapter.convert_abspos_batch([abspos], min_abspos, max_abspos)[0]
+
+    @staticmethod
+    def convert_abspos_batch(abspos: List[list], min_abspos: float=None, max_abspos: float=None) -> List[list]:
+        """convert_abspos for all patients, in one pass over the flat abspos"""
+        flat_abspos, offsets = flatten(abspos)
+        months = np.clip(DiscreteAbsposAdapter.hours2months(flat_abspos.astype(np.float64)), min_abspos, max_abspos)
+        # Round up, min_abspos is rounded down to make sure, we're not getting negative values
+        return unflatten(np.ceil(months).astype(np.int64) - floor(min_abspos), offsets)
     
     @staticmethod
     def hours2months(hours: float)->float:
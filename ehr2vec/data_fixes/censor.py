@@ -1,11 +1,77 @@
 import random
+from itertools import chain
+from typing import List, Tuple, Union
+
+import numpy as np
 import pandas as pd
-from typing import List, Union
 
-from ehr2vec.common.utils import iter_patients
+from ehr2vec.common.ragged import RaggedFeatures, RaggedSlices
+from ehr2vec.common.vocabulary import VocabularyIndex
 from ehr2vec.data_fixes.exclude import Excluder
 
 
+def get_sorted_tails(abspos: np.ndarray, offsets: np.ndarray, prefix: np.ndarray) -> np.ndarray:
+    """Whether the abspos of every patient is sorted after its prefix, nans count as unsorted"""
+    lengths = np.diff(offsets)
+    patient_indices = np.repeat(np.arange(len(lengths)), lengths)
+    decreasing = np.flatnonzero(~(abspos[1:] >= abspos[:-1])) + 1 # Index of the later item
+    decreasing = decreasing[decreasing - offsets[patient_indices[decreasing]] > prefix[patient_indices[decreasing]]]
+    return np.bincount(patient_indices[decreasing], minlength=len(lengths)) == 0
+
+
+def search_cuts(abspos: np.ndarray, offsets: np.ndarray, prefix: np.ndarray,
+                censor_timestamps: np.ndarray, n_hours: Union[float, np.ndarray]) -> np.ndarray:
+    """
+    Cut indices of one or many horizons per patient from the flat abspos of all patients.
+    For censor time censor_timestamps[i, h] the first cuts[i, h] items of patient i are kept: its prefix and the items before
+    the first one with abspos - censor_timestamp - n_hours > 0. A missing censor time keeps the whole patient.
+    The horizons of all patients whose abspos is sorted after the prefix are found with one binary search over keys
+    that order the items by patient and abspos, the remaining patients are compared item by item.
+    """
+    censor_timestamps = np.asarray(censor_timestamps, dtype=float)
+    single_horizon = censor_timestamps.ndim == 1
+    censor_timestamps = censor_timestamps.reshape(len(offsets) - 1, -1)
+    n_hours = np.broadcast_to(np.asarray(n_hours, dtype=float), censor_timestamps.shape)
+    lengths = np.diff(offsets)
+    cuts = np.repeat(lengths[:, None], censor_timestamps.shape[1], axis=1)
+    sorted_tails = get_sorted_tails(abspos, offsets, prefix)
+    censored = ~np.isnan(censor_timestamps)
+
+    patients, horizons = np.nonzero(censored & sorted_tails[:, None])
+    if len(patients):
+        events, hours = censor_timestamps[patients, horizons], n_hours[patients, horizons]
+        tail_starts, tail_ends = offsets[patients] + prefix[patients], offsets[patients + 1]
+        # Key of an item: patient * stride + rank of its abspos among the abspos and thresholds, 0 outside the searched tails
+        patient_indices = np.repeat(np.arange(len(lengths)), lengths)
+        in_tail = (np.arange(len(abspos)) - offsets[patient_indices] >= prefix[patient_indices]) & sorted_tails[patient_indices]
+        n_tail = np.count_nonzero(in_tail)
+        values, ranks = np.unique(np.concatenate([abspos[in_tail], events + hours]), return_inverse=True)
+        stride = len(values) + 1
+        keys = patient_indices * stride
+        keys[in_tail] += ranks[:n_tail] + 1
+        positions = np.searchsorted(keys, patients * stride + ranks[n_tail:] + 1, side='right')
+        # The search uses the summed threshold, the kept items are decided by the difference as in Censorer.censor
+        for step in (1, -1):
+            while True:
+                index = positions if step == 1 else positions - 1
+                movable = (index >= tail_starts) & (index < tail_ends)
+                kept = abspos[index[movable]] - events[movable] - hours[movable] <= 0
+                movable[movable] = kept if step == 1 else ~kept
+                if not movable.any():
+                    break
+                positions = positions + step * movable
+        cuts[patients, horizons] = positions - offsets[patients]
+
+    for i in np.flatnonzero(censored.any(axis=1) & ~sorted_tails):
+        tail = abspos[offsets[i] + prefix[i]:offsets[i + 1]]
+        patient_horizons = censored[i]
+        events, hours = censor_timestamps[i, patient_horizons], n_hours[i, patient_horizons]
+        after = ~(tail[None, :] - events[:, None] - hours[:, None] <= 0)
+        cuts[i, patient_horizons] = prefix[i] + np.where(after.any(axis=1), after.argmax(axis=1), len(tail))
+
+    return cuts[:, 0] if single_horizon else cuts
+
+
 class Censorer:
     def __init__(self, n_hours: int, min_len: int = 3, vocabulary:dict=None) -> None:
         """Censor the features based on the event timestamp.
@@ -14,7 +80,12 @@ class Censorer:
         self.vocabulary = vocabulary
         self.excluder = Excluder(min_len=min_len, vocabulary=vocabulary)
 
+    @property
+    def vocabulary_index(self) -> VocabularyIndex:
+        return VocabularyIndex.get(self.vocabulary or {})
+
     def __call__(self, features: dict, censor_outcomes: list, exclude: bool = True) -> tuple:
+        censor_outcomes = self.get_censor_outcomes(censor_outcomes)
         features = self.censor(features, censor_outcomes)
         if exclude:
             features, _, kept_indices = self.excluder(features, None)
@@ -23,79 +94,101 @@ class Censorer:
             return features, censor_outcomes
 
     def censor(self, features: dict, censor_outcomes: list) -> dict:
-        censored_features = {key: [] for key in features}
-        for i, patient in enumerate(iter_patients(features)):
-            censor_timestamp = censor_outcomes[i]
-            censored_patient = self._censor(patient, censor_timestamp)
-
-            # Append to censored features
-            for key, value in censored_patient.items():
-                censored_features[key].append(value)
+        """
+        Censors all patients of the batch at once. The kept items of a patient are its background prefix
+        ([CLS], background and [SEP]) and the items up to the event, found by binary search on its abspos, which is sorted after the prefix.
+        Patients are cut by slicing, patients whose abspos is not sorted are censored with the full censor flags.
+        """
+        events = np.array([np.nan if pd.isna(t) else t for t in censor_outcomes], dtype=float)
+        patients = np.flatnonzero(~np.isnan(events))
+        censored_features = {key: list(values) for key, values in features.items()}
+        if len(patients) == 0:
+            return censored_features
+
+        concepts = [features['concept'][i] for i in patients]
+        lengths = np.array([len(c) for c in concepts], dtype=np.int64)
+        offsets = np.zeros(len(patients) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        starts = offsets[:-1]
+        abspos = np.fromiter(chain.from_iterable(features['abspos'][i] for i in patients), dtype=float, count=offsets[-1])
+        flags = self._get_background_flags(list(chain.from_iterable(concepts)), starts, lengths)
+
+        # The cut can only be found by binary search if no items after the flagged prefix are flagged and abspos is sorted after it
+        prefix, only_prefix = self._get_flagged_prefix(flags, offsets)
+        sorted_tail = only_prefix & get_sorted_tails(abspos, offsets, prefix)
+        cuts = search_cuts(abspos, offsets, prefix, events[patients], self.n_hours)
+
+        for j, i in enumerate(patients):
+            if sorted_tail[j]:
+                for key in features:
+                    censored_features[key][i] = features[key][i][:cuts[j]]
+            else:
+                patient_abspos = abspos[starts[j]:starts[j] + lengths[j]]
+                keep = (patient_abspos - events[i] - self.n_hours <= 0) | flags[starts[j]:starts[j] + lengths[j]]
+                for key in features:
+                    censored_features[key][i] = [item for item, kept in zip(features[key][i], keep) if kept]
 
         return censored_features
 
-    def _censor(self, patient: dict, event_timestamp: float) -> dict:
-        """Censor the patient's features based on the event timestamp."""
-        if not pd.isna(event_timestamp):
-            # Extract the attention mask and determine the number of non-masked items
-            attention_mask = patient["attention_mask"]
-            num_non_masked = attention_mask.count(1)
-
-            # Extract absolute positions and concepts for non-masked items
-            absolute_positions = patient["abspos"][:num_non_masked]
-            concepts = patient["concept"][:num_non_masked]
-
-            # Determine if the concepts are tokenized and if they are background
-            tokenized_flag = self._identify_if_tokenized(concepts)
-            background_flags = self._identify_background(concepts, tokenized_flag)
-            
-            # Determine which items to censor based on the event timestamp and background flags
-            censor_flags = self._generate_censor_flags(absolute_positions, background_flags, event_timestamp)
-        
-            for key, value in patient.items():
-                patient[key] = [item for index, item in enumerate(value) if censor_flags[index]]
-                
-        return patient
-    
-    def _generate_censor_flags(self, absolute_positions: List[float], background_flags: List[bool], event_timestamp: float) -> List[bool]:
-        """Generate flags indicating which items to censor."""
-        return [
-            position - event_timestamp - self.n_hours <= 0 or is_background
-            for position, is_background in zip(absolute_positions, background_flags)
-        ]
-
-    def _identify_background(self, concepts: List[Union[int, str]], tokenized_flag: bool) -> List[bool]:
+    def cut_indices(self, features: RaggedFeatures, censor_timestamps: np.ndarray, n_hours: Union[float, np.ndarray] = None) -> np.ndarray:
         """
-        Identify background items in the patient's concepts.
-        Return a list of booleans of the same length as concepts indicating if each item is background.
+        Cut index of every patient for one or many horizons, see search_cuts. censor_timestamps has a row per patient and
+        n_hours, which defaults to the n_hours of the censorer, one value per horizon or per patient and horizon.
+        The kept prefix is the flagged background prefix, flagged items after it are cut like any other item.
         """
-        if tokenized_flag:
-            bg_values = set([v for k, v in self.vocabulary.items() if k.startswith('BG_')])
-            flags = [concept in bg_values for concept in concepts]
-            first_background = flags.index(True)
+        flags = self._get_background_flags(features.values['concept'], features.offsets[:-1], features.lengths())
+        prefix, _ = self._get_flagged_prefix(flags, features.offsets)
+        n_hours = self.n_hours if n_hours is None else n_hours
+        return search_cuts(features.values['abspos'], features.offsets, prefix, censor_timestamps, n_hours)
+
+    def censor_horizons(self, features: RaggedFeatures, censor_timestamps: np.ndarray, n_hours: Union[float, np.ndarray] = None) -> List[RaggedSlices]:
+        """Censors the features at every horizon at once. Horizons are views of the value arrays of features, nothing is copied."""
+        cuts = self.cut_indices(features, censor_timestamps, n_hours).reshape(len(features), -1)
+        return [features.head(cuts[:, horizon]) for horizon in range(cuts.shape[1])]
+
+    def _get_background_flags(self, concepts: Union[list, np.ndarray], starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+        """Background flags of the flat concepts of all patients, the [CLS] and the [SEP] after the first background item are flagged too."""
+        if len(concepts) and isinstance(concepts[0], (int, np.integer)):
+            ids = np.fromiter(concepts, dtype=np.int64, count=len(concepts))
+            flags = VocabularyIndex.lookup(self.vocabulary_index.is_background, ids)
+            cls_token, sep_token = self.vocabulary.get('[CLS]'), self.vocabulary.get('[SEP]')
         else:
-            flags = [concept.startswith('BG_') for concept in concepts]
-
-        # Dont censor [CLS] and [SEP] tokens of background
-        first_background = flags.index(True)
-        if concepts[0] == '[CLS]' or concepts[0] == self.vocabulary.get('[CLS]'):
-            flags[0] = True
-        if concepts[first_background+1] == '[SEP]' or concepts[first_background+1] == self.vocabulary.get('[SEP]'):
-            flags[first_background+1] = True
-
+            ids = np.array(concepts, dtype=object)
+            flags = pd.Series(ids, dtype=object).str.startswith('BG_').fillna(False).to_numpy(dtype=bool)
+            cls_token, sep_token = '[CLS]', '[SEP]'
+
+        background = np.flatnonzero(flags)
+        nonempty = starts[lengths > 0]
+        flags[nonempty[ids[nonempty] == cls_token]] = True
+        if len(background):
+            patient_indices = np.repeat(np.arange(len(starts)), lengths)
+            background_patients, first = np.unique(patient_indices[background], return_index=True)
+            after_first = background[first] + 1
+            after_first = after_first[after_first < (starts + lengths)[background_patients]]
+            flags[after_first[ids[after_first] == sep_token]] = True
         return flags
 
+    def get_censor_outcomes(self, censor_outcomes: list) -> list:
+        """Censor times used for the patients"""
+        return censor_outcomes
+
     @staticmethod
-    def _identify_if_tokenized(concepts:list) -> bool:
-        """Identify if the features are tokenized."""
-        return concepts and isinstance(concepts[0], int)
+    def _get_flagged_prefix(flags: np.ndarray, offsets: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Length of the prefix of flagged items of every patient, and whether no items after the prefix are flagged"""
+        lengths = np.diff(offsets)
+        patient_indices = np.repeat(np.arange(len(lengths)), lengths)
+        prefix = lengths.copy()
+        unflagged = np.flatnonzero(~flags)
+        unflagged_patients, first = np.unique(patient_indices[unflagged], return_index=True)
+        prefix[unflagged_patients] = unflagged[first] - offsets[unflagged_patients]
+        only_prefix = np.bincount(patient_indices[flags], minlength=len(lengths)) == prefix
+        return prefix, only_prefix
 
 
 class EQ_Censorer(Censorer):
-        
-    def __call__(self, features: dict, censor_outcomes: list, exclude: bool = True) -> dict:
-        censor_outcomes = self.get_censor_outcomes_for_negatives(censor_outcomes)
-        return super().__call__(features, censor_outcomes, exclude)
+
+    def get_censor_outcomes(self, censor_outcomes: list) -> list:
+        return self.get_censor_outcomes_for_negatives(censor_outcomes)
 
     @staticmethod
     def get_censor_outcomes_for_negatives(censor_outcomes: list) -> list:
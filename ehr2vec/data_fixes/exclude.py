@@ -1,6 +1,13 @@
+import numpy as np
 import pandas as pd
+from itertools import chain
 from typing import Tuple
 
+from ehr2vec.common.ragged import RaggedFeatures, segment_sum
+from ehr2vec.common.vocabulary import VocabularyIndex
+
+SPECIAL_PREFIXES = ('[', 'BG_')
+
 
 class Excluder:
     def __init__(self, min_len: int, vocabulary: dict=None):
@@ -22,22 +29,33 @@ class Excluder:
             outcomes = [outcomes[i] for i in kept_indices]
         return features, outcomes, kept_indices
 
+    def exclude_ragged(self, features: RaggedFeatures) -> Tuple[RaggedFeatures, list]:
+        """Excludes patients with less than min_len concepts from ragged features. Returns the kept features and indices."""
+        kept_indices = np.flatnonzero(self.count_codes(features.values['concept'], features.offsets) >= self.min_len)
+        return features.select(kept_indices), kept_indices.tolist()
+
     def _exclude(self, features: dict) -> list:
-        kept_indices = []
-        tokenized_features = self._is_tokenized(features['concept'])
-        
-        if tokenized_features:
-            special_tokens = set([idx for key, idx in self.vocabulary.items() if key.startswith(('[', 'BG_'))])
-            is_special = lambda x: x in special_tokens
+        concepts_list = features['concept']
+        offsets = np.zeros(len(concepts_list) + 1, dtype=np.int64)
+        np.cumsum([len(concepts) for concepts in concepts_list], out=offsets[1:])
+        if self._is_tokenized(concepts_list):
+            concepts = np.fromiter(chain.from_iterable(concepts_list), dtype=np.int64, count=offsets[-1])
         else:
-            is_special = lambda x: x.startswith(('[', 'BG_'))
-        
-        for i, concepts in enumerate(features['concept']):
-            codes = [code for code in concepts if not is_special(code)]
-            if len(codes) >= self.min_len:
-                kept_indices.append(i)
+            concepts = np.array(list(chain.from_iterable(concepts_list)), dtype=object)
+        return np.flatnonzero(self.count_codes(concepts, offsets) >= self.min_len).tolist()
+
+    def count_codes(self, concepts: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+        """Number of concepts that are not special tokens ([CLS], [SEP], background, ...) of every patient, from the flat concepts of all patients."""
+        if concepts.dtype.kind in 'iu':
+            is_code = ~self._get_special_lookup(concepts)
+        else:
+            is_code = ~pd.Series(concepts, dtype=object).str.startswith(SPECIAL_PREFIXES).fillna(False).to_numpy(dtype=bool)
+        return segment_sum(is_code, offsets)
 
-        return kept_indices
+    def _get_special_lookup(self, concepts: np.ndarray) -> np.ndarray:
+        """Special token flags of tokenized concepts, with one gather from the mask of the vocabulary index"""
+        index = VocabularyIndex.get(self.vocabulary)
+        return index.lookup(index.prefix_mask(SPECIAL_PREFIXES), concepts)
     
     @staticmethod
     def _is_tokenized(concepts_list: list) -> bool:
@@ -50,4 +68,3 @@ class Excluder:
                 return isinstance(concepts[0], int)
         return False
     
-
@@ -1,4 +1,8 @@
+import numpy as np
 import pandas as pd
+from typing import Union
+
+from ehr2vec.common.ragged import RaggedFeatures, segmented_dense_rank
 
 
 class Handler:
@@ -9,52 +13,53 @@ class Handler:
     def __call__(self, features: dict) -> dict:
         return self.handle(features)
 
-    def handle(self, features: dict) -> dict:
-        """Handle the features, including: incorrect ages, nans, and segments."""
-        handled_patients = {k: [] for k in features}
-        for patient in self._iter_patients(features):
-            patient = self.handle_incorrect_ages(patient, min_age=self.min_age, max_age=self.max_age)
-
-            patient = self.handle_nans(patient)
-            if 'segment' in patient:
-                patient['segment'] = self.normalize_segments(patient['segment'])
+    def handle(self, features: Union[dict, RaggedFeatures]) -> Union[dict, RaggedFeatures]:
+        """Handle the features, including: incorrect ages, nans, and segments. Returns the layout it is given."""
+        if isinstance(features, dict):
+            return self.handle_ragged(RaggedFeatures.from_lists(features)).to_lists()
+        return self.handle_ragged(features)
 
-            for key, values in patient.items():
-                handled_patients[key].append(values)
+    def handle_ragged(self, features: RaggedFeatures) -> RaggedFeatures:
+        """Handles all patients at once: one keep mask from the ages and nans of all features, then segments are renumbered per patient."""
+        keep = self._get_age_mask(features.values['age'], self.min_age, self.max_age)
+        for values in features.values.values():
+            keep &= ~pd.isna(values)
 
-        return handled_patients
+        features = features.mask(keep)
+        if 'segment' in features.values:
+            features.values['segment'] = segmented_dense_rank(
+                features.values['segment'], features.patient_indices(), features.offsets)
+        return features
 
     @staticmethod
-    def handle_incorrect_ages(patient: dict, min_age: int = -1, max_age: int = 120) -> dict:
-        correct_indices = set([i for i, age in enumerate(patient['age']) if min_age <= age <= max_age])
-        
-        for key, values in patient.items():
-            patient[key] = [values[i] for i in correct_indices]
-
-        return patient
+    def _get_age_mask(ages: np.ndarray, min_age: int, max_age: int) -> np.ndarray:
+        """Items with an age in [min_age, max_age], nan ages are not kept"""
+        keep = np.zeros(len(ages), dtype=bool)
+        not_nan = ~pd.isna(ages)
+        valid_ages = ages[not_nan].astype(float)
+        keep[not_nan] = (min_age <= valid_ages) & (valid_ages <= max_age)
+        return keep
 
     @staticmethod
-    def handle_nans(patient: dict) -> dict:
-        nan_indices = []
-        for values in patient.values():
-            nan_indices.extend([i for i, v in enumerate(values) if pd.isna(v)])
-
-        nan_indices = set(nan_indices)
+    def _mask_patient(patient: dict, keep: np.ndarray) -> dict:
         for key, values in patient.items():
-            patient[key] = [v for i, v in enumerate(values) if i not in nan_indices]
-
+            patient[key] = np.array(values, dtype=object)[keep].tolist()
         return patient
 
     @staticmethod
-    def normalize_segments(segments: list) -> list:
-        segment_set = sorted(set(segments))
-        correct_segments = list(range(len(segment_set)))
-        converter = {k: v for (k,v) in zip(segment_set, correct_segments)}
+    def handle_incorrect_ages(patient: dict, min_age: int = -1, max_age: int = 120) -> dict:
+        """The age filter of handle_ragged for one patient"""
+        keep = Handler._get_age_mask(np.array(patient['age'], dtype=object), min_age, max_age)
+        return Handler._mask_patient(patient, keep)
 
-        return [converter[segment] for segment in segments]
-    
     @staticmethod
-    def _iter_patients(features: dict) -> dict:
-        for i in range(len(features['concept'])):
-            yield {k: v[i] for k, v in features.items()}
+    def handle_nans(patient: dict) -> dict:
+        """The nan filter of handle_ragged for one patient"""
+        keep = np.logical_and.reduce([~pd.isna(np.array(values, dtype=object)) for values in patient.values()])
+        return Handler._mask_patient(patient, keep)
 
+    @staticmethod
+    def normalize_segments(segments: list) -> list:
+        """The segment renumbering of handle_ragged for one patient"""
+        segments = np.asarray(segments)
+        return segmented_dense_rank(segments, np.zeros(len(segments), dtype=np.int64), np.array([0, len(segments)])).tolist()
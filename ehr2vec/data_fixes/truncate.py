@@ -1,4 +1,9 @@
-from ehr2vec.common.utils import iter_patients
+from typing import Callable
+
+import numpy as np
+
+from ehr2vec.common.ragged import RaggedFeatures, range_positions
+from ehr2vec.common.vocabulary import VocabularyIndex
 
 class Truncator:
     def __init__(self, max_len: int, vocabulary: dict) -> None:
@@ -10,13 +15,49 @@ class Truncator:
         return self.truncate(features)
 
     def truncate(self, features: dict) -> dict:
-        background_length = self._get_background_length(features)
-        for index, patient in enumerate(iter_patients(features)):
-            truncated_patient = self._truncate_patient(patient, background_length)
-            for key, value in truncated_patient.items():
-                features[key][index] = value
+        """Truncates the patients longer than max_len in place, the sequence features of all patients are gathered at once by truncate_ragged."""
+        sequences = {key: values for key, values in features.items() if len(values) == 0 or isinstance(values[0], (list, tuple, np.ndarray))}
+        for key, values in self.truncate_ragged(RaggedFeatures.from_lists(sequences)).to_lists().items():
+            features[key] = values
         return features
 
+    def truncate_ragged(self, features: RaggedFeatures) -> RaggedFeatures:
+        """Truncates ragged features: the background prefix and tail window of every patient are gathered as index ranges in one operation."""
+        if len(features) == 0:
+            return features
+        concepts, starts, lengths = features.values['concept'], features.offsets[:-1], features.lengths()
+        background_length = self._get_background_length({'concept': [concepts[starts[0]:starts[0] + lengths[0]].tolist()]})
+        long_patients = lengths > self.max_len
+        tail_starts = np.zeros(len(features), dtype=np.int64)
+        tail_starts[long_patients] = self._get_tail_starts(
+            lengths[long_patients], background_length, lambda positions: concepts[starts[long_patients] + positions])
+        head_lengths = np.where(long_patients, np.minimum(background_length, lengths), 0)
+
+        # Every patient is two index ranges: its background prefix (empty if not truncated) and its tail window
+        range_starts = np.column_stack([starts, starts + tail_starts]).ravel()
+        range_lengths = np.column_stack([head_lengths, lengths - tail_starts]).ravel()
+        positions = range_positions(range_starts, range_lengths)
+        offsets = np.zeros(len(features) + 1, dtype=np.int64)
+        np.cumsum(head_lengths + lengths - tail_starts, out=offsets[1:])
+        return RaggedFeatures({key: values[positions] for key, values in features.values.items()}, offsets)
+
+    def _get_tail_starts(self, lengths: np.ndarray, background_length: int, get_concepts: Callable[[np.ndarray], np.ndarray]) -> np.ndarray:
+        """
+        Start of the kept tail, value[-truncation_length:], of patients longer than max_len.
+        get_concepts(positions) returns the concept at the given position of every patient.
+        """
+        truncation_lengths = np.full(len(lengths), self.max_len - background_length, dtype=np.int64)
+        # Do not start seq with [SEP] token (SEP token is included in background sentence)
+        if len(lengths):
+            starts_with_sep = get_concepts(self._normalize_index(-truncation_lengths, lengths)) == self.sep_token
+            truncation_lengths -= starts_with_sep
+        return np.clip(self._normalize_index(-truncation_lengths, lengths), 0, lengths)
+
+    @staticmethod
+    def _normalize_index(index: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+        """Python list index, negative indices count from the end"""
+        return np.where(index < 0, index + lengths, index)
+
     def _truncate_patient(self, patient: dict, background_length: int) -> dict:
         """Truncate patient to max_len, keeping background if present and CLS if present."""
         # Do not truncate if patient is shorter than max_len
@@ -36,10 +77,10 @@ class Truncator:
 
     def _get_background_length(self, features: dict)-> int:
         """Get the length of the background sentence, first SEP token included."""
-        background_tokens = set([v for k, v in self.vocabulary.items() if k.startswith('BG_')])
         example_concepts = features['concept'][0] # Assume that all patients have the same background length
         cls_token_int = int(example_concepts[0] == self.vocabulary.get("[CLS]"))
-        background_length = len(set(example_concepts) & background_tokens)
+        index = VocabularyIndex.get(self.vocabulary)
+        concepts = np.asarray(example_concepts, dtype=np.int64)
+        background_length = len(np.unique(concepts[index.lookup(index.is_background, concepts)]))
 
         return background_length + int((background_length > 0) and self.sep_token is not None) + cls_token_int
-
@@ -39,6 +39,17 @@ class OutcomeMaker:
 
         return outcomes
     
+    def required_columns(self)->list:
+        """Return the concept columns needed to match the outcomes, used for column projection when loading."""
+        columns = ['PID', 'TIMESTAMP']
+        for attrs in self.outcomes.values():
+            if attrs['type'] == 'patients_info':
+                continue
+            if 'exclude' in attrs:
+                columns.append('CONCEPT')
+            columns.extend(attrs['type'])
+        return list(dict.fromkeys(columns))
+
     @staticmethod
     def remove_missing_timestamps(concepts_plus: pd.DataFrame )->pd.DataFrame:
         return concepts_plus[concepts_plus.TIMESTAMP.notna()]
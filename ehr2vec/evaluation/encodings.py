@@ -11,6 +11,7 @@ from tqdm import tqdm
 
 from ehr2vec.common.config import get_function, instantiate
 from ehr2vec.common.logger import TqdmToLogger
+from ehr2vec.common.vocabulary import VocabularyIndex
 from ehr2vec.dataloader.collate_fn import dynamic_padding
 from ehr2vec.trainer.trainer import EHRTrainer
 from ehr2vec.trainer.utils import compute_avg_metrics, get_tqdm
@@ -175,14 +176,14 @@ class Forwarder(EHRTrainer):
     @staticmethod
     def store_to_df(data: dict, data_path: str)->pd.DataFrame:
         """Store data in dataframe, get concept names and change dtype to reduce memory use."""
-        vocab = torch.load(join(split(data_path)[0], 'vocabulary.pt'))
-        inv_vocab = {v:k for k,v in vocab.items()}
+        vocabulary_path = join(split(data_path)[0], 'vocabulary.pt')
+        vocabulary_index = VocabularyIndex.load(torch.load(vocabulary_path), vocabulary_path)
         info_cols = [k for k in data.keys() if not k.startswith('P_')]
         df = pd.DataFrame(data)
         for info_col in info_cols:
             if info_col!='abspos':
                 df[info_col] = df[info_col].astype('int16')
-        df['concept_name'] = df.concept.map(inv_vocab) 
+        df['concept_name'] = vocabulary_index.decode(df.concept.to_numpy())
         return df    
     
     @staticmethod
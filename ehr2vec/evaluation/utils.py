@@ -185,7 +185,8 @@ def save_data(data: Data, folder:str)->None:
     """Unpacks data and saves it to folder"""
     if len(data)>0:
         torch.save(data.pids, join(folder, f'{data.mode}_pids.pt'))
-        torch.save(data.features, join(folder, f'{data.mode}_features.pt'))
+        features = data.features if isinstance(data.features, dict) else data.features.to_lists()
+        torch.save(features, join(folder, f'{data.mode}_features.pt'))
         if data.outcomes is not None:
             torch.save(data.outcomes, join(folder, f'{data.mode}_outcomes.pt'))
         if data.censor_outcomes is not None:
@@ -9,17 +9,21 @@ Input: Formatted Data
 """
 import os
 import shutil
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 from os.path import join
+from typing import Tuple
 
 import torch
 from ehr2vec.common.azure import AzurePathContext, save_to_blobstore
 from ehr2vec.common.config import load_config
 from ehr2vec.common.logger import TqdmToLogger
 from ehr2vec.common.setup import DirectoryPreparer, get_args
-from ehr2vec.common.utils import check_directory_for_features
+from ehr2vec.common.utils import check_directory_for_features, get_mp_context
 from ehr2vec.data.batch import Batches, BatchTokenize
 from ehr2vec.data.concept_loader import ConceptLoaderLarge
 from ehr2vec.data.featuremaker import FeatureMaker
+from ehr2vec.data.incremental import FeatureManifest, IncrementalFeatureUpdater
 from ehr2vec.data.tokenizer import EHRTokenizer
 from ehr2vec.data_fixes.exclude import Excluder
 from ehr2vec.data_fixes.handle import Handler
@@ -28,7 +32,8 @@ from tqdm import tqdm
 CONFIG_NAME = 'data_pretrain.yaml'
 BLOBSTORE = 'PHAIR'
 
-args = get_args(CONFIG_NAME, 'data_pretrain')
+args = get_args(CONFIG_NAME, 'data_pretrain',
+                extra_args={'--workers': {'type': int, 'default': 1, 'help': 'Processes creating features and tokenizing patient batches in parallel'}})
 config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), args.config_path)
 
 
@@ -51,11 +56,14 @@ def main_data(config_path):
     
     logger.info('Initialize Processors')
     logger.info('Starting feature creation and processing')
-    if not check_directory_for_features(cfg.loader.data_dir):
-        pids = create_and_save_features(ConceptLoaderLarge(**cfg.loader), 
+    if cfg.get('incremental', False):
+        pids = create_or_update_features(cfg, logger)
+    elif not check_directory_for_features(cfg.loader.data_dir):
+        columns = FeatureMaker(cfg.features).required_columns()
+        pids = create_and_save_features(ConceptLoaderLarge(**{'columns': columns, **cfg.loader}), 
                                         Handler(**cfg.handler), 
                                         Excluder(**cfg.excluder), 
-                                        cfg, logger)
+                                        cfg, logger, workers=args.workers)
         torch.save(pids, join(cfg.output_dir, 'features', 'pids_features.pt'))
     else:
         pids = torch.load(join(cfg.loader.data_dir, 'features', 'pids_features.pt'))
@@ -69,7 +77,9 @@ def main_data(config_path):
     check_and_clear_directory(cfg, logger, tokenized_dir_name=tokenized_dir_name)
     logger.info('Tokenizing')
     tokenizer = EHRTokenizer(config=cfg.tokenizer)
-    batch_tokenize = BatchTokenize(pids, tokenizer, cfg, tokenized_dir_name=tokenized_dir_name)
+    batch_tokenize = BatchTokenize(pids, tokenizer, cfg, tokenized_dir_name=tokenized_dir_name, 
+                                   workers=args.workers, route_splits=cfg.get('route_splits', False),
+                                   shard_size=cfg.get('tokenized_shard_size', None))
     shutil.copy(config_path, join(cfg.output_dir, tokenized_dir_name,  'data_cfg.yaml'))
     
     batch_tokenize.tokenize(batches_split)
@@ -95,23 +105,161 @@ def check_and_clear_directory(cfg, logger, tokenized_dir_name='tokenized'):
             else:
                 shutil.rmtree(file_path)
 
-def create_and_save_features(conceptloader, handler, excluder, cfg, logger, )-> list:
+def create_or_update_features(cfg, logger)-> list:
+    """
+    Incremental mode: if the features in output_dir have a manifest from the same config, only patients with new or changed
+    concept rows are recomputed and their shards rewritten. Otherwise all features are created and a manifest is written.
+    """
+    features_dir = join(cfg.output_dir, 'features')
+    columns = FeatureMaker(cfg.features).required_columns()
+    conceptloader = ConceptLoaderLarge(**{'columns': columns, **cfg.loader})
+    handler, excluder = Handler(**cfg.handler), Excluder(**cfg.excluder)
+    source_paths = conceptloader.concepts_paths + conceptloader.patients_info_path
+    manifest_config = {'features': cfg.features, 'handler': cfg.handler, 'excluder': cfg.excluder, 'columns': conceptloader.columns}
+    updater = IncrementalFeatureUpdater(features_dir, 
+                                        lambda concepts, patients_info: create_batch_features(concepts, patients_info, handler, excluder, cfg.features),
+                                        manifest_config, conceptloader.batch_size)
+    if updater.is_compatible():
+        logger.info('Updating features incrementally')
+        return updater.update(conceptloader(), source_paths)
+
+    logger.info('No manifest from the same config found, creating all features')
+    updater.clear()
+    manifest = FeatureManifest(features_dir)
+    manifest.sources = FeatureManifest.get_sources(source_paths)
+    manifest.config = updater.config
+    pids = create_and_save_features(conceptloader, handler, excluder, cfg, logger, workers=args.workers, manifest=manifest)
+    torch.save(pids, join(features_dir, 'pids_features.pt'))
+    manifest.save()
+    return pids
+
+def create_and_save_features(conceptloader, handler, excluder, cfg, logger, workers: int=1, retries: int=2, manifest: FeatureManifest=None)-> list:
     """
     Creates features and saves them to disk.
+    With workers > 1, batches are processed in a process pool while the loader reads the next ones.
+    A failed batch is retried up to retries times, other batches are not affected.
+    If a manifest is given, the patient fingerprints of every shard are recorded in it.
     Returns a list of lists of pids for each batch
     """
-    pids = []
-    for i, (concept_batch, patient_batch) in enumerate(tqdm(conceptloader(), desc='Batch Process Data', file=TqdmToLogger(logger))):
-        feature_maker = FeatureMaker(cfg.features) # Otherwise appended to old features
-        features_batch, pids_batch = feature_maker(concept_batch, patient_batch)
-        features_batch = handler(features_batch)
-        features_batch, _, kept_indices  = excluder(features_batch)
-        kept_pids = [pids_batch[idx] for idx in kept_indices]
-        torch.save(features_batch, join(cfg.output_dir, 'features', f'features_{i}.pt'))
-        torch.save(kept_pids, join(cfg.output_dir, 'features', f'pids_features_{i}.pt'))
-        pids.append(kept_pids)
+    batches = conceptloader()
+    batches_iter = tqdm(manifest.record(batches) if manifest is not None else batches, desc='Batch Process Data', file=TqdmToLogger(logger))
+    if workers > 1:
+        pids = create_and_save_features_parallel(batches_iter, handler, excluder, cfg, logger, workers, retries)
+    else:
+        pids = [process_and_save_batch(i, concept_batch, patient_batch, handler, excluder, cfg.features, cfg.output_dir)
+                for i, (concept_batch, patient_batch) in enumerate(batches_iter)]
+    if hasattr(batches, 'metrics'):
+        logger.info(f'Prefetching: {batches.metrics()}')
     return pids
 
+def create_batch_features(concept_batch, patient_batch, handler, excluder, features_cfg)-> Tuple[dict, list]:
+    """Creates, handles and excludes the features of one batch. Returns the features and the kept pids."""
+    feature_maker = FeatureMaker(features_cfg) # Otherwise appended to old features
+    features_batch, pids_batch = feature_maker(concept_batch, patient_batch, ragged=True)
+    features_batch, kept_indices = excluder.exclude_ragged(handler(features_batch))
+    features_batch = features_batch.to_lists()
+    kept_pids = [pids_batch[idx] for idx in kept_indices]
+    return features_batch, kept_pids
+
+def process_and_save_batch(i, concept_batch, patient_batch, handler, excluder, features_cfg, output_dir)-> list:
+    """Creates the features of one batch and saves them as shard i. Returns the kept pids."""
+    features_batch, kept_pids = create_batch_features(concept_batch, patient_batch, handler, excluder, features_cfg)
+    torch.save(features_batch, join(output_dir, 'features', f'features_{i}.pt'))
+    torch.save(kept_pids, join(output_dir, 'features', f'pids_features_{i}.pt'))
+    return kept_pids
+
+def create_and_save_features_parallel(batches, handler, excluder, cfg, logger, workers: int, retries: int)-> list:
+    """
+    Submits batches to a process pool, keeping at most 2*workers batches in flight to bound memory.
+    Results are collected by batch index, so shard numbering and the returned order do not depend on completion order.
+    A crashed worker breaks the pool and every batch in flight with it: the pool is replaced and the lost batches
+    are rerun one at a time, so an attempt is only counted against the batch that crashes a worker.
+    """
+    results, attempts, pending = {}, {}, {}
+    mp_context = get_mp_context()
+    new_executor = lambda: ProcessPoolExecutor(max_workers=workers, mp_context=mp_context)
+    executor = new_executor()
+
+    def submit(i, batch):
+        try:
+            future = executor.submit(process_and_save_batch, i, *batch, handler, excluder, cfg.features, cfg.output_dir)
+        except BrokenProcessPool:
+            recover([])
+            return submit(i, batch)
+        pending[future] = (i, batch)
+
+    def record_failure(i, e):
+        attempts[i] = attempts.get(i, 0) + 1
+        if attempts[i] > retries:
+            executor.shutdown(cancel_futures=True)
+            raise RuntimeError(f'Batch {i} failed after {attempts[i]} attempts') from e
+        logger.warning(f'Batch {i} failed ({e!r}), retrying')
+
+    def collect(futures) -> Tuple[list, list]:
+        """Stores results of finished futures. Returns the failed batches and the batches lost with a broken pool"""
+        failed, broken = [], []
+        for future in futures:
+            i, batch = pending.pop(future)
+            try:
+                results[i] = future.result()
+            except BrokenProcessPool:
+                broken.append((i, batch))
+            except Exception as e:
+                record_failure(i, e)
+                failed.append((i, batch))
+        return failed, broken
+
+    def recover(broken: list):
+        """Replaces the broken pool. Batches lost with it are rerun in isolation unless only one was in flight."""
+        nonlocal executor
+        wait(list(pending))
+        failed, lost = collect(list(pending))
+        broken = broken + lost
+        executor.shutdown(wait=False, cancel_futures=True)
+        executor = new_executor()
+        if len(broken) == 1:
+            i, batch = broken[0]
+            record_failure(i, BrokenProcessPool('A worker crashed while processing the batch'))
+            failed.append((i, batch))
+        else:
+            for i, batch in broken:
+                run_isolated(i, batch)
+        for i, batch in failed:
+            submit(i, batch)
+
+    def run_isolated(i, batch):
+        """Runs a batch alone in the pool, so a crash can be attributed to it"""
+        nonlocal executor
+        while True:
+            future = executor.submit(process_and_save_batch, i, *batch, handler, excluder, cfg.features, cfg.output_dir)
+            try:
+                results[i] = future.result()
+                return
+            except BrokenProcessPool as e:
+                executor.shutdown(wait=False)
+                executor = new_executor()
+                record_failure(i, e)
+            except Exception as e:
+                record_failure(i, e)
+
+    def wait_for_one():
+        done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+        failed, broken = collect(done)
+        if broken:
+            recover(broken)
+        for i, batch in failed:
+            submit(i, batch)
+
+    try:
+        for i, batch in enumerate(batches):
+            submit(i, batch)
+            while len(pending) >= 2 * workers:
+                wait_for_one()
+        while pending:
+            wait_for_one()
+    finally:
+        executor.shutdown()
+    return [results[i] for i in range(len(results))]
 
 if __name__ == '__main__':
     main_data(config_path)
@@ -40,7 +40,8 @@ def main_data(config_path):
     logger.info('Mount Dataset')
     logger.info('Starting outcomes creation')
     features_cfg = load_config(join(cfg.features_dir, 'data_config.yaml'))
-    outcomes = process_data(ConceptLoaderLarge(**cfg.loader), cfg, features_cfg, logger)
+    columns = OutcomeMaker(cfg, features_cfg).required_columns()
+    outcomes = process_data(ConceptLoaderLarge(**{'columns': columns, **cfg.loader}), cfg, features_cfg, logger)
     
     torch.save(outcomes, join(cfg.paths.outcome_dir, f'{cfg.outcomes_name}.pt'))
     
@@ -6,9 +6,10 @@ import torch
 from ehr2vec.common.azure import AzurePathContext, save_to_blobstore
 from ehr2vec.common.config import get_function, instantiate, load_config
 from ehr2vec.common.setup import get_args, setup_logger
-from ehr2vec.data.prepare_data import DatasetPreparer
+from ehr2vec.data.prepare_data import DatasetPreparer, OneHotEncoder
 from ehr2vec.evaluation.utils import evaluate_predictions, get_pos_weight
 from sklearn.model_selection import train_test_split
+from sklearn.pipeline import Pipeline
 
 CONFIG_NAME = 'evaluate_one_hot.yaml'
 DEFAULT_VAL_SPLIT = 0.2
@@ -27,6 +28,7 @@ def main():
 
     model = instantiate(cfg.model)
     model_name = model.__class__.__name__
+    model = OneHotEncoder.get_model(model, OneHotEncoder.get_weighting(cfg)) # tfidf is fitted with the model on the training split
     cfg.paths.run_name = f"{model_name}_{cfg.paths.run_name}"
     run_folder=join(cfg.paths.output_path, cfg.paths.run_name)
      
@@ -35,6 +37,7 @@ def main():
     cfg.save_to_yaml(join(run_folder, 'evaluate_one_hot.yaml'))
 
     X, y, new_vocab = DatasetPreparer(cfg).prepare_onehot_features()
+    logger.info(f'One hot features: {X.shape[0]} patients x {X.shape[1]} features, {X.nnz} non-zero entries (sparse)')
     X_train, X_val, y_train, y_val = train_test_split(
         X, y, test_size=cfg.trainer_args.get('val_split',DEFAULT_VAL_SPLIT), 
         random_state=cfg.trainer_args.get('seed', 42))
@@ -43,7 +46,8 @@ def main():
     logger.info('Instantiating Model')
     sample_weight = get_pos_weight(cfg, y_train) if cfg.trainer_args.get('sample_weight', False) else None
     
-    model.fit(X_train, y_train, sample_weight=sample_weight,)
+    sample_weight_key = 'model__sample_weight' if isinstance(model, Pipeline) else 'sample_weight'
+    model.fit(X_train, y_train, **{sample_weight_key: sample_weight})
     pred_probas = model.predict_proba(X_val)[:, 1]
     metrics = [get_function(metric) for metric in cfg.metrics.values()]
     results = evaluate_predictions(y_val, pred_probas, metrics)
@@ -53,7 +57,7 @@ def main():
     results_df = pd.DataFrame(results, index=[0])
     results_df.to_csv(join(run_folder, 'results.csv'), index=False)
     try:
-        feature_importances = model.feature_importances_
+        feature_importances = (model[-1] if isinstance(model, Pipeline) else model).feature_importances_
         feature_names = ['age']
         sorted_new_vocab = {k: v for k, v in sorted(new_vocab.items(), key=lambda item: item[1])}
         feature_names = feature_names + [k for k, v in sorted_new_vocab.items()]
@@ -142,6 +142,8 @@ if __name__ == '__main__':
     
     dataset_preparer = DatasetPreparer(cfg)
     data = dataset_preparer.prepare_finetune_data()    
+    if cfg.data.get('feature_views', False):
+        data = data.to_views() # folds select index views of the features instead of copies
     
     if 'predefined_splits' in cfg.paths:
         logger.info('Using predefined splits')
@@ -1,10 +1,11 @@
-from typing import Dict, List
+from typing import List
 
 import numpy as np
 import pandas as pd
 
+from ehr2vec.common.ragged import RaggedFeatures
 from ehr2vec.common.utils import Data
-from ehr2vec.data.utils import Utilities
+from ehr2vec.data_fixes.censor import get_sorted_tails, search_cuts
 
 
 class PatientStats:
@@ -23,31 +24,61 @@ class PatientStats:
                      'visits':{name: {time: [] for time in censoring_times} for name in outcome_names},}
         return stats_dic
 
-    def calculate_statistics_for_censoring(self, patient:Dict, outcome:str, outcome_name:str, censoring_time:float):
-        """censoring_time given in hours since origin_point"""
-        censored_patient = Utilities.censor(patient, outcome - censoring_time * 30.4 * 24)
-        if len(censored_patient['concept']) < self.MIN_LEN:
-            return
+    def process_patients(self):
+        """
+        Censors all patients at all censoring times with one search, the statistics are read at the cut indices.
+        Patients whose abspos is not sorted keep all items up to the censoring time, wherever they are in the sequence.
+        """
+        features = RaggedFeatures.from_lists({key: self.data.features[key] for key in ('concept', 'age', 'abspos', 'segment')})
+        starts = features.offsets[:-1]
+        visits = self._cumulative_max(features.values['segment'], features.offsets)
+        censoring_hours = np.asarray(self.censoring_times, dtype=float) * 30.4 * 24
+        start_index = 2 if self.CLS else 1
+        no_prefix = np.zeros(len(features), dtype=np.int64)
+        sorted_patients = get_sorted_tails(features.values['abspos'], features.offsets, no_prefix)
+        for outcome_name, outcomes in self.data.outcomes.items():
+            outcomes = np.array([np.nan if pd.isna(outcome) else outcome for outcome in outcomes], dtype=float)
+            censor_timestamps = outcomes[:, None] - censoring_hours[None, :]
+            cuts = search_cuts(features.values['abspos'], features.offsets, no_prefix, censor_timestamps, 0)
+            unsorted = np.flatnonzero(~np.isnan(outcomes) & ~sorted_patients)
+            for horizon, time in enumerate(self.censoring_times):
+                patients = np.flatnonzero(~np.isnan(outcomes) & sorted_patients & (cuts[:, horizon] >= self.MIN_LEN))
+                lengths = cuts[patients, horizon]
+                last = starts[patients] + lengths - 1
+                stats = (patients, lengths, features.values['age'][last], features.values['abspos'][starts[patients] + start_index],
+                         features.values['abspos'][last], visits[last])
+                filtered = self._filtered_stats(features, unsorted, censor_timestamps[unsorted, horizon], start_index)
+                order = np.argsort(np.concatenate([patients, filtered[0]]), kind='stable')
+                _, lengths, ages, start_traj, end_traj, num_visits = (np.concatenate([a, b])[order] for a, b in zip(stats, filtered))
+                if time == 0:
+                    self.stats_dic['ages'][outcome_name].extend(ages.tolist())
 
-        if censoring_time == 0:
-            age = censored_patient['age'][-1]
-            self.stats_dic['ages'][outcome_name].append(age)
+                traj_lens = (end_traj - start_traj) / 24 / 30.4
+                self.stats_dic['visits'][outcome_name][time].extend(num_visits.tolist())
+                self.stats_dic['sequence_length'][outcome_name][time].extend((lengths - start_index).tolist())
+                self.stats_dic['trajectory'][outcome_name][time].extend([round(traj_len) for traj_len in traj_lens.tolist()])
 
-        seq_len = len(censored_patient['concept']) - (2 if self.CLS else 1)
-        start_traj = censored_patient['abspos'][2] if self.CLS else censored_patient['abspos'][1]
-        traj_len = round((censored_patient['abspos'][-1] - start_traj) / 24 / 30.4)
-        num_visits = max(censored_patient['segment'])
-        self.stats_dic['visits'][outcome_name][censoring_time].append(num_visits)
-        self.stats_dic['sequence_length'][outcome_name][censoring_time].append(seq_len)
-        self.stats_dic['trajectory'][outcome_name][censoring_time].append(traj_len)
+    def _filtered_stats(self, features: RaggedFeatures, patients: np.ndarray, censor_timestamps: np.ndarray, start_index: int) -> tuple:
+        """Patients, lengths, last ages, trajectory start and end and visits of the patients censored item by item"""
+        selected = features.select(patients)
+        keep = selected.values['abspos'] - np.repeat(censor_timestamps, selected.lengths()) <= 0
+        censored = selected.mask(keep)
+        lengths = censored.lengths()
+        long_enough = np.flatnonzero(lengths >= self.MIN_LEN)
+        starts, last = censored.offsets[long_enough], censored.offsets[long_enough + 1] - 1
+        visits = self._cumulative_max(censored.values['segment'], censored.offsets)
+        return (patients[long_enough], lengths[long_enough], censored.values['age'][last],
+                censored.values['abspos'][starts + start_index], censored.values['abspos'][last], visits[last])
 
-    def process_patients(self):
-        for patient, outcomes in Utilities.iter_patients(self.data):
-            for outcome_name, outcome in outcomes.items():
-                if pd.isna(outcome):
-                    continue
-                for time in self.censoring_times:
-                    self.calculate_statistics_for_censoring(patient, outcome, outcome_name, time)
+    @staticmethod
+    def _cumulative_max(values: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+        """Running maximum of the values of every patient"""
+        if len(values) == 0:
+            return values
+        patient_indices = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        # Shifting every patient above the previous one makes a single running maximum restart at each patient
+        shift = patient_indices * (values.max() - values.min() + 1)
+        return np.maximum.accumulate(values + shift) - shift
 
     def convert_to_numpy(self):
         for stat_type in self.stats_dic:
@@ -1,5 +1,5 @@
 import unittest
-from data_fixes.adapt import BehrtAdapter
+from data_fixes.adapt import BehrtAdapter, DiscreteAbsposAdapter, PLOSAdapter, HOURS_IN_MONTH
 
 class TestBehrtAdapter(unittest.TestCase):
 
@@ -18,6 +18,26 @@ class TestBehrtAdapter(unittest.TestCase):
         result = self.adapter.convert_segment(segments)
         self.assertEqual(result, expected_result)
 
+    def test_convert_segments_batch(self):
+        segments = [['A', 'A', 'B', 'B', 'C', 'C'], [], [0, 1, 1, 2]]
+        expected_result = [[0, 0, 1, 1, 0, 0], [], [0, 1, 1, 0]]
+        result = self.adapter.convert_segments_batch(segments)
+        self.assertEqual(result, expected_result)
+
+    def test_convert_abspos_batch(self):
+        abspos = [[-200 * HOURS_IN_MONTH, -0.5 * HOURS_IN_MONTH, 0], [50 * HOURS_IN_MONTH]]
+        expected_result = [[0, 120, 120], [157]]
+        result = DiscreteAbsposAdapter.convert_abspos_batch(abspos, min_abspos=-120, max_abspos=37)
+        self.assertEqual(result, expected_result)
+
+    def test_prolonged_length_of_stay(self):
+        features = {
+            'segment': [[0, 1, 1, 2, 2], [0, 1, 1, 2, 2], [0, 1]],
+            'abspos': [[0, 10, 30, 100, 170], [0, 10, 30, 100, 120], [0, 10]]
+        }
+        result = PLOSAdapter(threshold_in_days=2).adapt_features(features)
+        self.assertEqual(result['PLOS'], [1, 0, 0])
+
     def test_adapt_features(self):
         features = {
             'abspos': 'abspos_value',
@@ -1,7 +1,12 @@
+import os
+import tempfile
 import unittest
+import torch
 from unittest.mock import patch, MagicMock, call
+from common.config import Config
 from tests.helpers import ConfigMock
 from data.batch import Batches, BatchTokenize, Split
+from data.shards import TokenizedShards
 from data.tokenizer import EHRTokenizer
 
 class TestBatches(unittest.TestCase):
@@ -103,6 +108,55 @@ class TestBatchTokenize(unittest.TestCase):
             'attention_mask': [[1]],
         }, ['3'], 'test')
         self.assertEqual(self.batch_tokenize.save_tokenized_data.call_args_list[2], call(*expected_results3, save_dir=None))
-   
+
+    def tokenize_files(self, workers, route_splits, shard_size=None):
+        """Tokenizes two feature files, returns the vocabulary and the calls to save_tokenized_data, or the shards written"""
+        pids = [['1', '2'], ['4', '5']]
+        features = [
+            {'concept': [['BG_GENDER_MALE', 'D12', 'M1'], ['BG_GENDER_FEMALE', 'D123', 'D12']], 'segment': [[0, 1, 2], [0, 1, 1]]},
+            {'concept': [['BG_GENDER_MALE', 'M2', 'D3'], ['BG_GENDER_FEMALE', 'D4']], 'segment': [[0, 1, 1], [0, 1]]},
+        ]
+        splits = {'pretrain': Split(mode='pretrain', pids=['5', '1', '4']), 'finetune': Split(mode='finetune', pids=['2'])}
+        tokenizer_config = Config({'sep_tokens': True, 'cls_token': True, 'padding': False, 'truncation': None})
+        with tempfile.TemporaryDirectory() as features_dir:
+            for file_id, (file_features, file_pids) in enumerate(zip(features, pids)):
+                torch.save(file_features, os.path.join(features_dir, f'features_{file_id}.pt'))
+                torch.save(file_pids, os.path.join(features_dir, f'pids_features_{file_id}.pt'))
+            self.cfg.output_dir = features_dir
+            with patch('os.makedirs', return_value=None):
+                batch_tokenize = BatchTokenize(pids, EHRTokenizer(tokenizer_config), self.cfg, tokenized_dir_name='', 
+                                               workers=workers, route_splits=route_splits, shard_size=shard_size)
+            with patch.object(batch_tokenize, 'get_features_directory', return_value=features_dir), \
+                    patch.object(batch_tokenize, 'save_vocabulary'), \
+                    patch.object(batch_tokenize, 'save_tokenized_data') as save_tokenized_data:
+                batch_tokenize.tokenize(splits)
+            if shard_size:
+                saved = [(*TokenizedShards(os.path.join(features_dir, f'tokenized_{mode}')).load(), mode) for mode in splits]
+                return batch_tokenize.tokenizer.vocabulary, saved
+        return batch_tokenize.tokenizer.vocabulary, [saved.args for saved in save_tokenized_data.call_args_list]
+
+    def test_tokenize_parallel(self):
+        vocabulary, saved = self.tokenize_files(workers=2, route_splits=False)
+        # Same vocabulary ids and tokenized data as the sequential run
+        self.assertEqual((vocabulary, saved), self.tokenize_files(workers=1, route_splits=False))
+        self.assertEqual(list(vocabulary)[5:], ['BG_GENDER_MALE', 'D12', 'M1', 'M2', 'D3', 'BG_GENDER_FEMALE', 'D4'])
+
+    def test_tokenize_routed(self):
+        expected = self.tokenize_files(workers=1, route_splits=False)
+        self.assertEqual(self.tokenize_files(workers=1, route_splits=True), expected)
+        self.assertEqual(self.tokenize_files(workers=2, route_splits=True), expected)
+        self.assertEqual([pids for _, pids, _ in expected[1]], [['5', '1', '4'], ['2']])
+        self.assertEqual(expected[1][1][0]['concept'], [[1, 10, 2, 6, 6, 2]]) # D123 is encoded as its ancestor D12
+
+    def test_tokenize_sharded(self):
+        vocabulary, saved = self.tokenize_files(workers=1, route_splits=False)
+        for workers, route_splits in [(1, False), (2, False), (1, True)]:
+            sharded_vocabulary, sharded = self.tokenize_files(workers, route_splits, shard_size=2)
+            self.assertEqual(sharded_vocabulary, vocabulary)
+            # Patients are stored in the order they were tokenized, file order, instead of the order of split.pids
+            self.assertEqual([pids for _, pids, _ in sharded], [['1', '4', '5'], ['2']])
+            self.assertEqual(sharded[0][0]['concept'], [saved[0][0]['concept'][i] for i in (1, 2, 0)])
+            self.assertEqual(sharded[1][0], saved[1][0])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,63 @@
+import os
+import tempfile
+import unittest
+
+import pandas as pd
+from data.cache import FormattedDataCache
+
+
+class TestFormattedDataCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.tmp_dir.name, 'concept.diagnose.csv')
+        pd.DataFrame({'PID': ['1', '2'], 'CONCEPT': ['A', 'B']}).to_csv(self.file_path, index=False)
+        self.cache = FormattedDataCache(os.path.join(self.tmp_dir.name, 'cache'))
+        self.calls = 0
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def create(self):
+        self.calls += 1
+        return pd.read_csv(self.file_path, dtype=str)
+
+    def test_get_or_create(self):
+        first = self.cache.get_or_create(self.file_path, {'columns': None}, self.create)
+        second = self.cache.get_or_create(self.file_path, {'columns': None}, self.create)
+        self.assertEqual(self.calls, 1)
+        pd.testing.assert_frame_equal(first.to_pandas(), second.to_pandas())
+        pd.testing.assert_frame_equal(second.to_pandas(), self.create())
+
+    def test_config_is_part_of_key(self):
+        self.cache.get_or_create(self.file_path, {'columns': None}, self.create)
+        self.cache.get_or_create(self.file_path, {'columns': ['PID']}, self.create)
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(len(os.listdir(self.cache.cache_dir)), 2)
+
+    def test_stale_entries_are_replaced(self):
+        self.cache.get_or_create(self.file_path, {'columns': None}, self.create)
+        pd.DataFrame({'PID': ['1', '2', '3'], 'CONCEPT': ['A', 'B', 'C']}).to_csv(self.file_path, index=False)
+        table = self.cache.get_or_create(self.file_path, {'columns': None}, self.create)
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(table.num_rows, 3)
+        self.assertEqual(len(os.listdir(self.cache.cache_dir)), 1)
+
+    def test_get_or_create_from_chunks(self):
+        def create_chunks():
+            self.calls += 1
+            for chunk in pd.read_csv(self.file_path, dtype=str, chunksize=1):
+                yield chunk.astype({'CONCEPT': 'category'}) # Chunks have different dictionaries
+        first = self.cache.get_or_create_from_chunks(self.file_path, {'columns': None}, create_chunks)
+        second = self.cache.get_or_create_from_chunks(self.file_path, {'columns': None}, create_chunks)
+        self.assertEqual(self.calls, 1)
+        pd.testing.assert_frame_equal(first.to_pandas(), self.create())
+        pd.testing.assert_frame_equal(second.to_pandas(), self.create())
+
+    def test_chunks_that_do_not_fit_are_not_cached(self):
+        chunks = lambda: iter([pd.DataFrame({'PID': ['1']}), pd.DataFrame({'PID': [[1, 2]]})])
+        self.assertIsNone(self.cache.get_or_create_from_chunks(self.file_path, {'columns': None}, chunks))
+        self.assertEqual(os.listdir(self.cache.cache_dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
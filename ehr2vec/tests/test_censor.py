@@ -1,5 +1,8 @@
 import unittest
-from data_fixes.censor import Censorer, EQ_Censorer
+
+import numpy as np
+from common.ragged import RaggedFeatures
+from data_fixes.censor import Censorer, EQ_Censorer, search_cuts
 
 class TestCensorer(unittest.TestCase):
 
@@ -21,26 +24,50 @@ class TestCensorer(unittest.TestCase):
         result = self.censorer.censor(features, censor_outcomes)
         self.assertEqual(result, expected_result)
 
-    def test_if_tokenized(self):
-        self.assertFalse(self.censorer._identify_if_tokenized(['[CLS]', 'BG_GENDER_Male', '[SEP]', 'Diagnosis1', '[SEP]', 'Diagnosis2']))
-        self.assertTrue(self.censorer._identify_if_tokenized([0, 6, 1, 7, 1, 8]))
-
-    def test_identify_background(self):
+    def test_censor_batch(self):
         self.censorer.vocabulary = {'[CLS]': 0, '[SEP]': 1, 'BG_GENDER_Male': 2, 'Diagnosis1': 3, 'Diagnosis2': 4}
+        features = {
+            'concept': [[0, 2, 1, 3, 1, 4], [0, 2, 1, 3, 4, 3], [0, 2, 1, 4]],
+            'abspos': [[0, 0, 0, 1, 1, 5], [0, 0, 0, 3, 1, 2], [0, 0, 0, 9]],
+        }
+        censor_outcomes = [1, 0.5, None]
+        expected_result = {
+            'concept': [[0, 2, 1, 3, 1], [0, 2, 1, 4], [0, 2, 1, 4]],
+            'abspos': [[0, 0, 0, 1, 1], [0, 0, 0, 1], [0, 0, 0, 9]],
+        }
+        result = self.censorer.censor(features, censor_outcomes)
+        self.assertEqual(result, expected_result)
 
-        background_flags = self.censorer._identify_background(['[CLS]', 'BG_GENDER_Male', '[SEP]', 'Diagnosis1', '[SEP]', 'Diagnosis2'], tokenized_flag=False)
-        self.assertEqual(background_flags, [True, True, True, False, False, False])
+    def test_censor_horizons(self):
+        self.censorer.vocabulary = {'[CLS]': 0, '[SEP]': 1, 'BG_GENDER_Male': 2, 'Diagnosis1': 3, 'Diagnosis2': 4}
+        features = RaggedFeatures.from_lists({
+            'concept': [[0, 2, 1, 3, 1, 4, 4], [0, 2, 1, 3]],
+            'abspos': [[0, 0, 0, 1, 1, 2, 5], [0, 0, 0, 3]],
+        })
+        censor_timestamps = np.array([[1, 3, np.nan], [2, 3, 1]])
+        cuts = self.censorer.cut_indices(features, censor_timestamps, n_hours=np.array([0, 1, 0]))
+        self.assertEqual(cuts.tolist(), [[5, 6, 7], [3, 4, 3]])
+
+        horizons = self.censorer.censor_horizons(features, censor_timestamps, n_hours=np.array([0, 1, 0]))
+        self.assertEqual(horizons[0].to_lists()['concept'], [[0, 2, 1, 3, 1], [0, 2, 1]])
+        self.assertTrue(np.shares_memory(horizons[1].patient(0)['concept'], features.values['concept']))
+
+    def test_background_flags(self):
+        self.censorer.vocabulary = {'[CLS]': 0, '[SEP]': 1, 'BG_GENDER_Male': 2, 'Diagnosis1': 3, 'Diagnosis2': 4}
+        starts, lengths = np.array([0]), np.array([6])
 
-        background_flags_tokenized = self.censorer._identify_background([0, 2, 1, 3, 1, 4], tokenized_flag=True)
-        self.assertEqual(background_flags_tokenized, [True, True, True, False, False, False])
+        background_flags = self.censorer._get_background_flags(['[CLS]', 'BG_GENDER_Male', '[SEP]', 'Diagnosis1', '[SEP]', 'Diagnosis2'], starts, lengths)
+        self.assertEqual(background_flags.tolist(), [True, True, True, False, False, False])
 
-    def test_generate_censor_flags(self):
-        abspos = [0, 0, 0, 1, 1, 2, 3, 3]
-        background_flags = [False, True, False, False, False, False, False, False]
-        event_timestamp = 1
-        censor_flags = self.censorer._generate_censor_flags(abspos, background_flags, event_timestamp)
+        background_flags_tokenized = self.censorer._get_background_flags([0, 2, 1, 3, 1, 4], starts, lengths)
+        self.assertEqual(background_flags_tokenized.tolist(), [True, True, True, False, False, False])
 
-        self.assertEqual(censor_flags, [True, True, True, True, True, True, False, False])
+    def test_search_cuts(self):
+        # Patient 1 is not sorted after its prefix, patient 2 has no censor time
+        abspos = np.array([0, 0, 1, 2, 2, 3, 0, 5, 1, 2, 0, 9], dtype=float)
+        offsets = np.array([0, 6, 10, 12])
+        cuts = search_cuts(abspos, offsets, np.array([1, 1, 1]), np.array([1, 0.5, np.nan]), 1)
+        self.assertEqual(cuts.tolist(), [5, 1, 2])
 
 class TestEQCensorer(unittest.TestCase):
 
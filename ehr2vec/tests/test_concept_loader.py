@@ -1,7 +1,9 @@
+import os
+import tempfile
 import unittest
 import pandas as pd
 from unittest.mock import patch
-from data.concept_loader import ConceptLoader
+from data.concept_loader import BatchPrefetcher, ConceptLoader, ConceptLoaderLarge, CsvIterator
 
 class TestConceptLoader(unittest.TestCase):
     @patch('data.concept_loader.ConceptLoader._verify_input', return_value=None)
@@ -19,6 +21,60 @@ class TestConceptLoader(unittest.TestCase):
         })
         self.assertEqual(list(self.conceptloader._detect_date_columns(df)), ['testdate', 'testtime', 'dateandtime'])
 
+    def test_read_csv_schema(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, 'concept.diagnose.csv')
+            pd.DataFrame({
+                'TIMESTAMP': ['2020-01-01', '2020-01-02 10:30:00', None],
+                'PID': ['1', '2', '3'],
+                'CONCEPT': ['123', '456', '123'],
+            }).to_csv(file_path, index=False)
+            df = self.conceptloader.read_file(file_path)
+            self.assertTrue(pd.api.types.is_datetime64_dtype(df.TIMESTAMP))
+            self.assertEqual(df.TIMESTAMP.tolist()[:2], [pd.Timestamp('2020-01-01'), pd.Timestamp('2020-01-02 10:30:00')])
+            self.assertTrue(pd.isna(df.TIMESTAMP.iloc[2]))
+            self.assertIsInstance(df.CONCEPT.dtype, pd.CategoricalDtype)
+            self.assertEqual(df.CONCEPT.tolist(), ['123', '456', '123'])
+            # Zone offsets do not fit the schema and are parsed by pandas
+            pd.DataFrame({'TIMESTAMP': ['2020-01-01T10:00:00+02:00'], 'PID': ['1'], 'CONCEPT': ['123']}).to_csv(file_path, index=False)
+            df = self.conceptloader.read_file(file_path)
+            self.assertEqual(df.TIMESTAMP.tolist(), [pd.Timestamp('2020-01-01 10:00:00')])
+
+    def test_csv_iterator(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, 'concept.diagnose.csv')
+            pd.DataFrame({
+                'TIMESTAMP': ['2020-01-01', '2020-01-02 10:30:00', None, '2020-01-04', '2020-01-05'],
+                'PID': ['1', '2', '3', '4', '5'],
+                'CONCEPT': ['123', '456', '123', '789', '456'],
+                'VISIT_DATE': ['2020-01-01', '2020-01-02', '2020-01-03', '2020-01-04', '2020-01-05'],
+            }).to_csv(file_path, index=False)
+            chunks = list(CsvIterator(file_path, chunksize=2))
+            self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+            df = pd.concat(chunks, ignore_index=True)
+            expected = self.conceptloader.read_file(file_path)
+            pd.testing.assert_series_equal(df.TIMESTAMP, expected.TIMESTAMP)
+            self.assertEqual(df.CONCEPT.astype(str).tolist(), expected.CONCEPT.astype(str).tolist())
+            # The format of undeclared datetime columns is chosen once and applied to every chunk
+            self.assertTrue(pd.api.types.is_datetime64_dtype(df.VISIT_DATE))
+            self.assertEqual(df.VISIT_DATE.iloc[-1], pd.Timestamp('2020-01-05'))
+            # Rows that do not fit the schema are read with pandas
+            pd.DataFrame({'TIMESTAMP': ['2020-01-01T10:00:00+02:00'] * 3, 'PID': ['1', '2', '3'], 'CONCEPT': ['123'] * 3}).to_csv(file_path, index=False)
+            df = pd.concat(CsvIterator(file_path, chunksize=2), ignore_index=True)
+            self.assertEqual(df.TIMESTAMP.tolist(), [pd.Timestamp('2020-01-01 10:00:00')] * 3)
+
+    def test_drop_duplicates_and_sort(self):
+        df = pd.DataFrame({
+            'PID': ['2', '1', '1', '2', None, '1', '2'],
+            'TIMESTAMP': pd.to_datetime(['2020-01-02', '2020-01-03', None, '2020-01-01', '2020-01-01', '2020-01-03', '2020-01-02']),
+            'CONCEPT': ['A', 'B', 'C', 'D', 'E', 'B', 'F'],
+        })
+        for by in [['PID', 'TIMESTAMP'], ['TIMESTAMP']]:
+            expected = df.drop_duplicates().sort_values(by, kind='stable')
+            pd.testing.assert_frame_equal(self.conceptloader._drop_duplicates_and_sort(df, by), expected)
+            # Sorted input is returned as is
+            pd.testing.assert_frame_equal(self.conceptloader._drop_duplicates_and_sort(expected, by), expected)
+
     def test_invalid_creation(self):
         with self.assertRaises(AssertionError):
             ConceptLoader(concepts='diagnose')
@@ -27,5 +83,114 @@ class TestConceptLoader(unittest.TestCase):
         with self.assertRaises(AssertionError):
             ConceptLoader(concepts=[])
 
+
+class TestConceptLoaderLarge(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.data_dir = self.tmp_dir.name
+        pd.DataFrame({
+            'TIMESTAMP': ['2020-01-03', '2020-01-01', '2020-01-02', '2020-01-05', '2020-01-04', '2020-01-01'],
+            'PID': ['1', '2', '3', '1', '4', '2'],
+            'ADMISSION_ID': ['A', 'B', 'C', 'D', 'E', 'B'],
+            'CONCEPT': ['DA1', 'DA2', 'DA3', 'DA4', 'DA5', 'DA2'],
+        }).to_csv(os.path.join(self.data_dir, 'concept.diagnose.csv'), index=False)
+        pd.DataFrame({
+            'TIMESTAMP': ['2020-01-02', '2020-01-06', '2020-01-07'],
+            'PID': ['1', '4', '5'],
+            'ADMISSION_ID': ['A', 'E', 'F'],
+            'CONCEPT': ['MA1', 'MA2', 'MA3'],
+        }).to_csv(os.path.join(self.data_dir, 'concept.medication.csv'), index=False)
+        pd.DataFrame({
+            'PID': ['1', '2', '3', '4'],
+            'BIRTHDATE': ['2000-01-01', '2000-01-02', '2000-01-03', '2000-01-04'],
+            'GENDER': ['M', 'F', 'M', 'F'],
+        }).to_csv(os.path.join(self.data_dir, 'patients_info.csv'), index=False)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_partitioned_process(self):
+        loader = ConceptLoaderLarge(concepts=['diagnose', 'medication'], data_dir=self.data_dir, batch_size=2, chunksize=2)
+        partition_dir = os.path.join(self.data_dir, 'partitions')
+        partitioned_loader = ConceptLoaderLarge(concepts=['diagnose', 'medication'], data_dir=self.data_dir, batch_size=2, chunksize=2,
+                                                partition_dir=partition_dir, partition_buffer_size=1)
+        batches = list(loader())
+        partitioned_batches = list(partitioned_loader())
+        # Each concept file is written to one file per partition, flushes add row groups
+        for partition in os.listdir(partition_dir):
+            self.assertCountEqual(os.listdir(os.path.join(partition_dir, partition)), ['0_0.parquet', '1_0.parquet'])
+
+        self.assertEqual(len(batches), len(partitioned_batches))
+        for (concepts, patients_info), (partitioned_concepts, partitioned_patients_info) in zip(batches, partitioned_batches):
+            pd.testing.assert_frame_equal(concepts.reset_index(drop=True), partitioned_concepts.reset_index(drop=True))
+            pd.testing.assert_frame_equal(patients_info, partitioned_patients_info)
+        # Patient 5 is not in patients info and is dropped
+        self.assertNotIn('5', pd.concat([concepts for concepts, _ in partitioned_batches]).PID.tolist())
+
+    def test_parquet_process(self):
+        parquet_dir = os.path.join(self.data_dir, 'parquet')
+        os.mkdir(parquet_dir)
+        for file in os.listdir(self.data_dir):
+            if file.endswith('.csv'):
+                pd.read_csv(os.path.join(self.data_dir, file)).to_parquet(os.path.join(parquet_dir, file.replace('.csv', '.parquet')), index=False)
+        columns = ['PID', 'TIMESTAMP', 'CONCEPT']
+        loader = ConceptLoaderLarge(concepts=['diagnose', 'medication'], data_dir=self.data_dir, batch_size=2, chunksize=2, columns=columns)
+        parquet_loader = ConceptLoaderLarge(concepts=['diagnose', 'medication'], data_dir=parquet_dir, batch_size=2, chunksize=2, columns=columns)
+        batches = list(loader())
+        parquet_batches = list(parquet_loader())
+
+        self.assertEqual(len(batches), len(parquet_batches))
+        for (concepts, _), (parquet_concepts, _) in zip(batches, parquet_batches):
+            self.assertCountEqual(parquet_concepts.columns.tolist(), columns)
+            pd.testing.assert_frame_equal(concepts.reset_index(drop=True), parquet_concepts.reset_index(drop=True))
+
+    def test_prefetched_process(self):
+        loader = ConceptLoaderLarge(concepts=['diagnose', 'medication'], data_dir=self.data_dir, batch_size=2, chunksize=2, num_workers=1)
+        prefetched_loader = ConceptLoaderLarge(concepts=['diagnose', 'medication'], data_dir=self.data_dir, batch_size=2, chunksize=2, prefetch=1)
+        batches = list(loader())
+        prefetched = prefetched_loader()
+        prefetched_batches = list(prefetched)
+
+        self.assertEqual(len(batches), len(prefetched_batches))
+        for (concepts, _), (prefetched_concepts, _) in zip(batches, prefetched_batches):
+            pd.testing.assert_frame_equal(concepts, prefetched_concepts)
+        self.assertEqual(prefetched.metrics()['batches'], len(batches))
+
+    def test_cached_process(self):
+        loader = ConceptLoaderLarge(concepts=['diagnose', 'medication'], data_dir=self.data_dir, batch_size=2, chunksize=2)
+        cache_dir = os.path.join(self.data_dir, 'cache')
+        batches = list(loader())
+        for _ in range(2): # The first run streams the files into the cache, the second reads them from it
+            cached_loader = ConceptLoaderLarge(concepts=['diagnose', 'medication'], data_dir=self.data_dir, batch_size=2, chunksize=2, cache_dir=cache_dir)
+            cached_batches = list(cached_loader())
+            self.assertEqual(len(batches), len(cached_batches))
+            for (concepts, _), (cached_concepts, _) in zip(batches, cached_batches):
+                pd.testing.assert_frame_equal(concepts.reset_index(drop=True), cached_concepts.reset_index(drop=True))
+
+
+class TestBatchPrefetcher(unittest.TestCase):
+    def test_order_and_metrics(self):
+        prefetcher = BatchPrefetcher(iter(range(5)), size=2)
+        self.assertEqual(list(prefetcher), [0, 1, 2, 3, 4])
+        self.assertEqual(list(prefetcher), [])
+        metrics = prefetcher.metrics()
+        self.assertEqual(metrics['batches'], 5)
+        self.assertLessEqual(metrics['mean_queue_depth'], 2)
+
+    def test_producer_error(self):
+        def failing():
+            yield 1
+            raise ValueError('read failed')
+        prefetcher = BatchPrefetcher(failing())
+        self.assertEqual(next(prefetcher), 1)
+        with self.assertRaises(ValueError):
+            next(prefetcher)
+
+    def test_close(self):
+        prefetcher = BatchPrefetcher(iter(range(100)), size=1)
+        next(prefetcher)
+        prefetcher.close()
+        self.assertFalse(prefetcher.thread.is_alive())
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -59,6 +59,14 @@ class TestBaseCreator(unittest.TestCase):
         self.assertIn('SEGMENT', result.columns)
         self.assertEqual(result.SEGMENT.tolist(), [1, 1, 1, 2])
 
+    def test_number_segments(self):
+        pids = pd.Series(['1', '2', '1', '1', '2', '1'])
+        segments = pd.Series(['B', 'A', 'A', None, 'A', 'B'])
+        expected = pd.DataFrame({'PID': pids, 'SEG': segments}).groupby('PID')['SEG'].transform(lambda x: pd.factorize(x)[0]+1)
+        result = SegmentCreator.number_segments(pids, segments)
+        self.assertEqual(result.tolist(), [1, 1, 2, 0, 1, 1])
+        self.assertEqual(result.tolist(), expected.tolist())
+
     def test_background_creator(self):
         creator = BackgroundCreator(self.cfg)
         result = creator.create(self.concepts, self.patients_info)
@@ -1,5 +1,7 @@
 import unittest
+import numpy as np
 from data_fixes.exclude import Excluder
+from common.ragged import RaggedFeatures
 
 class TestExcluder(unittest.TestCase):
 
@@ -27,6 +29,20 @@ class TestExcluder(unittest.TestCase):
         result = self.excluder._exclude(features)
         self.assertEqual(result, expected_result)
 
+    def test_count_codes(self):
+        concepts = np.array([1, 3, 4, 2, 5, 1, 2])
+        offsets = np.array([0, 5, 5, 7])
+        np.testing.assert_array_equal(self.excluder.count_codes(concepts, offsets), [3, 0, 0])
+
+        concepts = np.array(['[CLS]', 'BG_GENDER', 'A', '[SEP]', 'B', 'C'], dtype=object)
+        np.testing.assert_array_equal(self.excluder.count_codes(concepts, np.array([0, 4, 6])), [1, 2])
+
+    def test_exclude_ragged(self):
+        features = RaggedFeatures.from_lists({'concept': [[1, 3, 4, 5], [1, 3, 4, 2], [3, 4, 5, 5]]})
+        result, kept_indices = self.excluder.exclude_ragged(features)
+        self.assertEqual(kept_indices, [0, 2])
+        self.assertEqual(result.to_lists(), {'concept': [[1, 3, 4, 5], [3, 4, 5, 5]]})
+
     def test__is_tokenized(self):
         concepts_list = [[3, 4, 5], [3, 4], [3, 4, 5, 5]]
         concepts_list2 = [['A', 'B', 'C'], ['A', 'B'], ['A', 'B', 'C', 'C']]
@@ -36,6 +36,24 @@ class TestFeatureMaker(unittest.TestCase):
 
         self.assertCountEqual(pids, self.concepts['PID'].unique().tolist())
 
+    def test_create_features_matches_groupby(self):
+        concepts = pd.DataFrame({
+            'PID': ['2', '1', None, '2', '1'],
+            'CONCEPT': ['A', 'B', 'C', 'D', 'E'],
+            'AGE': [1., 2., 3., 4., 5.],
+            'ABSPOS': [10., 20., 30., 40., 50.],
+            'SEGMENT': [1, 1, 1, 2, 2],
+        })
+        features, pids = self.feature_maker.create_features(concepts)
+
+        # Patients in order of first appearance, missing PIDs dropped
+        self.assertEqual(pids, ['2', '1'])
+        expected = {feature: [] for feature in features}
+        for _, patient in concepts.groupby('PID', sort=False):
+            for feature, values in expected.items():
+                values.append(patient[feature.upper()].tolist())
+        self.assertEqual(features, expected)
+
     def test_create_pipeline(self):
         pipeline = self.feature_maker.create_pipeline()
         self.assertIsInstance(pipeline, list)
@@ -1,5 +1,6 @@
 import random
 import unittest
+import numpy as np
 from unittest.mock import Mock, patch
 from ehr2vec.tests.helpers import ConfigMock
 from ehr2vec.data.filter import CodeTypeFilter, PatientFilter
@@ -20,7 +21,8 @@ class TestCodeTypeFilter(unittest.TestCase):
         data = Mock()
         # data.vocabulary = {'BG_GENDER_MALE': 10, 'Diagnosis1': 11, 'Medication1': 12, 'Labtest1': 13}
         data.features = {'concept': [[10, 11, 12, 13], [11, 13, 13]]}
-        keep_tokens = set([10, 11, 15])
+        keep_tokens = np.zeros(16, dtype=bool)
+        keep_tokens[[10, 11, 15]] = True
 
         patient1 = {'concept': data.features['concept'][0]}
         patient2 = {'concept': data.features['concept'][1]}
@@ -103,8 +105,14 @@ class TestPatientFilter(unittest.TestCase):
         indices = list(range(len(self.data.pids)))
         random.shuffle(indices)
         
-        self.assertCountEqual(result.pids, [self.data.pids[i] for i in indices[:num_patients]])
+        self.assertEqual(result.pids, [self.data.pids[i] for i in sorted(indices[:num_patients])])
         self.assertEqual(result.pids, result2.pids)
 
+    def test_select_entries_keeps_order(self):
+        result = self.filter.select_entries(self.data, np.array([2, 0]))
+        self.assertEqual(result.pids, ['pid3', 'pid1'])
+        self.assertEqual(result.censor_outcomes, [50, 50])
+        self.assertEqual(result.features['concept'], [[7, 8], [0, 2, 3]])
+
 if __name__ == '__main__':
     unittest.main()
@@ -38,5 +38,19 @@ class TestHandler(unittest.TestCase):
         result = self.handler.handle(features)
         self.assertEqual(result, expected_result)
 
+    def test_handle_batch(self):
+        features = {
+            'concept': [['A', None, 'B', 'C'], [], ['D', 'E', 'F']],
+            'age': [[1., 2., 150., 4.], [], [float('nan'), 5., 6.]],
+            'segment': [[2, 4, 6, 8], [], [3, 1, 3]]
+        }
+        expected_result = {
+            'concept': [['A', 'C'], [], ['E', 'F']],
+            'age': [[1., 4.], [], [5., 6.]],
+            'segment': [[0, 1], [], [0, 1]]
+        }
+        result = self.handler.handle(features)
+        self.assertEqual(result, expected_result)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
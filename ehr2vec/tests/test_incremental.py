@@ -0,0 +1,77 @@
+import os
+import tempfile
+import unittest
+
+import pandas as pd
+import torch
+from data.incremental import FeatureManifest, IncrementalFeatureUpdater, patient_fingerprints
+
+
+def create_features(concepts: pd.DataFrame, patients_info: pd.DataFrame):
+    """Features are the concepts of each patient, patients without concepts are excluded"""
+    pids = [pid for pid in patients_info['PID'] if pid in set(concepts['PID'])]
+    return {'concept': [concepts.loc[concepts['PID'] == pid, 'CONCEPT'].tolist() for pid in pids]}, pids
+
+
+class TestIncremental(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.features_dir = self.tmp_dir.name
+        self.source = os.path.join(self.features_dir, 'concept.diagnose.csv')
+        self.concepts = pd.DataFrame({'PID': ['1', '1', '2', '3'], 'CONCEPT': ['A', 'B', 'C', 'D']})
+        self.patients_info = pd.DataFrame({'PID': ['1', '2', '3', '4']})
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def build(self, batches):
+        """Full build of one shard per batch, with manifest"""
+        manifest = FeatureManifest(self.features_dir)
+        pids = []
+        for i, (concepts, patients_info) in enumerate(manifest.record(batches)):
+            features, kept_pids = create_features(concepts, patients_info)
+            torch.save(features, os.path.join(self.features_dir, f'features_{i}.pt'))
+            torch.save(kept_pids, os.path.join(self.features_dir, f'pids_features_{i}.pt'))
+            pids.append(kept_pids)
+        torch.save(pids, os.path.join(self.features_dir, 'pids_features.pt'))
+        self.concepts.to_csv(self.source, index=False)
+        manifest.sources = FeatureManifest.get_sources([self.source])
+        manifest.config = FeatureManifest.get_config({})
+        manifest.save()
+
+    def test_patient_fingerprints(self):
+        fingerprints = patient_fingerprints(self.concepts, self.patients_info)
+        self.assertEqual(list(fingerprints), ['1', '2', '3', '4'])
+        shuffled = patient_fingerprints(self.concepts.iloc[::-1], self.patients_info)
+        self.assertEqual(fingerprints, shuffled)
+        changed = patient_fingerprints(self.concepts.replace({'B': 'E'}), self.patients_info)
+        self.assertNotEqual(fingerprints['1'], changed['1'])
+        self.assertEqual(fingerprints['2'], changed['2'])
+
+    def test_update(self):
+        patients = self.patients_info
+        self.build([(self.concepts[self.concepts.PID.isin(['1', '2'])], patients[patients.PID.isin(['1', '2'])]),
+                    (self.concepts[self.concepts.PID.isin(['3', '4'])], patients[patients.PID.isin(['3', '4'])])])
+        updater = IncrementalFeatureUpdater(self.features_dir, create_features, {}, batch_size=10)
+        self.assertTrue(updater.is_compatible())
+        self.assertFalse(IncrementalFeatureUpdater(self.features_dir, create_features, {'other': 1}, 10).is_compatible())
+
+        # Patient 1 changes, 2 is removed, 4 gets a concept, 5 is new
+        concepts = pd.DataFrame({'PID': ['1', '3', '4', '5'], 'CONCEPT': ['E', 'D', 'F', 'G']})
+        patients = pd.DataFrame({'PID': ['1', '3', '4', '5']})
+        self.concepts = concepts
+        self.concepts.to_csv(self.source, index=False)
+        os.utime(self.source, ns=(0, 0))
+        pids = updater.update([(concepts, patients)], [self.source])
+
+        self.assertEqual(pids, [['1'], ['3', '4'], ['5']])
+        self.assertEqual(torch.load(os.path.join(self.features_dir, 'pids_features.pt')), pids)
+        self.assertEqual(torch.load(os.path.join(self.features_dir, 'features_0.pt')), {'concept': [['E']]})
+        self.assertEqual(torch.load(os.path.join(self.features_dir, 'features_1.pt')), {'concept': [['D'], ['F']]})
+        self.assertEqual(torch.load(os.path.join(self.features_dir, 'features_2.pt')), {'concept': [['G']]})
+        # Unchanged sources leave the shards as they are
+        self.assertEqual(updater.update([], [self.source]), pids)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+
+import numpy as np
+
+from sklearn.linear_model import LogisticRegression
+
+from common.utils import Data
+from data.prepare_data import OneHotEncoder
+
+
+class TestOneHotEncoder(unittest.TestCase):
+    def setUp(self):
+        self.token2index = {3: 0, 4: 1, 5: 2}
+        self.data = Data(features={'concept': [[1, 3, 4, 4], [1, 5, 9]], 'age': [[30.2, 30.5, 31.7, 32.1], [50.0, 51.0, 52.9]]},
+                         pids=['p1', 'p2'], outcomes=[None, 10.0])
+
+    def test_encode(self):
+        X, y = OneHotEncoder.encode(self.data, self.token2index)
+        self.assertEqual(X.format, 'csr')
+        np.testing.assert_array_equal(X.toarray(), [[32, 1, 1, 0], [52, 0, 0, 1]])
+        np.testing.assert_array_equal(y, [0, 1])
+
+    def test_encode_count(self):
+        X, _ = OneHotEncoder.encode(self.data, self.token2index, weighting='count')
+        np.testing.assert_array_equal(X.toarray(), [[32, 1, 2, 0], [52, 0, 0, 1]])
+
+    def test_encode_tfidf(self):
+        X, y = OneHotEncoder.encode(self.data, self.token2index, weighting='tfidf')
+        self.assertEqual(X.dtype, np.float32)
+        np.testing.assert_array_equal(X.toarray(), [[32, 1, 2, 0], [52, 0, 0, 1]]) # Counts, weighted by the model
+        model = OneHotEncoder.get_model(LogisticRegression(), weighting='tfidf').fit(X, y)
+        weighted = model[:-1].transform(X).toarray()
+        np.testing.assert_allclose(weighted[:, 0], [32, 52])
+        np.testing.assert_allclose(np.linalg.norm(weighted[:, 1:], axis=1), [1, 1], rtol=1e-6)
+
+    def test_encode_empty_patient(self):
+        data = Data(features={'concept': [[], [1, 3]], 'age': [[], [40.0, 41.0]]}, pids=['p0', 'p1'], outcomes=[None, None])
+        X, _ = OneHotEncoder.encode(data, self.token2index)
+        np.testing.assert_array_equal(X.toarray(), [[0, 0, 0, 0], [41, 1, 0, 0]])
+
+
+if __name__ == '__main__':
+    unittest.main()
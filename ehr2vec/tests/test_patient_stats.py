@@ -0,0 +1,28 @@
+import unittest
+
+from common.utils import Data
+from stats.patient_stats import PatientStats
+
+
+class TestPatientStats(unittest.TestCase):
+    def setUp(self):
+        features = {
+            'concept': [['A', 'B', 'C', 'D'], ['A', 'D', 'B', 'C'], ['A', 'B']],
+            'age': [[1, 2, 3, 4], [1, 4, 2, 3], [1, 2]],
+            'abspos': [[0, 730, 2190, 2920], [0, 2920, 730, 2190], [0, 730]],
+            'segment': [[0, 1, 1, 2], [0, 2, 1, 1], [0, 1]],
+        }
+        self.data = Data(features, ['p1', 'p2', 'p3'], outcomes={'O': [2500, 2500, None]})
+
+    def test_process_patients(self):
+        stats = PatientStats(self.data, censoring_times=[0, 1])
+        stats.process_patients()
+        # Patient 2 is not sorted, items after the censoring time are filtered out wherever they are
+        self.assertEqual(stats.stats_dic['ages'], {'O': [3, 3]})
+        self.assertEqual(stats.stats_dic['sequence_length'], {'O': {0: [2, 2], 1: [1, 1]}})
+        self.assertEqual(stats.stats_dic['trajectory'], {'O': {0: [2, 2], 1: [0, 0]}})
+        self.assertEqual(stats.stats_dic['visits'], {'O': {0: [1, 1], 1: [1, 1]}})
+
+
+if __name__ == '__main__':
+    unittest.main()
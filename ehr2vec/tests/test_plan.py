@@ -0,0 +1,84 @@
+import copy
+import random
+import unittest
+
+from common.config import Config
+from common.utils import Data
+from data.filter import PatientFilter
+from data.plan import PreprocessingPlan
+from data.prepare_data import DataModifier
+
+
+class TestPreprocessingPlan(unittest.TestCase):
+    def setUp(self):
+        self.cfg = Config({'data': {'min_len': 2, 'min_age': 10, 'max_age': 80,
+                                    'censorer': {'_target_': 'data_fixes.censor.EQ_Censorer'}}})
+        self.patient_filter = PatientFilter(self.cfg)
+        self.data_modifier = DataModifier(self.cfg)
+        vocabulary = {'[PAD]': 0, '[CLS]': 1, '[SEP]': 2, '[UNK]': 3, 'BG_GENDER_Male': 4, 'BG_GENDER_Female': 5,
+                      'D1': 6, 'D2': 7, 'D3': 8}
+        random.seed(0)
+        features = {'concept': [], 'abspos': [], 'age': [], 'segment': []}
+        for _ in range(20):
+            length = random.randint(0, 10)
+            features['concept'].append([1, random.choice([4, 5]), 2] + [random.choice([2, 6, 7, 8]) for _ in range(length)])
+            abspos = sorted(random.uniform(0, 100) for _ in range(length))
+            features['abspos'].append([0., 0., 0.] + abspos)
+            age = random.uniform(0, 90)
+            features['age'].append([age] * 3 + [age + pos / 24 / 365.25 for pos in abspos])
+            features['segment'].append([0, 0, 0] + [2 * i for i in range(1, length + 1)])
+        self.data = Data(features=features, pids=[f'p{i}' for i in range(20)],
+                         outcomes=[random.choice([None, 50.]) for _ in range(20)],
+                         censor_outcomes=[random.choice([None, random.uniform(0, 100)]) for _ in range(20)],
+                         vocabulary=vocabulary, mode='finetune')
+
+    def create_plan(self, lazy: bool, chunk_size: int = 3) -> PreprocessingPlan:
+        plan = PreprocessingPlan(lazy=lazy, chunk_size=chunk_size)
+        plan.filter(self.patient_filter.exclude_pids, args_for_func={'exclude_pids': ['p3', 'p7']})
+        plan.filter(self.data_modifier.assign_censor_outcomes, args_for_func={'n_hours': 1})
+        plan.transform(self.data_modifier.censor_data, args_for_func={'n_hours': 1})
+        plan.filter(self.patient_filter.select_by_age, reads_features=True)
+        plan.filter(self.patient_filter.exclude_short_sequences, reads_features=True, log_positive_patients_num=True)
+        plan.filter(self.patient_filter.select_random_subset, args_for_func={'num_patients': 8})
+        plan.transform(self.data_modifier.truncate, args_for_func={'truncation_len': 6})
+        plan.transform(self.data_modifier.normalize_segments)
+        plan.transform(self.data_modifier.adapt_to_behrt)
+        return plan
+
+    def test_lazy_matches_eager(self):
+        eager = self.create_plan(lazy=False).execute(copy.deepcopy(self.data))
+        for chunk_size in [1, 3, 100]:
+            lazy = self.create_plan(lazy=True, chunk_size=chunk_size).execute(copy.deepcopy(self.data))
+            self.assertEqual(lazy.pids, eager.pids)
+            self.assertEqual(lazy.features, eager.features)
+            self.assertEqual(lazy.outcomes, eager.outcomes)
+            self.assertEqual(lazy.censor_outcomes, eager.censor_outcomes)
+
+    def test_lazy_does_not_modify_input(self):
+        data = copy.deepcopy(self.data)
+        self.create_plan(lazy=True).execute(data)
+        self.assertEqual(data.features, self.data.features)
+
+    def test_transforms_update_patient_data(self):
+        def shift_censor_outcomes(data):
+            data.censor_outcomes = [None if t is None else t + 1 for t in data.censor_outcomes]
+            return data
+        def drop_first(data):
+            return self.patient_filter.select_entries(data, list(range(1, len(data.pids))))
+        plan = PreprocessingPlan(lazy=True, chunk_size=3).transform(shift_censor_outcomes)
+        result = plan.execute(copy.deepcopy(self.data))
+        self.assertEqual(result.censor_outcomes, [None if t is None else t + 1 for t in self.data.censor_outcomes])
+        with self.assertRaises(AssertionError):
+            PreprocessingPlan(lazy=True, chunk_size=3).transform(drop_first).execute(copy.deepcopy(self.data))
+
+    def test_explain(self):
+        explanation = self.create_plan(lazy=True).explain().splitlines()
+        self.assertEqual(len(explanation), 10)
+        self.assertIn('exclude_pids(exclude_pids=<list of 2>)', explanation[1])
+        self.assertIn('[fused pass 1]', explanation[3])
+        self.assertIn('[needs features]', explanation[4])
+        self.assertTrue(all('[fused pass 2]' in line for line in explanation[7:]))
+
+
+if __name__ == '__main__':
+    unittest.main()
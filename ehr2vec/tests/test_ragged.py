@@ -0,0 +1,106 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+from common.ragged import FeaturesView, RaggedFeatures, segment_sum, segmented_dense_rank
+from common.utils import Data
+
+
+class TestRaggedFeatures(unittest.TestCase):
+    def setUp(self):
+        self.features = {
+            'concept': [['[CLS]', 'A', 'B'], [], ['C']],
+            'age': [[1.5, 2.5, 3.5], [], [40.]],
+        }
+        self.ragged = RaggedFeatures.from_lists(self.features)
+
+    def test_from_lists(self):
+        self.assertEqual(len(self.ragged), 3)
+        self.assertEqual(self.ragged.offsets.tolist(), [0, 3, 3, 4])
+        self.assertEqual(self.ragged.lengths().tolist(), [3, 0, 1])
+        self.assertEqual(self.ragged.values['concept'].dtype, object)
+
+    def test_to_lists(self):
+        features = self.ragged.to_lists()
+        self.assertEqual(features, self.features)
+        self.assertIsInstance(features['age'][0][0], float)
+
+    def test_select(self):
+        selected = self.ragged.select(np.array([2, 0]))
+        self.assertEqual(selected.to_lists(), {
+            'concept': [['C'], ['[CLS]', 'A', 'B']],
+            'age': [[40.], [1.5, 2.5, 3.5]],
+        })
+        self.assertEqual(len(self.ragged.select(np.array([], dtype=int))), 0)
+
+    def test_mask(self):
+        masked = self.ragged.mask(np.array([True, False, True, False]))
+        self.assertEqual(masked.to_lists(), {'concept': [['[CLS]', 'B'], [], []], 'age': [[1.5, 3.5], [], []]})
+
+    def test_segmented_dense_rank(self):
+        ragged = RaggedFeatures.from_lists({'concept': [['A'] * 4, [], ['B'] * 3], 'segment': [[0, 3, 3, 6], [], [5, 2, 5]]})
+        ranks = segmented_dense_rank(ragged.values['segment'], ragged.patient_indices(), ragged.offsets)
+        self.assertEqual(ranks.tolist(), [0, 1, 1, 2, 1, 0, 1])
+
+    def test_segment_sum(self):
+        offsets = np.array([0, 2, 2, 5])
+        self.assertEqual(segment_sum(np.array([True, False, True, True, False]), offsets).tolist(), [1, 0, 2])
+        self.assertEqual(segment_sum(np.array([], dtype=bool), np.array([0, 0])).tolist(), [0])
+
+    def test_from_lists_keeps_missing_strings(self):
+        ragged = RaggedFeatures.from_lists({'concept': [['A', float('nan')], [None]]})
+        self.assertEqual(ragged.values['concept'].dtype, object)
+        self.assertEqual(pd.isna(ragged.values['concept']).tolist(), [False, True, True])
+
+
+class TestFeaturesView(unittest.TestCase):
+    def setUp(self):
+        self.features = {'concept': [[1, 2], [3], [4, 5, 6]], 'age': [[1.5, 2.5], [3.5], [4.5, 5.5, 6.5]], 'PLOS': [0, 1, 0]}
+        self.data = Data({key: list(values) for key, values in self.features.items()}, ['p1', 'p2', 'p3'], [None, 1.0, None])
+
+    def test_select(self):
+        data = self.data.to_views()
+        subset = data.select_data_subset_by_indices([2, 0], mode='train')
+        self.assertIs(subset.features.base, data.features.base)
+        self.assertEqual(subset.pids, ['p3', 'p1'])
+        self.assertEqual(subset.features['concept'][0], [4, 5, 6])
+        self.assertEqual(subset.features['PLOS'][1], 0)
+        self.assertEqual(subset.features.select([1]).to_lists(), {'concept': [[1, 2]], 'age': [[1.5, 2.5]], 'PLOS': [0]})
+
+    def test_copy_on_write(self):
+        data = self.data.to_views()
+        subset = data.select_data_subset_by_indices([1, 2])
+        subset.features['concept'][0] = [7]
+        self.assertEqual(subset.features['concept'], [[7], [4, 5, 6]])
+        self.assertEqual(data.features['concept'][1], [3])
+        subset.features['segment'] = [[0], [0, 1, 1]]
+        self.assertEqual(list(subset.features), ['concept', 'age', 'PLOS', 'segment'])
+        self.assertNotIn('segment', data.features)
+
+    def test_in_place_edits_are_not_kept(self):
+        data = self.data.to_views()
+        data.features['concept'][0].append(9)
+        self.assertEqual(data.features['concept'][0], [1, 2])
+        data.features['concept'][1] = [3, 9]
+        data.features['concept'][1].append(10)
+        self.assertEqual(data.features['concept'][:2], [[1, 2], [3, 9]])
+        concepts = data.features['concept'][2]
+        concepts.append(10)
+        data.features['concept'][2] = concepts
+        self.assertEqual(data.features['concept'][2], [4, 5, 6, 10])
+
+    def test_from_lists(self):
+        view = FeaturesView.from_lists(self.features)
+        self.assertEqual(list(view), ['concept', 'age', 'PLOS'])
+        self.assertEqual(view.patient_values, {'PLOS': [0, 1, 0]})
+        self.assertEqual(view.to_lists(), self.features)
+        subset = view.select([2, 1]).select([1])
+        self.assertEqual(subset.indices.tolist(), [1])
+        self.assertEqual(subset['age'][-1], [3.5])
+        self.assertEqual(subset['concept'][:], [[3]])
+        del subset['age']
+        self.assertEqual(subset.to_lists(), {'concept': [[3]], 'PLOS': [1]})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import os
+import tempfile
+import unittest
+
+import torch
+from common.loader import FeaturesLoader
+from data.shards import TokenizedShards, TokenizedShardWriter
+
+
+class TestTokenizedShards(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.shards_dir = os.path.join(self.tmp_dir.name, 'tokenized_pretrain')
+        self.pids_file = os.path.join(self.tmp_dir.name, 'pids_pretrain.pt')
+        writer = TokenizedShardWriter(self.shards_dir, shard_size=2, pids_file=self.pids_file)
+        writer.append({'concept': [[1, 5], [1, 6, 7]]}, ['a', 'b'])
+        writer.append({'concept': [[1, 8]]}, ['c'])
+        writer.append({'concept': [[1, 5, 6], [1, 9]]}, ['d', 'e'])
+        self.pids = writer.close()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_writer(self):
+        self.assertEqual(self.pids, ['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(torch.load(self.pids_file), self.pids)
+        self.assertTrue(TokenizedShards.is_sharded(self.shards_dir))
+        shards = TokenizedShards(self.shards_dir)
+        self.assertEqual((len(shards), shards.n_patients), (3, 5))
+        self.assertEqual([pids for _, pids in shards.iter_shards()], [['a', 'b'], ['c', 'd'], ['e']])
+
+    def test_load(self):
+        shards = TokenizedShards(self.shards_dir)
+        self.assertEqual(shards.load(), ({'concept': [[1, 5], [1, 6, 7], [1, 8], [1, 5, 6], [1, 9]]}, self.pids))
+        self.assertEqual(shards.load(shards=[2, 0]), ({'concept': [[1, 9], [1, 5], [1, 6, 7]]}, ['e', 'a', 'b']))
+        self.assertEqual(shards.load(pids=['e', 'b']), ({'concept': [[1, 6, 7], [1, 9]]}, ['b', 'e']))
+        self.assertEqual(shards.find_shards(['e', 'b']), [0, 2])
+
+    def test_load_features_and_pids(self):
+        files = (self.tmp_dir.name, ['tokenized_pretrain.pt'], ['pids_pretrain.pt'])
+        self.assertEqual(FeaturesLoader.load_features_and_pids(*files, selected_pids=['e', 'b']), ({'concept': [[1, 6, 7], [1, 9]]}, ['b', 'e']))
+        # A monolithic file next to the shards is ambiguous
+        torch.save({'concept': []}, os.path.join(self.tmp_dir.name, 'tokenized_pretrain.pt'))
+        with self.assertRaises(ValueError):
+            FeaturesLoader.load_features_and_pids(*files)
+
+
+if __name__ == '__main__':
+    unittest.main()
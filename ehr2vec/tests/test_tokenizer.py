@@ -1,4 +1,5 @@
 import unittest
+import torch
 from unittest.mock import patch, MagicMock
 
 from tests.helpers import ConfigMock
@@ -103,6 +104,23 @@ class TestEHRTokenizer(unittest.TestCase):
             'age': [1, 1, 2, 3]
         })
 
+    def test_batch_encode(self):
+        features = {
+            'concept': [['BG_1', 'D12345', 'M12345', 'D12345'], ['BG_1', 'M1']],
+            'segment': [[0, 1, 1, 2], [0, 1]],
+            'age': [[1.5, 2.5, 2.5, 3.5], [4.5, 5.5]]
+        }
+        encoded = self.tokenizer.batch_encode(features, padding=False, truncation=7)
+        self.assertEqual(encoded['concept'], [[1, 5, 2, 6, 2, 7, 2], [1, 5, 2, 8, 2]])
+        self.assertEqual(encoded['segment'], [[0, 0, 0, 1, 1, 2, 2], [0, 0, 0, 1, 1]])
+        self.assertEqual(encoded['age'], [[1.5, 1.5, 1.5, 2.5, 2.5, 3.5, 3.5], [4.5, 4.5, 4.5, 5.5, 5.5]])
+        self.assertEqual(encoded['attention_mask'], [[1] * 7, [1] * 5])
+        self.assertEqual(list(self.tokenizer.vocabulary)[5:], ['BG_1', 'M1234', 'D123', 'M1'])
+
+        padded = self.tokenizer.batch_encode(features, padding=True, truncation=7)
+        self.assertEqual(padded['concept'].tolist(), [[1, 5, 2, 6, 2, 7, 2], [1, 5, 2, 8, 2, 0, 0]])
+        self.assertEqual(padded['age'].dtype, torch.float32)
+
     def test_limit_concepts_length(self):
         concepts = ['D12345', 'M12345']
         limited = self.tokenizer.limit_concepts_length(concepts)
@@ -118,5 +136,15 @@ class TestEHRTokenizer(unittest.TestCase):
         self.tokenizer.freeze_vocabulary()
         self.assertFalse(self.tokenizer.new_vocab)
 
+    def test_find_closest_ancestor(self):
+        self.config.cutoffs = None
+        tokenizer = EHRTokenizer(self.config, vocabulary={'[PAD]': 0, '[UNK]': 3, 'D1': 5, 'D123': 6, 'M': 7})
+        encoded = tokenizer.encode(['D12345', 'D129', 'D1', 'M01', 'X1', 'D12345'])
+        self.assertEqual(encoded, [6, 5, 5, 7, 3, 6])
+        info = tokenizer.get_ancestor_index().cache_info()
+        self.assertEqual((info.hits, info.misses), (1, 4))
+        tokenizer.vocabulary['X'] = 8 # Index is rebuilt when the vocabulary changes
+        self.assertEqual(tokenizer.find_closest_ancestor('X1'), 8)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
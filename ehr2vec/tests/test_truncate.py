@@ -1,5 +1,6 @@
 import unittest
 from data_fixes.truncate import Truncator
+from common.ragged import RaggedFeatures
 
 class TestTruncator(unittest.TestCase):
 
@@ -37,6 +38,18 @@ class TestTruncator(unittest.TestCase):
         result = self.truncator.truncate(features)
         self.assertEqual(result, expected_result)
 
+    def test_truncate_ragged(self):
+        features = {
+            'concept': [[1, 3, 2, 4, 2, 5, 6, 2], [1, 3, 2, 4, 2, 6, 2], [1, 2, 3]],
+            'abspos': [[0, 0, 0, 1, 1, 2, 3, 3], [0, 0, 0, 1, 1, 2, 2], [0, 0, 1]]
+        }
+        expected_result = {
+            'concept': [[1, 3, 2, 5, 6, 2], [1, 3, 2, 6, 2], [1, 2, 3]],
+            'abspos': [[0, 0, 0, 2, 3, 3], [0, 0, 0, 2, 2], [0, 0, 1]]
+        }
+        result = self.truncator.truncate_ragged(RaggedFeatures.from_lists(features))
+        self.assertEqual(result.to_lists(), expected_result)
+
     def test__truncate_patient(self):
         patient = {
             'concept': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
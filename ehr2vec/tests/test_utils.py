@@ -1,4 +1,5 @@
 import unittest
+import numpy as np
 import pandas as pd
 from datetime import datetime
 from unittest.mock import Mock, MagicMock, patch
@@ -115,6 +116,14 @@ class TestUtilities(unittest.TestCase):
 
         self.assertEqual(outcomes, {'COVID': [0, 2, 1], 'DEATH': [0, 1, 0], 'ICU': [1, 0, 2]})
 
+    def test_search_closest_before(self):
+        # Patient 0 is unsorted with a tie, patient 1 has nothing before its time
+        abspos = np.array([5., 1., 3., 3., 8., 4., 6.])
+        offsets = np.array([0, 5, 7])
+        closest = Utilities.search_closest_before(abspos, offsets, np.array([0, 1]), np.array([4., 2.]))
+        self.assertEqual(closest.tolist(), [2, 5])
+        self.assertEqual(Utilities.search_closest_before(abspos, offsets, np.array([0]), np.array([9.])).tolist(), [4])
+
     def test_iter_patients(self):
         pass
 
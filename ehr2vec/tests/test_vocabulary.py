@@ -0,0 +1,60 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+from common.vocabulary import VocabularyIndex
+
+
+class TestVocabularyIndex(unittest.TestCase):
+    def setUp(self):
+        self.vocabulary = {'[PAD]': 0, '[CLS]': 1, '[SEP]': 2, 'BG_GENDER_M': 3, 'D10': 4, 'M20': 5}
+        self.index = VocabularyIndex(self.vocabulary)
+
+    def test_masks(self):
+        self.assertEqual(self.index.tokens.tolist(), list(self.vocabulary))
+        np.testing.assert_array_equal(self.index.is_special, [True, True, True, False, False, False])
+        np.testing.assert_array_equal(self.index.is_background, [False, False, False, True, False, False])
+        np.testing.assert_array_equal(self.index.prefix_mask(('D', 'BG_')), [False, False, False, True, True, False])
+        self.assertIs(self.index.prefix_mask(('D', 'BG_')), self.index.prefix_mask(('D', 'BG_')))
+
+    def test_lookup_and_decode(self):
+        ids = np.array([3, 4, 7, -1])
+        np.testing.assert_array_equal(VocabularyIndex.lookup(self.index.is_background, ids), [True, False, False, False])
+        self.assertEqual(self.index.decode(ids).tolist(), ['BG_GENDER_M', 'D10', None, None])
+
+    def test_get(self):
+        index = VocabularyIndex.get(self.vocabulary)
+        self.assertIs(VocabularyIndex.get(self.vocabulary), index)
+        self.vocabulary['L30'] = 6
+        index = VocabularyIndex.get(self.vocabulary)
+        self.assertEqual(index.tokens[6], 'L30')
+        # Same size, a token replaced in place
+        del self.vocabulary['L30']
+        self.vocabulary['M40'] = 6
+        self.assertEqual(VocabularyIndex.get(self.vocabulary).tokens[6], 'M40')
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            vocabulary_path = os.path.join(tmp_dir, 'vocabulary.pt')
+            torch.save(self.vocabulary, vocabulary_path)
+            self.index.prefix_mask('M')
+            self.index.save(vocabulary_path)
+            self.assertTrue(os.path.exists(os.path.join(tmp_dir, 'vocabulary_index.pt')))
+
+            loaded = VocabularyIndex.load(self.vocabulary, vocabulary_path)
+            self.assertEqual(loaded.tokens.tolist(), self.index.tokens.tolist())
+            np.testing.assert_array_equal(loaded.prefix_mask('M'), self.index.prefix_mask('M'))
+            self.assertIs(VocabularyIndex.get(self.vocabulary), loaded)
+
+            # An index saved with another vocabulary of the same size is rebuilt
+            other = {'[PAD]': 0, '[CLS]': 1, '[SEP]': 2, 'BG_GENDER_F': 3, 'D11': 4, 'M21': 5}
+            loaded = VocabularyIndex.load(other, vocabulary_path)
+            self.assertEqual(loaded.tokens.tolist(), list(other))
+            self.assertIs(VocabularyIndex.get(other), loaded)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,15 @@
 import os
-from collections import Counter
+from itertools import chain
 from os.path import join
 
+import numpy as np
 import pandas as pd
 import torch
 from tqdm import tqdm
 
 from ehr2vec.common.logger import TqdmToLogger
+from ehr2vec.common.vocabulary import VocabularyIndex
+from ehr2vec.data.shards import TokenizedShards
 from ehr2vec.tree.node import Node
 
 
@@ -213,18 +216,22 @@ def get_counts(cfg, logger)-> dict:
     """Takes a cfg and logger and returns a dictionary of counts for each code in the vocabulary."""
     data_path = cfg.paths.features
     tokenized_dir = cfg.paths.get('tokenized_dir', 'tokenized')
-    vocabulary = torch.load(join(data_path, tokenized_dir,'vocabulary.pt'))
-    inv_vocab = {v: k for k, v in vocabulary.items()}
+    vocabulary_path = join(data_path, tokenized_dir,'vocabulary.pt')
+    index = VocabularyIndex.load(torch.load(vocabulary_path), vocabulary_path)
 
     train_val_files = [
         join(data_path, 'tokenized', f) 
         for f in os.listdir(join(data_path, tokenized_dir)) 
         if f.startswith(('tokenized_train', 'tokenized_val', 'tokenized_pretrain'))
     ]
-    counts = Counter()
+    counts = np.zeros(len(index), dtype=np.int64)
     for f in tqdm(train_val_files, desc="Count" ,file=TqdmToLogger(logger)):
-        tokenized_features = torch.load(f)
-        counts.update(inv_vocab[code] for codes in tokenized_features['concept'] for code in codes)
-
-    return dict(counts)
+        # Sharded output is counted one shard at a time
+        shards = TokenizedShards(f).iter_shards() if TokenizedShards.is_sharded(f) else [(torch.load(f), None)]
+        for tokenized_features, _ in shards:
+            concepts = np.fromiter(chain.from_iterable(tokenized_features['concept']), dtype=np.int64)
+            counts += np.bincount(concepts, minlength=len(index))[:len(index)]
+
+    counted = np.flatnonzero(counts)
+    return dict(zip(index.tokens[counted].tolist(), counts[counted].tolist()))
 